@@ -0,0 +1,211 @@
+"""
+   Copyright 2017-2018 Echo Park Labs
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   For additional information, contact:
+
+   email: info@echoparklabs.io
+"""
+
+import os
+import re
+import ast
+import threading
+import numpy as np
+
+from enum import Enum
+from concurrent.futures import ThreadPoolExecutor
+
+from epl.native.imagery.metadata_helpers import Band
+
+
+def get_band_name(band_definition) -> str:
+    """
+    The name a source band goes by in an expression. Band enums use their name (NIR, RED), band numbers are B<number>
+    """
+    if isinstance(band_definition, Band):
+        return band_definition.name
+    return "B{}".format(band_definition)
+
+
+class BandExpression:
+    """
+    A band math expression over source bands, like "(NIR - RED) / (NIR + RED)", evaluated with numpy after the
+    source bands are read. Unlike a python pixel function it doesn't need GDAL_VRT_ENABLE_PYTHON or a call back into
+    the interpreter for every block GDAL reads; the expression is checked once and then runs in row blocks across a
+    thread pool (numpy releases the GIL for the arithmetic).
+
+    Only numbers, band names, named constants, + - * / ** and comparisons, and the functions in
+    BandExpression.functions are allowed.
+    """
+    functions = {
+        'abs': np.abs,
+        'sqrt': np.sqrt,
+        'log': np.log,
+        'log10': np.log10,
+        'exp': np.exp,
+        'minimum': np.minimum,
+        'maximum': np.maximum,
+        'clip': np.clip,
+        'where': np.where,
+    }
+
+    __allowed_nodes = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Compare, ast.Call, ast.Name, ast.Load,
+                       ast.Constant,
+                       ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.USub, ast.UAdd,
+                       ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.Eq, ast.NotEq)
+
+    __executor = None
+    __executor_lock = threading.Lock()
+
+    def __init__(self, expression: str, band_names: list=None, constants: dict=None):
+        """
+        :param expression: the expression
+        :param band_names: the names the expression may use, any name if None
+        :param constants: numeric values for names in the expression that aren't bands
+        """
+        try:
+            self.constants = {key: float(value) for key, value in (constants or {}).items()}
+        except (TypeError, ValueError):
+            raise ValueError("band expression '{0}' constants must be numbers: {1}".format(expression, constants))
+
+        try:
+            tree = ast.parse(expression.strip(), mode='eval')
+        except SyntaxError as e:
+            raise ValueError("band expression '{0}' is not valid: {1}".format(expression, e.msg))
+
+        names = []
+        for node in ast.walk(tree):
+            if not isinstance(node, self.__allowed_nodes):
+                raise ValueError("band expression '{0}' uses unsupported syntax {1}".format(
+                    expression, type(node).__name__))
+            if isinstance(node, ast.Constant) and not isinstance(node.value, (int, float)):
+                raise ValueError("band expression '{0}' may only use numeric constants".format(expression))
+            if isinstance(node, ast.Call):
+                if not isinstance(node.func, ast.Name) or node.func.id not in self.functions or node.keywords:
+                    raise ValueError("band expression '{0}' calls an unsupported function".format(expression))
+            elif isinstance(node, ast.Name) and node.id not in self.functions and node.id not in self.constants \
+                    and node.id not in names:
+                if band_names is not None and node.id not in band_names:
+                    raise ValueError("band expression '{0}' uses {1}, which isn't one of its bands {2}".format(
+                        expression, node.id, band_names))
+                names.append(node.id)
+
+        self.expression = expression
+        self.names = names
+        self.__code = compile(tree, '<band expression>', 'eval')
+
+    @classmethod
+    def __get_executor(cls) -> ThreadPoolExecutor:
+        with cls.__executor_lock:
+            if cls.__executor is None:
+                cls.__executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+            return cls.__executor
+
+    def evaluate(self, arrays: dict, out: np.ndarray, nodata=0, block_rows=256) -> np.ndarray:
+        """
+        Evaluate the expression into out. Pixels where any source band is nodata, or where the result isn't finite
+        (division by zero), are set to nodata. Integer outputs are rounded and clipped to the range of the dtype.
+        :param arrays: source band name to 2d ndarray, all the same shape as out
+        :param out: 2d ndarray to write to
+        :param nodata: nodata value of the sources and the output
+        :param block_rows: number of rows evaluated in each block
+        :return: out
+        """
+        b_integer = np.issubdtype(out.dtype, np.integer)
+        dtype_info = np.iinfo(out.dtype) if b_integer else None
+        result_dtype = np.float64 if out.dtype == np.float64 else np.float32
+
+        def evaluate_block(start):
+            stop = min(start + block_rows, out.shape[0])
+            out_block = out[start:stop]
+            block = {name: arrays[name][start:stop] for name in self.names}
+            block.update(self.constants)
+            block.update(self.functions)
+
+            with np.errstate(all='ignore'):
+                result = np.asarray(eval(self.__code, {'__builtins__': {}}, block), dtype=result_dtype)
+                result = np.broadcast_to(result, out_block.shape)
+                invalid = ~np.isfinite(result)
+                for name in self.names:
+                    invalid |= block[name] == nodata
+
+                if b_integer:
+                    result = np.clip(np.rint(result), dtype_info.min, dtype_info.max)
+
+            out_block[...] = result
+            out_block[invalid] = nodata
+
+        list(self.__get_executor().map(evaluate_block, range(0, out.shape[0], block_rows)))
+        return out
+
+
+class SpectralIndex(Enum):
+    """
+    Named spectral indices, (expression, source bands, default constants). Sources are Band enums, so each scene's
+    BandMap picks the band numbers (NIR is band 5 on Landsat 8, band 4 on Landsat 4-7).
+
+    The Level-1 bands are digital numbers, not reflectance, and the indices are computed on them as they are. A
+    normalized difference only cancels a scale factor, and the DN to reflectance conversion also has an offset
+    (REFLECTANCE_ADD_BAND_x = -0.1 on Landsat 8), so even NDVI is only close to the index of the reflectance. EVI and
+    SAVI have terms that assume reflectance, so their constant is given in DN per unit of reflectance. The default is
+    for Landsat 8 (REFLECTANCE_MULT_BAND_x = 2.0E-05), pass another through the arguments of
+    FunctionDetails.from_spectral_index for other spacecraft, e.g. arguments={'dn_per_reflectance': 255}
+    """
+    NDVI = ("(NIR - RED) / (NIR + RED)", (Band.RED, Band.NIR), None)
+    NDWI = ("(GREEN - NIR) / (GREEN + NIR)", (Band.GREEN, Band.NIR), None)
+    MNDWI = ("(GREEN - SWIR1) / (GREEN + SWIR1)", (Band.GREEN, Band.SWIR1), None)
+    NDMI = ("(NIR - SWIR1) / (NIR + SWIR1)", (Band.NIR, Band.SWIR1), None)
+    NDBI = ("(SWIR1 - NIR) / (SWIR1 + NIR)", (Band.NIR, Band.SWIR1), None)
+    NBR = ("(NIR - SWIR2) / (NIR + SWIR2)", (Band.NIR, Band.SWIR2), None)
+    NBR2 = ("(SWIR1 - SWIR2) / (SWIR1 + SWIR2)", (Band.SWIR1, Band.SWIR2), None)
+    EVI = ("2.5 * (NIR - RED) / (NIR + 6 * RED - 7.5 * BLUE + dn_per_reflectance)",
+           (Band.BLUE, Band.RED, Band.NIR), {'dn_per_reflectance': 50000})
+    SAVI = ("1.5 * (NIR - RED) / (NIR + RED + 0.5 * dn_per_reflectance)",
+            (Band.RED, Band.NIR), {'dn_per_reflectance': 50000})
+
+    def __init__(self, expression, band_definitions, constants):
+        self.expression = expression
+        self.band_definitions = list(band_definitions)
+        self.constants = constants or {}
+
+    def resolve(self, band_map=None) -> tuple:
+        """
+        The expression and source bands of the index for the scenes of a BandMap
+        :param band_map: the sources become its band numbers, B<number> in the expression. Without one they stay
+        Band enums, which each scene's BandMap resolves when it's read
+        :return: (expression, band_definitions)
+        """
+        if band_map is None:
+            return self.expression, list(self.band_definitions)
+
+        try:
+            numbers = {band.name: band_map.get_number(band) for band in self.band_definitions}
+        except KeyError:
+            raise ValueError("{0} needs bands {1} that the BandMap's spacecraft doesn't have".format(
+                self.name, [band.name for band in self.band_definitions]))
+        expression = re.sub(r'\b({})\b'.format('|'.join(numbers)),
+                            lambda match: get_band_name(numbers[match.group(1)]),
+                            self.expression)
+        return expression, [numbers[band.name] for band in self.band_definitions]
+
+    @classmethod
+    def from_name(cls, name: str):
+        """
+        :param name: index name, case insensitive
+        :return: the SpectralIndex, or None if name isn't one
+        """
+        if not name:
+            return None
+        return cls.__members__.get(name.upper())
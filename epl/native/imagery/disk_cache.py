@@ -0,0 +1,186 @@
+"""
+   Copyright 2017-2018 Echo Park Labs
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   For additional information, contact:
+
+   email: info@echoparklabs.io
+"""
+
+import os
+import time
+import uuid
+import sqlite3
+import numpy as np
+
+from contextlib import closing
+from osgeo import gdal
+
+
+class DiskCache:
+    """
+    Persistent store of fetch_imagery_array results (.npy) and get_dataset results (tiled GeoTIFF) by request key,
+    for batch jobs that repeat requests across runs. An sqlite index next to the files tracks their sizes and when
+    they were last used, and the least recently used are deleted once the store is over max_bytes.
+
+    Any number of processes can share a store: files are written under a temporary name and renamed into place, so
+    a file is either complete or absent, and the index is only changed in sqlite transactions. A file that's evicted
+    between the index lookup and the read is a miss.
+
+    Landsat.disk_cache = DiskCache("/mnt/disks/ssd/imagery-cache", max_bytes=50 * 1024 ** 3)
+    """
+    def __init__(self, path: str, max_bytes: int=10 * 1024 ** 3):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+        self.__index_path = os.path.join(path, "index.sqlite")
+        with closing(self.__connect()) as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS entries ("
+                               "key TEXT PRIMARY KEY, file_name TEXT, size INTEGER, last_access REAL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)")
+
+    def __connect(self) -> sqlite3.Connection:
+        # autocommit, transactions are begun explicitly. the timeout waits out other processes' writes
+        return sqlite3.connect(self.__index_path, timeout=60, isolation_level=None)
+
+    def __get_file_path(self, file_name: str) -> str:
+        return os.path.join(self.path, file_name[:2], file_name)
+
+    def __lookup(self, key: str):
+        """
+        :return: path of the key's file, None if it isn't cached. marks it as used
+        """
+        with closing(self.__connect()) as connection:
+            row = connection.execute("SELECT file_name FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            connection.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+        return self.__get_file_path(row[0])
+
+    def __forget(self, key: str):
+        with closing(self.__connect()) as connection:
+            connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def __store(self, key: str, file_name: str, write):
+        """
+        Write a file through write(temporary_path) and add it to the index, then evict down to max_bytes
+        """
+        file_path = self.__get_file_path(file_name)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        temporary_path = "{0}.{1}.{2}.tmp{3}".format(file_path, os.getpid(), uuid.uuid4().hex,
+                                                     os.path.splitext(file_name)[1])
+        try:
+            write(temporary_path)
+            os.replace(temporary_path, file_path)
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+        size = os.path.getsize(file_path)
+        if size > self.max_bytes:
+            os.remove(file_path)
+            return
+
+        with closing(self.__connect()) as connection:
+            connection.execute("INSERT OR REPLACE INTO entries (key, file_name, size, last_access) VALUES (?, ?, ?, ?)",
+                               (key, file_name, size, time.time()))
+        self.evict()
+
+    def evict(self, max_bytes: int=None):
+        """
+        Delete the least recently used files until the store is at most max_bytes, self.max_bytes if None
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        evicted = []
+        with closing(self.__connect()) as connection:
+            # IMMEDIATE takes the write lock up front, so two processes don't both pick the same files
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+                if total > max_bytes:
+                    for key, file_name, size in connection.execute(
+                            "SELECT key, file_name, size FROM entries ORDER BY last_access").fetchall():
+                        if total <= max_bytes:
+                            break
+                        connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+                        evicted.append(file_name)
+                        total -= size
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+
+        for file_name in evicted:
+            try:
+                os.remove(self.__get_file_path(file_name))
+            except FileNotFoundError:
+                pass
+
+    def get_array(self, key: str, out: np.ndarray=None):
+        """
+        :param out: C-contiguous array to read into, with the cached array's shape and a dtype that holds the cached
+        one without loss
+        :return: the cached array (out if given), None if it isn't cached
+        """
+        file_path = self.__lookup(key)
+        if file_path is None:
+            return None
+        try:
+            cached = np.load(file_path, mmap_mode='r')
+        except (FileNotFoundError, ValueError, OSError):
+            self.__forget(key)
+            return None
+
+        if out is None:
+            return np.array(cached)
+        if out.shape != cached.shape or not out.flags.c_contiguous:
+            raise ValueError("out must be a C-contiguous array of shape {0}, not {1}".format(cached.shape, out.shape))
+        if not np.can_cast(cached.dtype, out.dtype):
+            raise ValueError("out of dtype {0} can't hold the cached {1}".format(out.dtype, cached.dtype))
+        out[...] = cached
+        return out
+
+    def put_array(self, key: str, nda: np.ndarray):
+        self.__store(key, key + ".npy", lambda temporary_path: np.save(temporary_path, nda))
+
+    def get_dataset(self, key: str):
+        """
+        :return: the cached GeoTIFF opened read only, None if it isn't cached
+        """
+        file_path = self.__lookup(key)
+        if file_path is None:
+            return None
+        dataset = gdal.Open(file_path) if os.path.exists(file_path) else None
+        if dataset is None:
+            self.__forget(key)
+        return dataset
+
+    def put_dataset(self, key: str, dataset):
+        def write(temporary_path):
+            copy = gdal.GetDriverByName("GTiff").CreateCopy(temporary_path, dataset,
+                                                            options=["TILED=YES", "COMPRESS=DEFLATE",
+                                                                     "BIGTIFF=IF_SAFER"])
+            copy.FlushCache()
+            del copy
+        self.__store(key, key + ".tif", write)
+
+    @property
+    def size_bytes(self) -> int:
+        with closing(self.__connect()) as connection:
+            return connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def __len__(self):
+        with closing(self.__connect()) as connection:
+            return connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
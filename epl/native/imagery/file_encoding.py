@@ -0,0 +1,133 @@
+"""
+   Copyright 2017-2018 Echo Park Labs
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   For additional information, contact:
+
+   email: info@echoparklabs.io
+"""
+
+
+import os
+import uuid
+
+from enum import Enum
+from osgeo import gdal
+
+from epl.grpc.imagery import epl_imagery_pb2
+
+JPEG_QUALITY = 85
+DEFLATE_LEVEL = 6
+
+
+class FileType(Enum):
+    """
+    Image files a dataset is encoded to.
+    (grpc enum, GDAL driver, suffix, GDAL data types the driver writes (None for any), band counts it writes,
+    rough compression ratio of Landsat imagery)
+    """
+    PNG     = (epl_imagery_pb2.PNG,     "PNG",   ".png", (gdal.GDT_Byte, gdal.GDT_UInt16), (1, 2, 3, 4), 2.0)
+    JPEG    = (epl_imagery_pb2.JPEG,    "JPEG",  ".jpg", (gdal.GDT_Byte,),                 (1, 3),       10.0)
+    GEOTIFF = (epl_imagery_pb2.GEOTIFF, "GTiff", ".tif", None,                             None,         2.0)
+
+    def __init__(self, grpc_num, driver_name, suffix, gdal_types, band_counts, compression_ratio):
+        self.grpc_num = grpc_num
+        self.driver_name = driver_name
+        self.suffix = suffix
+        self.gdal_types = gdal_types
+        self.band_counts = band_counts
+        self.compression_ratio = compression_ratio
+
+    @staticmethod
+    def from_grpc(grpc_num):
+        for file_type in FileType:
+            if file_type.grpc_num == grpc_num:
+                return file_type
+        raise ValueError("unknown file type {}".format(grpc_num))
+
+    def get_creation_options(self, gdal_type, quality: int=None, deflate_level: int=None, threads=None) -> list:
+        """
+        :param quality: JPEG quality, 1 to 100
+        :param deflate_level: zlib level of PNG and GeoTIFF, 1 to 9
+        :param threads: GeoTIFF compression threads, a number or "ALL_CPUS". PNG and JPEG are written on one thread
+        """
+        if self is FileType.JPEG:
+            return ["QUALITY={}".format(quality or JPEG_QUALITY)]
+        elif self is FileType.PNG:
+            return ["ZLEVEL={}".format(deflate_level or DEFLATE_LEVEL)]
+
+        options = ["TILED=YES",
+                   "COMPRESS=DEFLATE",
+                   "ZLEVEL={}".format(deflate_level or DEFLATE_LEVEL),
+                   # horizontal differencing, floating point prediction for floats
+                   "PREDICTOR={}".format(3 if gdal_type in (gdal.GDT_Float32, gdal.GDT_Float64) else 2),
+                   "BIGTIFF=IF_SAFER"]
+        if threads:
+            options.append("NUM_THREADS={}".format(threads))
+        return options
+
+    def check_dataset(self, dataset):
+        """
+        ValueError if the driver can't write the dataset's data type or band count
+        """
+        gdal_type = dataset.GetRasterBand(1).DataType
+        if self.gdal_types is not None and gdal_type not in self.gdal_types:
+            raise ValueError("{0} can't be written as {1}".format(gdal.GetDataTypeName(gdal_type), self.name))
+        if self.band_counts is not None and dataset.RasterCount not in self.band_counts:
+            raise ValueError("{0} bands can't be written as {1}".format(dataset.RasterCount, self.name))
+
+
+def encode_dataset(dataset,
+                   file_type: FileType,
+                   quality: int=None,
+                   deflate_level: int=None,
+                   threads=None) -> bytes:
+    """
+    Write a dataset to a file in /vsimem and return the file's bytes. Sidecar files the driver writes (.aux.xml for
+    the georeferencing of a PNG or JPEG) are dropped.
+    """
+    file_type.check_dataset(dataset)
+    directory = "/vsimem/{}".format(uuid.uuid4())
+    file_path = "{0}/image{1}".format(directory, file_type.suffix)
+    try:
+        options = file_type.get_creation_options(dataset.GetRasterBand(1).DataType, quality, deflate_level, threads)
+        written = gdal.GetDriverByName(file_type.driver_name).CreateCopy(file_path, dataset, options=options)
+        if written is None:
+            raise ValueError("{0} failed: {1}".format(file_type.driver_name, gdal.GetLastErrorMsg()))
+        # flushes and closes the file
+        del written
+
+        handle = gdal.VSIFOpenL(file_path, 'rb')
+        try:
+            gdal.VSIFSeekL(handle, 0, os.SEEK_END)
+            size = gdal.VSIFTellL(handle)
+            gdal.VSIFSeekL(handle, 0, os.SEEK_SET)
+            return gdal.VSIFReadL(1, size, handle)
+        finally:
+            gdal.VSIFCloseL(handle)
+    finally:
+        for file_name in gdal.ReadDir(directory) or []:
+            gdal.Unlink("{0}/{1}".format(directory, file_name))
+
+
+def downsample_dataset(dataset, factor: float):
+    """
+    Average a dataset down by factor in each dimension into a MEM dataset. At least 1 pixel is kept
+    """
+    return gdal.Translate("",
+                          dataset,
+                          format="MEM",
+                          width=max(1, int(round(dataset.RasterXSize / factor))),
+                          height=max(1, int(round(dataset.RasterYSize / factor))),
+                          resampleAlg="average")
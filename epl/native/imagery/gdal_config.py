@@ -0,0 +1,132 @@
+"""
+   Copyright 2017-2018 Echo Park Labs
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   For additional information, contact:
+
+   email: info@echoparklabs.io
+"""
+
+import threading
+
+from enum import Enum
+from osgeo import gdal
+
+
+class IOProfile(Enum):
+    """
+    Named GDAL tuning for the different places the imagery is read from.
+    (block cache MB, warp memory MB, GDAL_NUM_THREADS, VSI read cache MB, skip directory listing on open)
+
+    FUSE is for gcsfuse/s3fs mounted buckets where every directory listing and small read is a network round trip.
+    LOCAL_SSD is for imagery copied onto local disk, where decompression is the bottleneck.
+    BULK_EXPORT is for long running exports that read the whole scene and can use a lot of memory.
+    """
+    DEFAULT     = (None, None, None,        None, False)
+    FUSE        = (512,  256,  "2",         64,   True)
+    LOCAL_SSD   = (256,  512,  "ALL_CPUS",  None, False)
+    BULK_EXPORT = (1024, 1024, "ALL_CPUS",  256,  True)
+
+    def __init__(self, cache_max_mb, warp_memory_mb, num_threads, vsi_cache_mb, b_disable_readdir):
+        self.cache_max_mb = cache_max_mb
+        self.warp_memory_mb = warp_memory_mb
+        self.num_threads = num_threads
+        self.vsi_cache_mb = vsi_cache_mb
+        self.b_disable_readdir = b_disable_readdir
+
+    @property
+    def config_options(self) -> dict:
+        options = {}
+        if self.num_threads:
+            options['GDAL_NUM_THREADS'] = self.num_threads
+        if self.vsi_cache_mb:
+            options['VSI_CACHE'] = "TRUE"
+            options['VSI_CACHE_SIZE'] = str(self.vsi_cache_mb * 1024 * 1024)
+        if self.b_disable_readdir:
+            options['GDAL_DISABLE_READDIR_ON_OPEN'] = "EMPTY_DIR"
+        return options
+
+
+class GDALConfig:
+    """
+    Context manager that sets GDAL config options for the calling thread only, so concurrent requests can be tuned
+    differently (and python pixel functions enabled) without changing the process wide configuration.
+
+    with GDALConfig(IOProfile.FUSE, GDAL_HTTP_TIMEOUT=30):
+        nda = landsat.fetch_imagery_array(...)
+
+    The GDAL block cache is shared by the whole process. A profile's block cache size is applied as a minimum: it
+    will grow the cache but never shrink it out from under another thread.
+
+    The values an entered config replaces are saved on a thread local stack, not on the instance, so one instance
+    can be shared between threads (each calling thread runs its own with block, like the block readers do) and
+    entered again inside itself.
+    """
+    __local = threading.local()
+    __cache_lock = threading.Lock()
+
+    def __init__(self, profile: IOProfile=IOProfile.DEFAULT, **config_options):
+        self.profile = profile
+        self.config_options = profile.config_options
+        self.config_options.update({key: str(value) for key, value in config_options.items()})
+
+    def __enter__(self):
+        previous = {key: gdal.GetThreadLocalConfigOption(key, None) for key in self.config_options}
+        for key, value in self.config_options.items():
+            gdal.SetThreadLocalConfigOption(key, value)
+
+        if self.profile.cache_max_mb:
+            cache_max = self.profile.cache_max_mb * 1024 * 1024
+            with GDALConfig.__cache_lock:
+                if gdal.GetCacheMax() < cache_max:
+                    gdal.SetCacheMax(cache_max)
+
+        GDALConfig.__stack().append((self, previous))
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        config, previous = GDALConfig.__stack().pop()
+        if config is not self:
+            raise RuntimeError("GDALConfig contexts have to be exited in the reverse order they were entered")
+        for key, value in previous.items():
+            # None unsets the thread local value, falling back to the process wide one
+            gdal.SetThreadLocalConfigOption(key, value)
+        return False
+
+    @staticmethod
+    def __stack() -> list:
+        """
+        (config, the thread local values it replaced) of the configs entered on this thread, innermost last
+        """
+        if not hasattr(GDALConfig.__local, 'stack'):
+            GDALConfig.__local.stack = []
+        return GDALConfig.__local.stack
+
+    @staticmethod
+    def current():
+        """
+        :return: the innermost GDALConfig active on this thread, or None
+        """
+        stack = GDALConfig.__stack()
+        return stack[-1][0] if stack else None
+
+    @staticmethod
+    def warp_memory_limit():
+        """
+        :return: warp memory limit in bytes of the innermost profile on this thread that sets one, or None
+        """
+        for config, _ in reversed(GDALConfig.__stack()):
+            if config.profile.warp_memory_mb:
+                return config.profile.warp_memory_mb * 1024 * 1024
+        return None
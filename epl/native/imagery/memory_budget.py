@@ -0,0 +1,166 @@
+"""
+   Copyright 2017-2018 Echo Park Labs
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   For additional information, contact:
+
+   email: info@echoparklabs.io
+"""
+
+import math
+import threading
+
+from enum import Enum
+from contextlib import contextmanager
+
+
+class BudgetAction(Enum):
+    """
+    What fetch_imagery_array does with a request whose estimate is over its MemoryBudget's request_bytes.
+    REJECT raises MemoryBudgetExceeded.
+    TILE assembles the result from blocks, so only the result and a block's intermediates are held at once. A request
+    whose result alone doesn't fit is rejected.
+    DOWNSAMPLE coarsens spatial_resolution_m until the whole request fits.
+    """
+    REJECT = 0
+    TILE = 1
+    DOWNSAMPLE = 2
+
+
+class MemoryBudgetExceeded(MemoryError):
+    def __init__(self, message, plan=None):
+        super().__init__(message)
+        self.plan = plan
+
+
+class MemoryPlan:
+    """
+    Estimate of the memory a request needs, calculated from the RasterMetadata of its scenes before any pixels are
+    read.
+    output_bytes: the result ndarray
+    source_bytes: the source band pixels covering the request, at native resolution
+    intermediate_bytes: the datasets built on the way to the result (translated scenes, the warped mosaic, band math
+    sources)
+    """
+    def __init__(self,
+                 x_size: int,
+                 y_size: int,
+                 band_count: int,
+                 output_bytes: int,
+                 source_bytes: int,
+                 intermediate_bytes: int,
+                 spatial_resolution_m):
+        self.x_size = x_size
+        self.y_size = y_size
+        self.band_count = band_count
+        self.output_bytes = output_bytes
+        self.source_bytes = source_bytes
+        self.intermediate_bytes = intermediate_bytes
+        self.spatial_resolution_m = spatial_resolution_m
+
+    @property
+    def total_bytes(self) -> int:
+        """
+        bytes held at the peak: the result plus the intermediate datasets. source pixels are streamed through GDAL's
+        block cache and aren't counted
+        """
+        return self.output_bytes + self.intermediate_bytes
+
+    def tiled_bytes(self, block_size: int) -> int:
+        """
+        peak bytes when the result is assembled from block_size blocks: the result plus the intermediates of two
+        blocks (the one being copied and the one being prefetched)
+        """
+        pixel_count = max(self.x_size * self.y_size, 1)
+        block_count = min(block_size * block_size, pixel_count)
+        return self.output_bytes + 2 * int(math.ceil(self.intermediate_bytes * float(block_count) / pixel_count))
+
+    def __repr__(self):
+        return "MemoryPlan({0}x{1}x{2} at {3}m, output {4} bytes, source {5} bytes, intermediate {6} bytes)".format(
+            self.x_size, self.y_size, self.band_count, self.spatial_resolution_m,
+            self.output_bytes, self.source_bytes, self.intermediate_bytes)
+
+
+class MemoryBudget:
+    """
+    Limits on the memory a request may use, checked against its MemoryPlan before any I/O.
+
+    request_bytes limits a single request, and action decides what happens to a request over it.
+    MemoryBudget.process_bytes limits the estimated total of every request in flight in the process, whatever
+    budget they were made with. A request that would go over it is rejected. None means no limit.
+    """
+    process_bytes = None
+
+    __in_flight = 0
+    __in_flight_lock = threading.Lock()
+
+    def __init__(self, request_bytes: int=None, action: BudgetAction=BudgetAction.REJECT, block_size=512):
+        """
+        :param request_bytes: bytes a single request may use, None for no limit
+        :param action: BudgetAction for requests over request_bytes
+        :param block_size: the largest block size BudgetAction.TILE starts from
+        """
+        self.request_bytes = request_bytes
+        self.action = action
+        self.block_size = block_size
+
+    @property
+    def b_limited(self) -> bool:
+        return self.request_bytes is not None or MemoryBudget.process_bytes is not None
+
+    def fits(self, nbytes: int) -> bool:
+        return self.request_bytes is None or nbytes <= self.request_bytes
+
+    def get_block_size(self, plan: MemoryPlan):
+        """
+        :return: the largest power of two block size, up to block_size, whose tiled peak fits the request budget.
+        None if not even the result alone fits
+        """
+        block_size = self.block_size
+        while block_size >= 64:
+            if self.fits(plan.tiled_bytes(block_size)):
+                return block_size
+            block_size //= 2
+        return None
+
+    def get_downsample_factor(self, plan: MemoryPlan) -> float:
+        """
+        :return: the factor to multiply spatial_resolution_m by so that the plan fits (every term of it scales with
+        the pixel count, so with the square of the resolution)
+        """
+        if self.request_bytes is None or plan.total_bytes <= self.request_bytes:
+            return 1.0
+        return math.sqrt(float(plan.total_bytes) / self.request_bytes)
+
+    @classmethod
+    def in_flight_bytes(cls) -> int:
+        with cls.__in_flight_lock:
+            return cls.__in_flight
+
+    @classmethod
+    @contextmanager
+    def reserve(cls, nbytes: int, plan: MemoryPlan=None):
+        """
+        Context manager that counts nbytes against the process budget for the length of a request
+        """
+        with cls.__in_flight_lock:
+            if cls.process_bytes is not None and cls.__in_flight + nbytes > cls.process_bytes:
+                raise MemoryBudgetExceeded("request needs {0} bytes, {1} of the process budget of {2} are in "
+                                           "use".format(nbytes, cls.__in_flight, cls.process_bytes), plan)
+            cls.__in_flight += nbytes
+        try:
+            yield
+        finally:
+            with cls.__in_flight_lock:
+                cls.__in_flight -= nbytes
@@ -683,6 +683,12 @@ class BandMap:
                                                         'description': '15 meter resolution, sharper image definition',
                                                         'resolution_m': 15}
 
+    # MSS has no band named NIR, but INFRARED2 (0.8-1.1) covers it, so indices written with NIR work on MSS scenes
+    __equivalents = {
+        SpacecraftID.LANDSAT_123_MSS: {Band.NIR: Band.INFRARED2},
+        SpacecraftID.LANDSAT_45_MSS: {Band.NIR: Band.INFRARED2},
+    }
+
     __enum_map = {}
     for spacecrafID in __map:
         for band_key in __map[spacecrafID]:
@@ -711,11 +717,16 @@ class BandMap:
     def get_band_enum(self, band_number):
         return self.__enum_map[self.__spacecraft_id][band_number]
 
+    def __get_band(self, band_enum: Band):
+        if band_enum not in self.__map[self.__spacecraft_id] and self.__spacecraft_id in self.__equivalents:
+            band_enum = self.__equivalents[self.__spacecraft_id].get(band_enum, band_enum)
+        return self.__map[self.__spacecraft_id][band_enum]
+
     def get_number(self, band_enum: Band):
-        return self.__map[self.__spacecraft_id][band_enum]['number']
+        return self.__get_band(band_enum)['number']
 
     def get_resolution(self, band_enum: Band):
-        return self.__map[self.__spacecraft_id][band_enum]['resolution_m']
+        return self.__get_band(band_enum)['resolution_m']
 
     def get_details(self):
         return self.__map[self.__spacecraft_id]
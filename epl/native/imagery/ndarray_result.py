@@ -0,0 +1,302 @@
+"""
+   Copyright 2017-2018 Echo Park Labs
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   For additional information, contact:
+
+   email: info@echoparklabs.io
+"""
+
+import os
+import zlib
+import numpy as np
+
+from enum import Enum
+from multiprocessing import shared_memory, resource_tracker
+
+from epl.grpc.imagery import epl_imagery_pb2
+
+# zstd and lz4 are optional, deflate is always available from zlib
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+class Compression(Enum):
+    """
+    Compression of NDArrayResult.data_buffer. The levels favour speed, imagery is compressed per request on the
+    serving path.
+    (grpc enum, level)
+    """
+    NONE    = (epl_imagery_pb2.NO_COMPRESSION, None)
+    ZSTD    = (epl_imagery_pb2.ZSTD, 3)
+    LZ4     = (epl_imagery_pb2.LZ4, 0)
+    DEFLATE = (epl_imagery_pb2.DEFLATE, 1)
+
+    def __init__(self, grpc_num, level):
+        self.grpc_num = grpc_num
+        self.level = level
+
+    @property
+    def b_available(self) -> bool:
+        if self is Compression.ZSTD:
+            return zstandard is not None
+        elif self is Compression.LZ4:
+            return lz4 is not None
+        return True
+
+    @staticmethod
+    def from_grpc(grpc_num):
+        for compression in Compression:
+            if compression.grpc_num == grpc_num:
+                return compression
+        raise ValueError("unknown compression {}".format(grpc_num))
+
+    def compress(self, data: bytes) -> bytes:
+        if self is Compression.ZSTD:
+            return zstandard.ZstdCompressor(level=self.level).compress(data)
+        elif self is Compression.LZ4:
+            return lz4.frame.compress(data, compression_level=self.level)
+        elif self is Compression.DEFLATE:
+            return zlib.compress(data, self.level)
+        return data
+
+    def decompress(self, data: bytes, size: int) -> bytes:
+        if self is Compression.ZSTD:
+            return zstandard.ZstdDecompressor().decompress(data, max_output_size=size)
+        elif self is Compression.LZ4:
+            return lz4.frame.decompress(data)
+        elif self is Compression.DEFLATE:
+            return zlib.decompress(data, bufsize=max(size, 1))
+        return data
+
+
+# GDALDataType of each numpy type, and the legacy repeated field it is sent in
+_types = {
+    np.dtype(np.uint8): (epl_imagery_pb2.BYTE, 'data_uint32'),
+    np.dtype(np.uint16): (epl_imagery_pb2.UINT16, 'data_uint32'),
+    np.dtype(np.int16): (epl_imagery_pb2.INT16, 'data_int32'),
+    np.dtype(np.uint32): (epl_imagery_pb2.UINT32, 'data_uint32'),
+    np.dtype(np.int32): (epl_imagery_pb2.INT32, 'data_int32'),
+    np.dtype(np.float32): (epl_imagery_pb2.FLOAT32, 'data_float'),
+    np.dtype(np.float64): (epl_imagery_pb2.FLOAT64, 'data_double'),
+}
+_grpc_types = {grpc_num: dtype for dtype, (grpc_num, _) in _types.items()}
+_fields = {dtype: field for dtype, (_, field) in _types.items()}
+_grpc_nums = {dtype: grpc_num for dtype, (grpc_num, _) in _types.items()}
+
+
+def negotiate_compression(accepted_compression) -> Compression:
+    """
+    :param accepted_compression: grpc Compression values from ImageryRequest.accepted_compression, in the client's
+    order of preference
+    :return: the first one available here, Compression.NONE if there are none
+    """
+    for grpc_num in accepted_compression:
+        try:
+            compression = Compression.from_grpc(grpc_num)
+        except ValueError:
+            continue
+        if compression.b_available:
+            return compression
+    return Compression.NONE
+
+
+def to_ndarray_result(nda: np.ndarray,
+                      b_raw_buffer: bool=True,
+                      compression: Compression=Compression.NONE) -> epl_imagery_pb2.NDArrayResult:
+    """
+    Build an NDArrayResult from an ndarray.
+    :param b_raw_buffer: send the pixels as a single little endian buffer of the array's memory. C or Fortran
+    ordered arrays are sent as they are, anything else is copied to C order first. False fills the legacy repeated
+    fields, for clients that don't ask for raw_buffer
+    :param compression: compression of the raw buffer
+    """
+    dtype = np.dtype(nda.dtype)
+    if dtype.newbyteorder('=') not in _grpc_nums:
+        raise ValueError("{} can't be sent in an NDArrayResult".format(dtype))
+    dtype = dtype.newbyteorder('<')
+
+    result = epl_imagery_pb2.NDArrayResult()
+    result.dtype = _grpc_nums[dtype.newbyteorder('=')]
+    result.shape.extend(nda.shape)
+
+    if not b_raw_buffer:
+        getattr(result, _fields[dtype.newbyteorder('=')]).extend(nda.ravel().tolist())
+        return result
+
+    if not (nda.flags['C_CONTIGUOUS'] or nda.flags['F_CONTIGUOUS']):
+        nda = np.ascontiguousarray(nda)
+    # a no op on little endian machines
+    nda = nda.astype(dtype, copy=False)
+
+    # tobytes copies in the array's own order when asked for 'A', so the strides are unchanged
+    data = nda.tobytes(order='A')
+    result.strides.extend(nda.strides)
+    result.buffer_size = len(data)
+    result.compression = compression.grpc_num
+    result.data_buffer = compression.compress(data)
+    return result
+
+
+def from_ndarray_result(result: epl_imagery_pb2.NDArrayResult) -> np.ndarray:
+    """
+    Read the ndarray from an NDArrayResult. A raw buffer is wrapped (once decompressed) without a copy, so the result
+    is read only
+    """
+    if result.dtype not in _grpc_types:
+        raise ValueError("unknown NDArrayResult dtype {}".format(result.dtype))
+    dtype = _grpc_types[result.dtype]
+    shape = tuple(result.shape)
+
+    if result.HasField("shared_memory"):
+        with SharedMemoryArray(result) as nda:
+            return nda.copy()
+
+    if not result.data_buffer:
+        # legacy repeated fields, or an empty array
+        return np.array(getattr(result, _fields[dtype]), dtype=dtype).reshape(shape)
+
+    compression = Compression.from_grpc(result.compression)
+    if not compression.b_available:
+        raise ValueError("{} isn't installed, the result can't be decompressed".format(compression.name))
+    data = compression.decompress(result.data_buffer, result.buffer_size)
+
+    return np.ndarray(shape,
+                      dtype=dtype.newbyteorder('<'),
+                      buffer=data,
+                      strides=tuple(result.strides) or None).astype(dtype, copy=False)
+
+
+def to_shared_memory_result(nda: np.ndarray, leases=None) -> epl_imagery_pb2.NDArrayResult:
+    """
+    Copy an ndarray into a new shared memory segment and build an NDArrayResult with its handle instead of the
+    pixels. The client unlinks the segment as it maps it with SharedMemoryArray. One that's never claimed is unlinked
+    by leases if there are any, otherwise by this process's resource tracker when this process exits. POSIX only,
+    elsewhere a segment is gone once this process closes it.
+    :param leases: takes over unlinking unclaimed segments, anything with add(name) like the server's
+    SharedMemoryLeases. The segment is taken off the resource tracker, so it outlives this process
+    """
+    if os.name != "posix":
+        raise ValueError("shared memory results need POSIX shared memory")
+    dtype = np.dtype(nda.dtype).newbyteorder('=')
+    if dtype not in _grpc_nums:
+        raise ValueError("{} can't be sent in an NDArrayResult".format(dtype))
+
+    # segments can't be empty
+    segment = shared_memory.SharedMemory(create=True, size=max(nda.nbytes, 1))
+    try:
+        view = np.ndarray(nda.shape, dtype=dtype, buffer=segment.buf)
+        view[...] = nda
+        del view
+    except Exception:
+        segment.close()
+        segment.unlink()
+        raise
+    segment.close()
+    if leases is not None:
+        # the resource tracker knows POSIX segments by their name with the leading slash, which name leaves off
+        tracked_name = segment.name if segment.name.startswith("/") else "/" + segment.name
+        resource_tracker.unregister(tracked_name, "shared_memory")
+        leases.add(segment.name)
+
+    result = epl_imagery_pb2.NDArrayResult()
+    result.dtype = _grpc_nums[dtype]
+    result.shape.extend(nda.shape)
+    # C order in native byte order, the client is on the same host
+    result.shared_memory.name = segment.name
+    result.shared_memory.size = nda.nbytes
+    return result
+
+
+class SharedMemoryArray:
+    """
+    The array of a shared memory NDArrayResult, mapped without a copy. The segment is unlinked as soon as it's
+    mapped, so it's freed once closed and no other client can claim it. The array is only valid until close.
+
+    with SharedMemoryArray(stub.ImagerySearchNArray(request)) as nda:
+        ...
+    """
+    def __init__(self, result: epl_imagery_pb2.NDArrayResult):
+        if not result.HasField("shared_memory"):
+            raise ValueError("the NDArrayResult isn't in shared memory")
+        if result.dtype not in _grpc_types:
+            raise ValueError("unknown NDArrayResult dtype {}".format(result.dtype))
+
+        # FileNotFoundError if the server isn't on this host, or the segment was already claimed
+        self.__segment = shared_memory.SharedMemory(name=result.shared_memory.name)
+        # the mapping outlives the name. unlink also takes it back off the resource tracker
+        self.__segment.unlink()
+        self.array = np.ndarray(tuple(result.shape),
+                                dtype=_grpc_types[result.dtype],
+                                buffer=self.__segment.buf,
+                                strides=tuple(result.strides) or None)
+
+    def close(self):
+        if self.__segment is None:
+            return
+        self.array = None
+        self.__segment.close()
+        self.__segment = None
+
+    def __enter__(self) -> np.ndarray:
+        return self.array
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def to_ndarray_chunk(shape: tuple,
+                     offset: list,
+                     nda: np.ndarray,
+                     b_raw_buffer: bool=True,
+                     compression: Compression=Compression.NONE) -> epl_imagery_pb2.NDArrayChunk:
+    """
+    Build an NDArrayChunk of a streamed array
+    :param shape: shape of the whole array
+    :param offset: index of the chunk's first element along each axis of the whole array
+    :param nda: the chunk's pixels
+    """
+    chunk = epl_imagery_pb2.NDArrayChunk()
+    chunk.shape.extend(shape)
+    chunk.offset.extend(offset)
+    chunk.data.CopyFrom(to_ndarray_result(nda, b_raw_buffer=b_raw_buffer, compression=compression))
+    chunk.dtype = chunk.data.dtype
+    return chunk
+
+
+def assemble_ndarray_chunks(chunks, out: np.ndarray=None) -> np.ndarray:
+    """
+    Assemble a stream of NDArrayChunk messages, such as an ImagerySearchNArrayStream response, into one array. Each
+    chunk is decoded and copied into place as it arrives, so only one chunk's message is held at a time.
+    :param chunks: iterable of NDArrayChunk
+    :param out: preallocated array to assemble into, with the shape of the whole array. Allocated from the first
+    chunk if None
+    :return: out, None if there were no chunks
+    """
+    for chunk in chunks:
+        if out is None:
+            out = np.empty(tuple(chunk.shape), dtype=_grpc_types[chunk.dtype])
+        elif out.shape != tuple(chunk.shape):
+            raise ValueError("out has shape {0}, the streamed array is {1}".format(out.shape, tuple(chunk.shape)))
+
+        nda = from_ndarray_result(chunk.data)
+        out[tuple(slice(start, start + size) for start, size in zip(chunk.offset, nda.shape))] = nda
+    return out
@@ -0,0 +1,198 @@
+"""
+   Copyright 2017-2018 Echo Park Labs
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   For additional information, contact:
+
+   email: info@echoparklabs.io
+"""
+
+import os
+import sys
+import hashlib
+import threading
+import multiprocessing
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor, wait
+from multiprocessing import resource_tracker, shared_memory
+
+# compiled band functions in a worker process, by (name, sha256 of code)
+_worker_functions = {}
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    try:
+        # python 3.13+, the creating process owns the segment and unlinks it
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        # before 3.13 attaching registers the segment with the resource tracker as though this worker had made it,
+        # and the tracker unlinks what's registered when it cleans up after the worker
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+def _get_function(name: str, code: str, code_hash: str):
+    key = (name, code_hash)
+    if key not in _worker_functions:
+        namespace = {}
+        exec(compile(code, "<{}>".format(name), 'exec'), namespace)
+        _worker_functions[key] = namespace[name]
+    return _worker_functions[key]
+
+
+def _run_block(name: str, code: str, code_hash: str, arguments: dict,
+               source_spec: tuple, source_indices: list, out_spec: tuple, start: int, stop: int, geo_transform):
+    """
+    Runs in a worker process. Attaches to the shared source and output arrays and calls the band function on rows
+    start to stop of the sources at source_indices, with the same arguments a VRT python pixel function gets.
+    """
+    source_shm = _attach(source_spec[0])
+    out_shm = _attach(out_spec[0])
+    try:
+        sources = np.ndarray(source_spec[1], dtype=source_spec[2], buffer=source_shm.buf)
+        out = np.ndarray(out_spec[1], dtype=out_spec[2], buffer=out_shm.buf)
+        raster_ysize, raster_xsize = out.shape
+
+        function = _get_function(name, code, code_hash)
+        function([sources[index][start:stop] for index in source_indices], out[start:stop],
+                 0, start, raster_xsize, stop - start, raster_xsize, raster_ysize, 0, geo_transform,
+                 **(arguments or {}))
+    finally:
+        # views have to be gone before the buffers close
+        sources = None
+        out = None
+        source_shm.close()
+        out_shm.close()
+
+
+class SharedArrayLease:
+    """
+    An ndarray in a shared memory segment that BandFunctionPool workers attach to by name. array, and any view of
+    it, is only valid while the lease is open: views have to be dropped before it's closed, which unlinks the
+    segment.
+
+        with SharedArrayLease((2, 512, 512), np.float32) as sources:
+            dataset.ReadAsArray(buf_obj=sources.array)
+    """
+    def __init__(self, shape: tuple, dtype):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.__shm = shared_memory.SharedMemory(create=True,
+                                                size=max(int(np.prod(self.shape)) * self.dtype.itemsize, 1))
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.__shm.buf)
+
+    @property
+    def spec(self) -> tuple:
+        """
+        (segment name, shape, dtype) for attaching to the segment in a worker
+        """
+        return self.__shm.name, self.shape, self.dtype.str
+
+    def close(self):
+        if self.__shm is None:
+            return
+        self.array = None
+        try:
+            self.__shm.close()
+        except BufferError:
+            # a view outlived the lease (on an error), the mapping is released along with it
+            pass
+        if sys.version_info < (3, 13):
+            # spawned workers share this process's resource tracker, and _attach unregistered the segment from it.
+            # Registering is idempotent, unlink unregisters it again
+            resource_tracker.register(self.__shm._name, "shared_memory")
+        self.__shm.unlink()
+        self.__shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class BandFunctionPool:
+    """
+    Runs python band functions (FunctionDetails code with process_pool=True) in worker processes, so heavy per pixel
+    work like classification spreads across every core instead of running one block at a time on the GIL inside
+    GDAL. The source bands and the output live in SharedArrayLease segments, workers get their names and a range of
+    rows, so no pixel data is pickled, and the sources are read into the segment and the output written from it
+    without any copies in between.
+
+    Workers are started with spawn, forking a process that has GDAL threads running isn't safe.
+    """
+    max_workers = os.cpu_count() or 1
+
+    __executor = None
+    __executor_lock = threading.Lock()
+
+    @classmethod
+    def get_executor(cls) -> ProcessPoolExecutor:
+        with cls.__executor_lock:
+            if cls.__executor is None:
+                cls.__executor = ProcessPoolExecutor(max_workers=cls.max_workers,
+                                                     mp_context=multiprocessing.get_context('spawn'))
+            return cls.__executor
+
+    @classmethod
+    def shutdown(cls):
+        with cls.__executor_lock:
+            if cls.__executor is not None:
+                cls.__executor.shutdown()
+                cls.__executor = None
+
+    @classmethod
+    def evaluate(cls,
+                 name: str,
+                 code: str,
+                 sources: SharedArrayLease,
+                 out: SharedArrayLease,
+                 source_indices: list=None,
+                 arguments: dict=None,
+                 geo_transform=None,
+                 block_rows=256,
+                 code_hash: str=None) -> np.ndarray:
+        """
+        Evaluate a band function into out.
+        :param name: name of the function defined in code
+        :param code: python code defining name(in_ar, out_ar, xoff, yoff, xsize, ysize, raster_xsize, raster_ysize,
+        buf_radius, gt, **kwargs)
+        :param sources: (band, y, x) source bands, each the shape of out
+        :param out: 2d array to write to
+        :param source_indices: the bands of sources that are the function's in_ar, in order. All of them if None
+        :param arguments: keyword arguments for the function
+        :param geo_transform: passed to the function as gt
+        :param block_rows: number of rows each worker task evaluates
+        :param code_hash: sha256 hex digest of code, FunctionDetails.code_hash. Computed if None
+        :return: out.array, valid as long as the out lease is
+        """
+        if tuple(sources.shape[1:]) != tuple(out.shape) or len(out.shape) != 2:
+            raise ValueError("sources of shape {0} don't match out of shape {1}".format(sources.shape, out.shape))
+        if source_indices is None:
+            source_indices = list(range(sources.shape[0]))
+
+        if code_hash is None:
+            code_hash = hashlib.sha256(code.encode()).hexdigest()
+        futures = [cls.get_executor().submit(_run_block, name, code, code_hash, arguments,
+                                             sources.spec, source_indices, out.spec,
+                                             start, min(start + block_rows, out.shape[0]), geo_transform)
+                   for start in range(0, out.shape[0], block_rows)]
+        # every block is done before any error is raised, so none is still using the leases when they're closed
+        wait(futures)
+        for future in futures:
+            future.result()
+
+        return out.array
@@ -21,7 +21,7 @@
 import os
 import sys
 import errno
-import tempfile
+import hashlib
 import py_compile
 
 import shapefile
@@ -38,6 +38,10 @@ import pyproj
 import copy
 import glob
 import re
+import uuid
+import queue
+import tempfile
+import threading
 import numpy as np
 
 from pyqtree import Index
@@ -46,11 +50,13 @@ from typing import Generator
 from operator import itemgetter
 from datetime import date
 from datetime import datetime
-from osgeo import osr, ogr, gdal
+from osgeo import osr, ogr, gdal, gdal_array
 from urllib.parse import urlparse
 from lxml import etree
 from enum import Enum
 from subprocess import call
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from typing import List, Tuple
 from peewee import Field
@@ -60,6 +66,15 @@ from google.cloud import exceptions
 
 from epl.grpc.imagery import epl_imagery_pb2
 from epl.native.imagery import PLATFORM_PROVIDER
+from epl.native.imagery.gdal_config import GDALConfig, IOProfile
+from epl.native.imagery.band_math import BandExpression, SpectralIndex, get_band_name
+from epl.native.imagery.process_pool import BandFunctionPool, SharedArrayLease
+from epl.native.imagery.rescale import get_lut_scale_params, get_scale_lut, apply_lut
+from epl.native.imagery.statistics import BandStatistics
+from epl.native.imagery.memory_budget import BudgetAction, MemoryBudget, MemoryBudgetExceeded, MemoryPlan
+from epl.native.imagery.ndarray_result import Compression, to_ndarray_chunk
+from epl.native.imagery.disk_cache import DiskCache
+from epl.native.imagery.file_encoding import FileType, encode_dataset, downsample_dataset
 from epl.native.imagery.metadata_helpers import SpacecraftID, Band, BandMap, MetadataFilters, LandsatQueryFilters
 
 
@@ -147,15 +162,39 @@ https://docs.scipy.org/doc/numpy-1.13.0/user/basics.types.html
         return self.__numpy_type
 
 
+class CutlineMode(Enum):
+    """
+    How a polygon_boundary_wkb is applied to a request. WARP runs the translated datasets through gdal.Warp with a
+    cutline. RASTER_MASK rasterizes the polygon once onto the output grid and zeroes the pixels outside of it in numpy
+    (only used for single scene requests, mosaics still need the warp).
+    """
+    WARP = 0
+    RASTER_MASK = 1
+
+
 class FileTypeMap:
     @staticmethod
     def get_suffix(file_type):
-        return ".jpg"
+        """
+        :param file_type: FileType or grpc ImageryFileType
+        """
+        if not isinstance(file_type, FileType):
+            file_type = FileType.from_grpc(file_type)
+        return file_type.suffix
 
 
 class FunctionDetails:
     """
-    Make a pixel function
+    Make a pixel function. Either python code that runs as a VRT pixel function, or a band math expression over the
+    band_definitions that is evaluated with numpy after the bands are read, e.g.
+    FunctionDetails(name="ndvi", band_definitions=[Band.RED, Band.NIR], data_type=DataType.FLOAT32,
+                    expression="(NIR - RED) / (NIR + RED)")
+    Band enums are referred to by name in an expression, band numbers as B<number> (B4, B5).
+
+    The built in SpectralIndex indices are made with FunctionDetails.from_spectral_index("ndvi").
+
+    Python code with process_pool=True isn't run by GDAL: the sources are read first and the function is called on
+    row blocks in BandFunctionPool worker processes, for functions heavy enough to be worth spreading across cores.
     """
     name = None
     band_definitions = None
@@ -163,27 +202,53 @@ class FunctionDetails:
     code = None
     arguments = None
     transfer_type = None
+    expression = None
+    band_expression = None
+    code_hash = None
+    process_pool = False
+
+    # the same few functions are sent over and over, so code that compiled and parsed expressions are kept by content
+    compile_cache_size = 256
+    __compiled = OrderedDict()
+    __compiled_lock = threading.Lock()
 
     def __init__(self,
                  name: str,
-                 band_definitions: list,
-                 data_type: DataType,
+                 band_definitions: list=None,
+                 data_type: DataType=None,
                  code: str=None,
                  arguments: dict=None,
-                 transfer_type: DataType=None):
+                 transfer_type: DataType=None,
+                 expression: str=None,
+                 process_pool: bool=False):
+        if code and expression:
+            raise ValueError("a FunctionDetails has either code or an expression, not both")
+        if process_pool and not code:
+            raise ValueError("only FunctionDetails with python code run in the process pool")
+
+        if band_definitions is None or data_type is None:
+            raise ValueError("FunctionDetails {} needs band_definitions and a data_type".format(name))
+
         self.name = name
         self.band_definitions = band_definitions
         self.data_type = data_type
 
+        if expression:
+            # arguments are the named constants of an expression
+            constants = dict(arguments or {})
+            band_names = tuple(get_band_name(band) for band in band_definitions)
+            constants_key = tuple(sorted(constants.items()))
+            self.band_expression = self.__get_compiled(
+                ('expression', expression, band_names, constants_key),
+                lambda: BandExpression(expression, list(band_names), constants))
+            self.expression = expression
+
         if code:
-            # TODO, still ugly that I have to use a temporary file: Also, stupid that I can't catch GDAL errors
-            function_file = tempfile.NamedTemporaryFile(prefix=self.name, suffix=".py", delete=True)
-            function_file.write(code.encode())
-            function_file.flush()
-
-            py_compile.compile(function_file.name, doraise=True)
-            # delete file after compiling
-            function_file.close()
+            # TODO, stupid that I can't catch GDAL errors
+            # only compiled to check it here, GDAL and the BandFunctionPool workers compile it themselves. The workers
+            # keep it by the same (name, code_hash)
+            self.code_hash = hashlib.sha256(code.encode()).hexdigest()
+            self.__get_compiled(('code', name, self.code_hash), lambda: self.__compile_code(code))
             self.code = code
 
         # TODO arguments should maybe have some kind of setter
@@ -191,6 +256,68 @@ class FunctionDetails:
             self.arguments = {k: str(v) for k, v in arguments.items()}
 
         self.transfer_type = transfer_type
+        self.process_pool = process_pool
+
+    @classmethod
+    def from_spectral_index(cls,
+                            index,
+                            band_map: BandMap=None,
+                            data_type: DataType=DataType.FLOAT32,
+                            arguments: dict=None):
+        """
+        A band math FunctionDetails of a built in spectral index
+        :param index: a SpectralIndex or its name, case insensitive
+        :param band_map: BandMap of the scenes it's read from. The index's bands become its band numbers, and a band
+        the spacecraft doesn't have raises here instead of when the scenes are read. Without one the bands stay Band
+        enums, resolved by each scene's BandMap
+        :param arguments: values for the index's constants, e.g. {'dn_per_reflectance': 255}
+        """
+        spectral_index = index if isinstance(index, SpectralIndex) else SpectralIndex.from_name(index)
+        if spectral_index is None:
+            raise ValueError("{} isn't a spectral index".format(index))
+
+        expression, band_definitions = spectral_index.resolve(band_map)
+        constants = dict(spectral_index.constants)
+        constants.update(arguments or {})
+        return cls(name=spectral_index.name.lower(),
+                   band_definitions=band_definitions,
+                   data_type=data_type,
+                   expression=expression,
+                   arguments=constants or None)
+
+    @property
+    def is_band_math(self) -> bool:
+        """
+        True if the function is evaluated after its source bands are read, instead of by GDAL in a VRT
+        """
+        return bool(self.expression) or self.process_pool
+
+    def __compile_code(self, code: str):
+        try:
+            return compile(code, "<{}>".format(self.name), 'exec')
+        except (SyntaxError, ValueError) as e:
+            # same exception as py_compile.compile(doraise=True) raised back when the code went through a temp file
+            raise py_compile.PyCompileError(e.__class__, e, self.name)
+
+    @classmethod
+    def __get_compiled(cls, key, create):
+        """
+        Bounded LRU cache of compiled code and parsed band expressions. Anything that fails to compile raises and is
+        not cached.
+        """
+        with cls.__compiled_lock:
+            if key in cls.__compiled:
+                cls.__compiled.move_to_end(key)
+                return cls.__compiled[key]
+
+        compiled = create()
+
+        with cls.__compiled_lock:
+            cls.__compiled[key] = compiled
+            while len(cls.__compiled) > cls.compile_cache_size:
+                cls.__compiled.popitem(last=False)
+
+        return compiled
 
 
 # TODO rename as LandsatMetadata
@@ -571,6 +698,11 @@ LLNppprrrOOYYDDDMM_AA.TIF  where:
 
 
 class __RasterMetadata:
+    # file headers (data type, size, projection, geotransform) by file path. band files don't change, and reopening
+    # them over a mounted bucket costs a round trip per scene and band
+    header_cache_size = 4096
+    __headers = OrderedDict()
+    __header_lock = threading.Lock()
 
     # TODO, maybe there should be setters and getters to prevent problems?
     def __init__(self, band_number: int=None, metadata: Metadata=None):
@@ -593,21 +725,14 @@ class __RasterMetadata:
         if metadata:
             file_path = metadata.get_full_file_path(band_number)
 
-            dataset = gdal.Open(file_path)
-
-            self.data_type = gdal.GetDataTypeName(dataset.GetRasterBand(1).DataType)
+            self.data_type, x_size, y_size, self.projection, self.geo_transform = self.__get_header(file_path)
 
-            self.x_src_size = dataset.RasterXSize
-            self.y_src_size = dataset.RasterYSize
-            self.x_dst_size = dataset.RasterXSize
-            self.y_dst_size = dataset.RasterYSize
-
-            self.projection = dataset.GetProjection()
-            self.geo_transform = dataset.GetGeoTransform()
+            self.x_src_size = x_size
+            self.y_src_size = y_size
+            self.x_dst_size = x_size
+            self.y_dst_size = y_size
             # self.data_id = name_prefix
 
-            del dataset
-
             xmin = self.geo_transform[0]
             ymax = self.geo_transform[3]
             # self.geo_transform[1] is positive
@@ -624,6 +749,27 @@ class __RasterMetadata:
 
             self.file_path = file_path
 
+    @classmethod
+    def __get_header(cls, file_path) -> tuple:
+        with cls.__header_lock:
+            if file_path in cls.__headers:
+                cls.__headers.move_to_end(file_path)
+                return cls.__headers[file_path]
+
+        dataset = gdal.Open(file_path)
+        header = (gdal.GetDataTypeName(dataset.GetRasterBand(1).DataType),
+                  dataset.RasterXSize,
+                  dataset.RasterYSize,
+                  dataset.GetProjection(),
+                  dataset.GetGeoTransform())
+        del dataset
+
+        with cls.__header_lock:
+            cls.__headers[file_path] = header
+            while len(cls.__headers) > cls.header_cache_size:
+                cls.__headers.popitem(last=False)
+        return header
+
     def clip_by_boundary(self, other_bounds, other_cs=None):
         # TODO throw exception
         # if not self.geo_transform:
@@ -740,8 +886,10 @@ class RasterMetadata(__RasterMetadata):
         return band_number in self.raster_band_metadata
 
     def calculate_clipped(self, extent, extent_cs=None):
-        if extent in self.__calculated:
-            return self.__calculated[extent]
+        # the same extent in another coordinate system is another clip
+        key = (extent, extent_cs.srs if extent_cs else None)
+        if key in self.__calculated:
+            return self.__calculated[key]
 
         # TODO override deep copy to copy each of the bands? Or store clipped information on bands and rasters instead of making a whole object copy?
         copied_raster = copy.deepcopy(self)
@@ -749,7 +897,7 @@ class RasterMetadata(__RasterMetadata):
         if not extent_cs:
             extent_cs = self.__wgs84_cs
         copied_raster.clip_by_boundary(extent, extent_cs)
-        self.__calculated[extent] = copied_raster
+        self.__calculated[key] = copied_raster
         return copied_raster
 
 
@@ -770,6 +918,21 @@ class Landsat(Imagery):
     __metadata = None
     __id = None
 
+    # polygon masks keyed on (polygon, grid), shared between Landsat objects
+    cutline_mask_cache_size = 64
+    __cutline_masks = OrderedDict()
+    __cutline_mask_lock = threading.Lock()
+
+    # scale_params="auto" stretches each band between these percentiles of its valid values
+    auto_scale_percentiles = (2.0, 98.0)
+
+    # the default for fetch_imagery_array, no limits
+    memory_budget = MemoryBudget()
+
+    # opt in persistent store of fetch_imagery_array and get_dataset results, shared by every Landsat unless an
+    # instance sets its own
+    disk_cache: DiskCache = None
+
     def __init__(self, metadata: [Metadata]):
         bucket_name = "gcp-public-data-landsat"
         super().__init__(bucket_name)
@@ -832,23 +995,539 @@ class Landsat(Imagery):
                             envelope_boundary: tuple=None,
                             boundary_cs=4326,
                             output_type: DataType=DataType.BYTE,
-                            spatial_resolution_m=60) -> np.ndarray:
+                            spatial_resolution_m=60,
+                            cutline_mode: CutlineMode=CutlineMode.WARP,
+                            out: np.ndarray=None,
+                            memory_budget: MemoryBudget=None) -> np.ndarray:
+        """
+        Read the requested bands into an ndarray. With 3 or more bands the result is pixel interleaved, shape
+        (y, x, band), otherwise it is (band, y, x) or (y, x) for a single band. The result is always C-contiguous.
+        :param out: optional preallocated C-contiguous array to read into, it must have the result's shape. Any dtype
+        is accepted, GDAL converts from the output_type while reading
+        :param scale_params: gdal.Translate scaleParams, or "auto" to stretch each band between the
+        auto_scale_percentiles of its cached statistics
+        :param memory_budget: limits checked against plan_request before reading, Landsat.memory_budget if None
+        """
         # TODO remove this, right?
         if polygon_boundary_wkb:
-            envelope_boundary = shapely.wkb.loads(polygon_boundary_wkb).bounds
+            envelope_boundary = self.__get_polygon_envelope(polygon_boundary_wkb, boundary_cs)
+
+        if self.__is_auto_scale(scale_params):
+            scale_params = self.get_auto_scale_params(band_definitions, output_type)
+
+        return self.__fetch_within_budget(band_definitions, scale_params, polygon_boundary_wkb, envelope_boundary,
+                                          boundary_cs, output_type, spatial_resolution_m, cutline_mode, out,
+                                          memory_budget or self.memory_budget)
+
+    def __fetch_within_budget(self,
+                              band_definitions,
+                              scale_params,
+                              polygon_boundary_wkb: bytes,
+                              envelope_boundary: tuple,
+                              boundary_cs,
+                              output_type: DataType,
+                              spatial_resolution_m,
+                              cutline_mode: CutlineMode,
+                              out: np.ndarray,
+                              memory_budget: MemoryBudget) -> np.ndarray:
+        if not memory_budget.b_limited:
+            return self.__fetch_cached(lambda: self.__fetch_imagery_array(band_definitions, scale_params,
+                                                                          polygon_boundary_wkb, envelope_boundary,
+                                                                          boundary_cs, output_type,
+                                                                          spatial_resolution_m, cutline_mode, out),
+                                       band_definitions, scale_params, polygon_boundary_wkb, envelope_boundary,
+                                       boundary_cs, output_type, spatial_resolution_m, cutline_mode, out)
+
+        plan = self.plan_request(band_definitions,
+                                 output_type=output_type,
+                                 envelope_boundary=envelope_boundary,
+                                 polygon_boundary_wkb=polygon_boundary_wkb,
+                                 spatial_resolution_m=spatial_resolution_m,
+                                 boundary_cs=boundary_cs)
+        block_size = None
+        if not memory_budget.fits(plan.total_bytes):
+            if memory_budget.action is BudgetAction.DOWNSAMPLE and out is None:
+                # the estimate isn't exactly quadratic in the resolution (pixel rounding), so check again
+                for _ in range(4):
+                    spatial_resolution_m *= memory_budget.get_downsample_factor(plan) * 1.01
+                    plan = self.plan_request(band_definitions,
+                                             output_type=output_type,
+                                             envelope_boundary=envelope_boundary,
+                                             polygon_boundary_wkb=polygon_boundary_wkb,
+                                             spatial_resolution_m=spatial_resolution_m,
+                                             boundary_cs=boundary_cs)
+                    if memory_budget.fits(plan.total_bytes):
+                        break
+            elif memory_budget.action is BudgetAction.TILE:
+                block_size = memory_budget.get_block_size(plan)
+
+            if block_size is None and not memory_budget.fits(plan.total_bytes):
+                raise MemoryBudgetExceeded("{0} is over the request budget of {1} bytes".format(
+                    plan, memory_budget.request_bytes), plan)
+
+        def fetch():
+            if block_size:
+                return self.__fetch_tiled(band_definitions, scale_params, polygon_boundary_wkb, envelope_boundary,
+                                          boundary_cs, output_type, spatial_resolution_m, cutline_mode, block_size, out)
+            return self.__fetch_imagery_array(band_definitions, scale_params, polygon_boundary_wkb, envelope_boundary,
+                                              boundary_cs, output_type, spatial_resolution_m, cutline_mode, out)
+
+        with MemoryBudget.reserve(plan.tiled_bytes(block_size) if block_size else plan.total_bytes, plan):
+            # keyed by the resolution that's read, a downsampled result is never returned for the full resolution
+            return self.__fetch_cached(fetch, band_definitions, scale_params, polygon_boundary_wkb, envelope_boundary,
+                                       boundary_cs, output_type, spatial_resolution_m, cutline_mode, out)
+
+    def __fetch_cached(self,
+                       fetch,
+                       band_definitions,
+                       scale_params,
+                       polygon_boundary_wkb: bytes,
+                       envelope_boundary: tuple,
+                       boundary_cs,
+                       output_type: DataType,
+                       spatial_resolution_m,
+                       cutline_mode: CutlineMode,
+                       out: np.ndarray) -> np.ndarray:
+        """
+        The result of fetch() through the disk_cache, if there is one, under the key of the request it reads
+        """
+        # gdal clamps values converted into a narrower out, a copy from the cache would wrap them
+        if self.disk_cache is None or (out is not None and not np.can_cast(output_type.numpy_type, out.dtype)):
+            return fetch()
+
+        cache_key = self.get_cache_key("array", band_definitions, scale_params, polygon_boundary_wkb,
+                                       envelope_boundary, boundary_cs, output_type, spatial_resolution_m, cutline_mode)
+        nda = self.disk_cache.get_array(cache_key, out=out)
+        if nda is None:
+            nda = fetch()
+            self.disk_cache.put_array(cache_key, nda)
+        return nda
 
-        dataset = self.get_dataset(band_definitions,
-                                   output_type=output_type,
-                                   scale_params=scale_params,
-                                   envelope_boundary=envelope_boundary,
-                                   polygon_boundary_wkb=polygon_boundary_wkb,
-                                   spatial_resolution_m=spatial_resolution_m)
-        nda = dataset.ReadAsArray()
+    def plan_request(self,
+                     band_definitions,
+                     output_type: DataType=DataType.BYTE,
+                     envelope_boundary: tuple=None,
+                     polygon_boundary_wkb: bytes=None,
+                     spatial_resolution_m=60,
+                     boundary_cs=4326) -> MemoryPlan:
+        """
+        Estimate the memory a fetch_imagery_array request needs from the RasterMetadata of its scenes. Only file
+        headers are read.
+        :param boundary_cs: epsg code of polygon_boundary_wkb
+        """
+        if polygon_boundary_wkb:
+            envelope_boundary = self.__get_polygon_envelope(polygon_boundary_wkb, boundary_cs)
+
+        output_bytes_per_pixel = np.dtype(output_type.numpy_type).itemsize * len(band_definitions)
+        b_band_math = self.__has_band_math(band_definitions)
+        b_warp = len(self.__metadata) > 1 or polygon_boundary_wkb is not None
+
+        scene_sizes = []
+        scene_bounds = []
+        projections = set()
+        source_bytes = 0
+        for metadata in self.__metadata:
+            if self.storage.mount_sub_folder(metadata, request_key=str(self.__id)) is False:
+                continue
+
+            raster = self.__calculate_metadata(metadata, band_definitions, extent=envelope_boundary)
+            scene_sizes.append((int(math.ceil(raster.x_dst_size * raster.geo_transform[1] / spatial_resolution_m)),
+                                int(math.ceil(raster.y_dst_size * -raster.geo_transform[5] / spatial_resolution_m))))
+            scene_bounds.append(raster.bounds)
+            projections.add(raster.projection)
+
+            for band_number in raster.raster_band_metadata:
+                band_raster = raster.get_metadata(band_number)
+                band_data_size = gdal.GetDataTypeSize(gdal.GetDataTypeByName(band_raster.data_type)) // 8
+                source_bytes += band_raster.x_dst_size * band_raster.y_dst_size * band_data_size
+
+        scene_pixels = sum(x_size * y_size for x_size, y_size in scene_sizes)
+        if len(scene_sizes) == 1:
+            x_size, y_size = scene_sizes[0]
+        elif len(projections) == 1:
+            x_size = int(math.ceil((max(bounds[2] for bounds in scene_bounds) -
+                                    min(bounds[0] for bounds in scene_bounds)) / spatial_resolution_m))
+            y_size = int(math.ceil((max(bounds[3] for bounds in scene_bounds) -
+                                    min(bounds[1] for bounds in scene_bounds)) / spatial_resolution_m))
+        else:
+            # scenes in different projections are warped to the first one, a square of their total is close enough
+            x_size = y_size = int(math.ceil(math.sqrt(scene_pixels)))
+
+        output_bytes = x_size * y_size * output_bytes_per_pixel
+        # every scene is translated to a MEM dataset, and warped into one more when there's a mosaic or cutline
+        intermediate_bytes = (scene_pixels + (x_size * y_size if b_warp else 0)) * output_bytes_per_pixel
+        if b_band_math:
+            # sources are read as Float32 through the same translate and warp, copied out to evaluate, and the
+            # evaluated Float32 bands are translated once more to the output type
+            source_count = len(self.__get_band_math_sources(band_definitions))
+            intermediate_bytes += (scene_pixels + (x_size * y_size if b_warp else 0)) * source_count * 4
+            intermediate_bytes += x_size * y_size * (source_count + len(band_definitions)) * 4
+
+        return MemoryPlan(x_size, y_size, len(band_definitions), output_bytes, source_bytes, intermediate_bytes,
+                          spatial_resolution_m)
+
+    def __fetch_tiled(self,
+                      band_definitions,
+                      scale_params,
+                      polygon_boundary_wkb: bytes,
+                      envelope_boundary: tuple,
+                      boundary_cs,
+                      output_type: DataType,
+                      spatial_resolution_m,
+                      cutline_mode: CutlineMode,
+                      block_size,
+                      out: np.ndarray=None) -> np.ndarray:
+        """
+        fetch_imagery_array assembled from iter_imagery_blocks, so that only the result and two blocks' worth of
+        intermediate datasets are held at once
+        """
+        (x_size, y_size), band_count, dtype, blocks, _ = self.__get_blocks(band_definitions,
+                                                                           scale_params=scale_params,
+                                                                           polygon_boundary_wkb=polygon_boundary_wkb,
+                                                                           envelope_boundary=envelope_boundary,
+                                                                           output_type=output_type,
+                                                                           spatial_resolution_m=spatial_resolution_m,
+                                                                           block_size=block_size,
+                                                                           boundary_cs=boundary_cs,
+                                                                           cutline_mode=cutline_mode)
+        b_interleave = len(band_definitions) >= 3
+        shape = self.__get_array_shape(band_count, (0, 0, x_size, y_size), b_interleave)
+        if out is None:
+            out = np.empty(shape, dtype=dtype)
+        elif out.shape != shape or not out.flags.c_contiguous:
+            raise ValueError("out must be a C-contiguous array of shape {0}, not {1}".format(shape, out.shape))
+
+        for (x_offset, y_offset, x_block, y_block), block in blocks:
+            if b_interleave or out.ndim == 2:
+                out[y_offset:y_offset + y_block, x_offset:x_offset + x_block] = block
+            else:
+                out[:, y_offset:y_offset + y_block, x_offset:x_offset + x_block] = block
+        return out
+
+    def __fetch_imagery_array(self,
+                              band_definitions,
+                              scale_params,
+                              polygon_boundary_wkb: bytes,
+                              envelope_boundary: tuple,
+                              boundary_cs,
+                              output_type: DataType,
+                              spatial_resolution_m,
+                              cutline_mode: CutlineMode,
+                              out: np.ndarray) -> np.ndarray:
+        # a single scene doesn't need gdal.Warp to apply a cutline, a cached raster mask does the same job
+        b_raster_mask = polygon_boundary_wkb is not None and \
+            cutline_mode is CutlineMode.RASTER_MASK and \
+            len(self.__metadata) == 1
+
+        b_warp = len(self.__metadata) > 1 or (polygon_boundary_wkb is not None and not b_raster_mask)
+        luts = None if b_warp else self.__get_scale_luts(band_definitions, scale_params, output_type)
+        b_alpha_channel = Band.ALPHA in band_definitions
+
+        if luts:
+            # read unscaled, the lookup tables do the scaling
+            dataset = self.__get_dataset([band_definition for band_definition in band_definitions
+                                          if band_definition is not Band.ALPHA],
+                                         output_type=DataType.UINT16,
+                                         envelope_boundary=envelope_boundary,
+                                         spatial_resolution_m=spatial_resolution_m)
+            band_count = len(luts) + (1 if b_alpha_channel else 0)
+            dtype = output_type.numpy_type
+        else:
+            dataset = self.__get_dataset(band_definitions,
+                                         output_type=output_type,
+                                         scale_params=scale_params,
+                                         envelope_boundary=envelope_boundary,
+                                         polygon_boundary_wkb=None if b_raster_mask else polygon_boundary_wkb,
+                                         spatial_resolution_m=spatial_resolution_m,
+                                         boundary_cs=boundary_cs)
+            band_count = dataset.RasterCount
+            dtype = gdal_array.GDALTypeCodeToNumericTypeCode(dataset.GetRasterBand(1).DataType)
+
+        b_interleave = len(band_definitions) >= 3
+        window = (0, 0, dataset.RasterXSize, dataset.RasterYSize)
+        shape = self.__get_array_shape(band_count, window, b_interleave)
+        if out is None:
+            out = np.empty(shape, dtype=dtype)
+        elif out.shape != shape or not out.flags.c_contiguous:
+            raise ValueError("out must be a C-contiguous array of shape {0}, not {1}".format(shape, out.shape))
+
+        if luts:
+            self.__read_scaled_into(dataset, out, luts, window, b_interleave, output_type, b_alpha_channel)
+        else:
+            self.__read_into(dataset, out, window, b_interleave)
+        if b_raster_mask:
+            mask = self.get_cutline_mask(polygon_boundary_wkb, dataset, boundary_cs=boundary_cs)
+            # zero is the nodata value set in translate (and the value warp uses outside of a cutline)
+            if b_interleave:
+                out[~mask] = 0
+            else:
+                out[..., ~mask] = 0
         del dataset
-        
-        if len(band_definitions) >= 3:
-            return nda.transpose((1, 2, 0))
-        return nda
+
+        return out
+
+    def get_cache_key(self,
+                      kind: str,
+                      band_definitions,
+                      scale_params=None,
+                      polygon_boundary_wkb: bytes=None,
+                      envelope_boundary: tuple=None,
+                      boundary_cs=4326,
+                      output_type: DataType=DataType.BYTE,
+                      spatial_resolution_m=60,
+                      cutline_mode: CutlineMode=CutlineMode.WARP) -> str:
+        """
+        Content key of a request for the disk_cache: the scene ids, the band definitions (code by its hash), the
+        scale, the grid (boundary, coordinate system and resolution) and the output type
+        :param kind: what's stored under the key, "array" or "dataset"
+        """
+        description = (kind,
+                       tuple((metadata.scene_id, metadata.product_id) for metadata in self.__metadata),
+                       tuple(self.__describe_band(band_definition) for band_definition in band_definitions),
+                       repr(scale_params),
+                       hashlib.sha256(polygon_boundary_wkb).hexdigest() if polygon_boundary_wkb else None,
+                       tuple(envelope_boundary) if envelope_boundary else None,
+                       boundary_cs,
+                       output_type.name,
+                       float(spatial_resolution_m),
+                       cutline_mode.name)
+        return hashlib.sha256(repr(description).encode()).hexdigest()
+
+    @staticmethod
+    def __describe_band(band_definition):
+        if isinstance(band_definition, FunctionDetails):
+            return (band_definition.name,
+                    tuple(Landsat.__describe_band(source) for source in band_definition.band_definitions),
+                    band_definition.data_type.name,
+                    band_definition.expression,
+                    band_definition.code_hash,
+                    tuple(sorted((band_definition.arguments or {}).items())),
+                    band_definition.transfer_type.name if band_definition.transfer_type else None)
+        elif isinstance(band_definition, Band):
+            return band_definition.name
+        return int(band_definition)
+
+    def get_band_statistics(self, band_definition) -> BandStatistics:
+        """
+        Statistics of a band over every scene, merged from the cached statistics of each scene's band file
+        :param band_definition: Band enum or band number
+        """
+        statistics = None
+        for metadata in self.__metadata:
+            if self.storage.mount_sub_folder(metadata, request_key=str(self.__id)) is False:
+                continue
+
+            band_number = band_definition
+            if isinstance(band_definition, Band):
+                band_number = metadata.band_map.get_number(band_definition)
+
+            scene_statistics = BandStatistics.get(metadata.get_full_file_path(band_number))
+            statistics = scene_statistics if statistics is None else statistics + scene_statistics
+        return statistics
+
+    def get_auto_scale_params(self, band_definitions, output_type: DataType) -> list:
+        """
+        scaleParams that stretch each band between the auto_scale_percentiles of its statistics. Valid values are
+        scaled from 1 so that they stay distinct from nodata
+        """
+        if output_type not in (DataType.BYTE, DataType.UINT16, DataType.INT16, DataType.UINT32, DataType.INT32):
+            raise ValueError("auto scale needs an integer output_type, not {}".format(output_type.name))
+
+        low_percent, high_percent = self.auto_scale_percentiles
+        scale_params = []
+        for band_definition in band_definitions:
+            if band_definition is Band.ALPHA:
+                continue
+            if isinstance(band_definition, FunctionDetails):
+                raise ValueError("auto scale uses the statistics of band files, {} is a band function".format(
+                    band_definition.name))
+
+            statistics = self.get_band_statistics(band_definition)
+            low = statistics.percentile(low_percent) if statistics else None
+            if low is None:
+                scale_params.append([0.0, 65535.0, 1, output_type.range_max])
+                continue
+
+            high = max(statistics.percentile(high_percent), low + 1)
+            scale_params.append([float(low), float(high), 1, output_type.range_max])
+
+        return scale_params
+
+    @staticmethod
+    def __is_auto_scale(scale_params) -> bool:
+        return isinstance(scale_params, str) and scale_params.lower() == "auto"
+
+    @staticmethod
+    def __get_array_shape(band_count, window: tuple, b_interleave: bool) -> tuple:
+        x_size, y_size = window[2], window[3]
+        if b_interleave:
+            return y_size, x_size, band_count
+        elif band_count == 1:
+            return y_size, x_size
+        return band_count, y_size, x_size
+
+    @staticmethod
+    def __read_into(dataset, nda: np.ndarray, window: tuple, b_interleave: bool):
+        """
+        Read every band of the dataset into the leading bands of nda. GDAL writes through the strides of the array it
+        is given, so handing it a (band, y, x) view of a (y, x, band) array fills the pixel interleaved buffer
+        directly, with no transpose copy afterwards.
+        """
+        band_count = dataset.RasterCount
+        if b_interleave:
+            buf_obj = nda[:, :, :band_count].transpose((2, 0, 1))
+        elif nda.ndim == 3:
+            buf_obj = nda[:band_count]
+        else:
+            buf_obj = nda
+
+        # single band datasets are read through the band, which only takes a 2d buffer
+        if band_count == 1 and buf_obj.ndim == 3:
+            buf_obj = buf_obj[0]
+
+        dataset.ReadAsArray(*window, buf_obj=buf_obj)
+
+    @staticmethod
+    def __get_scale_luts(band_definitions, scale_params, output_type: DataType) -> list:
+        """
+        Lookup tables that replace gdal.Translate's floating point scaling of each band, or None if the request can't
+        use them. Landsat bands are Byte or UInt16, so they can be read unscaled as UInt16 and scaled to any small
+        integer type with one 65,536 entry table per band. Warped requests keep using Translate: the warp treats 0 as
+        nodata, and scaling after it instead of before can change which pixels are 0.
+        """
+        if output_type not in (DataType.BYTE, DataType.UINT16, DataType.INT16):
+            return None
+
+        bands = [band_definition for band_definition in band_definitions if band_definition is not Band.ALPHA]
+        if any(isinstance(band_definition, FunctionDetails) for band_definition in bands):
+            return None
+
+        lut_scale_params = get_lut_scale_params(scale_params, len(bands))
+        if lut_scale_params is None:
+            return None
+
+        dtype = np.dtype(output_type.numpy_type).str
+        return [get_scale_lut(scale_param, dtype) for scale_param in lut_scale_params]
+
+    @staticmethod
+    def __read_scaled_into(dataset,
+                           nda: np.ndarray,
+                           luts: list,
+                           window: tuple,
+                           b_interleave: bool,
+                           output_type: DataType,
+                           b_alpha_channel: bool):
+        """
+        Read each unscaled UInt16 band of the dataset and scale it into nda through its lookup table. A UInt16 output
+        is read straight into nda and mapped in place, other outputs go through a single band buffer.
+        """
+        if b_interleave:
+            bands_view = nda.transpose((2, 0, 1))
+        elif nda.ndim == 3:
+            bands_view = nda
+        else:
+            bands_view = nda[np.newaxis]
+
+        source = None
+        for band_index, lut in enumerate(luts):
+            band_view = bands_view[band_index]
+            band = dataset.GetRasterBand(band_index + 1)
+            if band_view.dtype == np.uint16:
+                band.ReadAsArray(*window, buf_obj=band_view)
+                apply_lut(lut, band_view, out=band_view)
+                continue
+
+            if source is None:
+                source = np.empty((window[3], window[2]), dtype=np.uint16)
+            band.ReadAsArray(*window, buf_obj=source)
+            apply_lut(lut, source, out=band_view)
+
+        if b_alpha_channel:
+            # the scaled values are what Translate would have set nodata (0) on, so alpha comes from them
+            valid = np.any(bands_view[:len(luts)] != 0, axis=0)
+            bands_view[len(luts)] = valid * Landsat.__get_alpha_max(output_type)
+
+    @classmethod
+    def get_cutline_mask(cls, polygon_boundary_wkb: bytes, dataset, boundary_cs=4326, window: tuple=None) -> np.ndarray:
+        """
+        Rasterize a polygon onto the grid of a dataset. Masks are cached by polygon and grid, so repeated requests for
+        the same polygon clipped tile only pay for the rasterization once.
+        :param polygon_boundary_wkb: polygon in the boundary_cs coordinate system
+        :param dataset: gdal dataset that defines the output grid
+        :param boundary_cs: epsg code of the polygon
+        :param window: (xoff, yoff, xsize, ysize) of the dataset to rasterize onto, the whole dataset if None
+        :return: boolean ndarray of shape (ysize, xsize), True inside of the polygon
+        """
+        if not window:
+            window = (0, 0, dataset.RasterXSize, dataset.RasterYSize)
+        dataset_geo_transform = dataset.GetGeoTransform()
+        geo_transform = (dataset_geo_transform[0] + window[0] * dataset_geo_transform[1],
+                         dataset_geo_transform[1],
+                         dataset_geo_transform[2],
+                         dataset_geo_transform[3] + window[1] * dataset_geo_transform[5],
+                         dataset_geo_transform[4],
+                         dataset_geo_transform[5])
+        projection = dataset.GetProjection()
+        key = (polygon_boundary_wkb, boundary_cs, geo_transform, projection, window[2], window[3])
+
+        with cls.__cutline_mask_lock:
+            if key in cls.__cutline_masks:
+                cls.__cutline_masks.move_to_end(key)
+                return cls.__cutline_masks[key]
+
+        mask_dataset = gdal.GetDriverByName('MEM').Create('', window[2], window[3], 1, gdal.GDT_Byte)
+        mask_dataset.SetGeoTransform(geo_transform)
+        mask_dataset.SetProjection(projection)
+
+        cutline_ds = ogr.GetDriverByName('Memory').CreateDataSource('cutline')
+        cutline_lyr = cutline_ds.CreateLayer('cutline', srs=cls.__get_boundary_srs(boundary_cs))
+        f = ogr.Feature(cutline_lyr.GetLayerDefn())
+        f.SetGeometry(ogr.CreateGeometryFromWkb(polygon_boundary_wkb))
+        cutline_lyr.CreateFeature(f)
+        f = None
+
+        # the layer is reprojected into the mask_dataset projection by RasterizeLayer
+        gdal.RasterizeLayer(mask_dataset, [1], cutline_lyr, burn_values=[1])
+        mask = mask_dataset.ReadAsArray().astype(np.bool_)
+        mask.setflags(write=False)
+
+        cutline_lyr = None
+        cutline_ds = None
+        del mask_dataset
+
+        with cls.__cutline_mask_lock:
+            cls.__cutline_masks[key] = mask
+            while len(cls.__cutline_masks) > cls.cutline_mask_cache_size:
+                cls.__cutline_masks.popitem(last=False)
+
+        return mask
+
+    @staticmethod
+    def __get_boundary_srs(boundary_cs: int):
+        """
+        The spatial reference of a boundary_cs polygon, in the (x, y) axis order of shapely's wkb
+        """
+        boundary_srs = osr.SpatialReference()
+        boundary_srs.ImportFromEPSG(boundary_cs)
+        # GDAL 3 defaults to authority axis order (lat, lon) for 4326, wkb from shapely is always (lon, lat)
+        if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+            boundary_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        return boundary_srs
+
+    @classmethod
+    def __get_polygon_envelope(cls, polygon_boundary_wkb: bytes, boundary_cs=4326) -> tuple:
+        """
+        The wgs84 envelope of a polygon in boundary_cs, envelope_boundary is always clipped as wgs84
+        :return: (minx, miny, maxx, maxy)
+        """
+        if boundary_cs == 4326:
+            return shapely.wkb.loads(polygon_boundary_wkb).bounds
+
+        polygon = ogr.CreateGeometryFromWkb(polygon_boundary_wkb)
+        polygon.AssignSpatialReference(cls.__get_boundary_srs(boundary_cs))
+        polygon.TransformTo(cls.__get_boundary_srs(4326))
+        min_x, max_x, min_y, max_y = polygon.GetEnvelope()
+        return min_x, min_y, max_x, max_y
 
     def __get_source_elem(self,
                           band_number,
@@ -897,7 +1576,6 @@ class Landsat(Imagery):
                                  calculated_metadata,
                                  metadata,
                                  block_size=256):
-        gdal.SetConfigOption('GDAL_VRT_ENABLE_PYTHON', "YES")
         # data_type = gdal.GetDataTypeName(dataset.GetRasterBand(1).DataType)
         elem_raster_band = etree.SubElement(vrt_dataset, "VRTRasterBand")
 
@@ -983,6 +1661,10 @@ class Landsat(Imagery):
         # TODO if no bands throw exception
         for band_definition in band_definitions:
             if isinstance(band_definition, FunctionDetails):
+                if band_definition.is_band_math:
+                    raise ValueError("band math {0} is evaluated after reading, it can't be part of a vrt. use "
+                                     "get_dataset or fetch_imagery_array".format(band_definition.name))
+
                 self.__get_function_band_elem(vrt_dataset,
                                               band_definition,
                                               position_number,
@@ -1021,7 +1703,15 @@ class Landsat(Imagery):
                                   scale_params=None,
                                   envelope_boundary: tuple=None,
                                   xRes=60,
-                                  yRes=60):
+                                  yRes=60,
+                                  output_format='MEM',
+                                  envelope_cs=4326):
+        # python pixel functions are only enabled on this thread, and only for the length of the translate
+        vrt_options = self.__get_vrt_options(band_definitions)
+        # get_vrt clips in wgs84 unless it's told otherwise
+        extent_cs = pyproj.Proj(init='epsg:{}'.format(envelope_cs)) if envelope_boundary and envelope_cs != 4326 \
+            else None
+
         translated = []
         for metadata in self.__metadata:
             if self.storage.mount_sub_folder(metadata, request_key=str(self.__id)) is False:
@@ -1029,19 +1719,32 @@ class Landsat(Imagery):
 
             # TODO, the envelope requested should be a part of the metadata, so that the envelope
             # boundary can be pulled from that if available
-            vrt = self.get_vrt(band_definitions, metadata=metadata, envelope_boundary=envelope_boundary)
+            vrt = self.get_vrt(band_definitions,
+                               metadata=metadata,
+                               envelope_boundary=envelope_boundary,
+                               boundary_cs=extent_cs)
             # http://gdal.org/python/
             # http://gdal.org/python/osgeo.gdal-module.html#TranslateOptions
-            dataset_translated = gdal.Translate('', vrt.decode('utf-8'),
-                                                format='MEM',
-                                                scaleParams=scale_params,
-                                                xRes=xRes,
-                                                yRes=yRes,
-                                                outputType=output_type.gdal,
-                                                noData=0)
+            with GDALConfig(**vrt_options):
+                dataset_translated = gdal.Translate('', vrt.decode('utf-8'),
+                                                    format=output_format,
+                                                    scaleParams=scale_params,
+                                                    xRes=xRes,
+                                                    yRes=yRes,
+                                                    outputType=output_type.gdal,
+                                                    noData=0)
             translated.append(dataset_translated)
         return translated
 
+    @staticmethod
+    def __get_vrt_options(band_definitions) -> dict:
+        """
+        GDAL config options needed for reading pixels from the vrt of these band definitions
+        """
+        if any(isinstance(band_definition, FunctionDetails) for band_definition in band_definitions):
+            return {'GDAL_VRT_ENABLE_PYTHON': "YES"}
+        return {}
+
     def get_dataset(self,
                     band_definitions,
                     output_type: DataType,
@@ -1049,6 +1752,114 @@ class Landsat(Imagery):
                     envelope_boundary: tuple = None,
                     polygon_boundary_wkb: bytes = None,
                     spatial_resolution_m=60):
+        """
+        The result of fetch_imagery_array as a georeferenced MEM dataset, the boundaries are in 4326. With a
+        disk_cache a cached result is copied from its GeoTIFF, so it can be written to like one that was read
+        """
+        if self.disk_cache is None:
+            return self.__get_dataset(band_definitions, output_type, scale_params, envelope_boundary,
+                                      polygon_boundary_wkb, spatial_resolution_m)
+
+        cache_key = self.get_cache_key("dataset", band_definitions,
+                                       scale_params=scale_params,
+                                       polygon_boundary_wkb=polygon_boundary_wkb,
+                                       envelope_boundary=envelope_boundary,
+                                       boundary_cs=4326,
+                                       output_type=output_type,
+                                       spatial_resolution_m=spatial_resolution_m)
+        cached = self.disk_cache.get_dataset(cache_key)
+        if cached is not None:
+            dataset = gdal.Translate('', cached, format='MEM')
+            del cached
+            return dataset
+
+        dataset = self.__get_dataset(band_definitions, output_type, scale_params, envelope_boundary,
+                                     polygon_boundary_wkb, spatial_resolution_m)
+        self.disk_cache.put_dataset(cache_key, dataset)
+        return dataset
+
+    def get_file(self,
+                 band_definitions,
+                 file_type: FileType,
+                 output_type: DataType=DataType.BYTE,
+                 scale_params=None,
+                 envelope_boundary: tuple=None,
+                 polygon_boundary_wkb: bytes=None,
+                 spatial_resolution_m=60,
+                 max_file_size: int=None,
+                 quality: int=None,
+                 deflate_level: int=None,
+                 threads=None) -> tuple:
+        """
+        Encode the result of get_dataset as a PNG, JPEG or GeoTIFF file in memory.
+        :param max_file_size: bytes the file must fit in. When the request's plan says it won't at
+        spatial_resolution_m, it's read at a coarser resolution to begin with, and a file that's still too big is
+        downsampled from the dataset already read (not read again) and encoded again. None for no limit
+        :param quality: JPEG quality, 1 to 100
+        :param deflate_level: zlib level of PNG and GeoTIFF, 1 to 9
+        :param threads: GeoTIFF compression threads, a number or "ALL_CPUS"
+        :param scale_params: gdal.Translate scaleParams, or "auto" as in fetch_imagery_array
+        :return: (the file's bytes, the spatial resolution it was written at)
+        """
+        if polygon_boundary_wkb:
+            envelope_boundary = shapely.wkb.loads(polygon_boundary_wkb).bounds
+
+        if self.__is_auto_scale(scale_params):
+            scale_params = self.get_auto_scale_params(band_definitions, output_type)
+
+        if max_file_size:
+            plan = self.plan_request(band_definitions,
+                                     output_type=output_type,
+                                     envelope_boundary=envelope_boundary,
+                                     polygon_boundary_wkb=polygon_boundary_wkb,
+                                     spatial_resolution_m=spatial_resolution_m)
+            expected_size = plan.output_bytes / file_type.compression_ratio
+            if expected_size > max_file_size:
+                spatial_resolution_m *= math.sqrt(expected_size / max_file_size)
+
+        dataset = self.get_dataset(band_definitions,
+                                   output_type=output_type,
+                                   scale_params=scale_params,
+                                   envelope_boundary=envelope_boundary,
+                                   polygon_boundary_wkb=polygon_boundary_wkb,
+                                   spatial_resolution_m=spatial_resolution_m)
+        # fail on an unsupported data type or band count before any encoding
+        file_type.check_dataset(dataset)
+
+        data = encode_dataset(dataset, file_type, quality=quality, deflate_level=deflate_level, threads=threads)
+        for _ in range(8):
+            if not max_file_size or len(data) <= max_file_size:
+                return data, spatial_resolution_m
+            if dataset.RasterXSize == 1 and dataset.RasterYSize == 1:
+                break
+
+            # encoded size goes roughly with the pixel count, aim a little under
+            factor = max(math.sqrt(len(data) / max_file_size) * 1.05, 1.1)
+            x_size, y_size = dataset.RasterXSize, dataset.RasterYSize
+            dataset = downsample_dataset(dataset, factor)
+            spatial_resolution_m *= max(x_size / dataset.RasterXSize, y_size / dataset.RasterYSize)
+            data = encode_dataset(dataset, file_type, quality=quality, deflate_level=deflate_level, threads=threads)
+
+        raise ValueError("the {0} file is {1} bytes downsampled to {2}m, over max_file_size {3}".format(
+            file_type.name, len(data), spatial_resolution_m, max_file_size))
+
+    def __get_dataset(self,
+                      band_definitions,
+                      output_type: DataType,
+                      scale_params=None,
+                      envelope_boundary: tuple = None,
+                      polygon_boundary_wkb: bytes = None,
+                      spatial_resolution_m=60,
+                      boundary_cs=4326):
+        if self.__has_band_math(band_definitions):
+            return self.__get_band_math_dataset(band_definitions,
+                                                output_type=output_type,
+                                                scale_params=scale_params,
+                                                envelope_boundary=envelope_boundary,
+                                                polygon_boundary_wkb=polygon_boundary_wkb,
+                                                spatial_resolution_m=spatial_resolution_m,
+                                                boundary_cs=boundary_cs)
+
         dataset_translated = self.__get_translated_datasets(band_definitions,
                                                             output_type,
                                                             scale_params,
@@ -1058,48 +1869,1112 @@ class Landsat(Imagery):
 
         b_alpha_channel = Band.ALPHA in band_definitions
         # if there is no need to warp the data
-        if not polygon_boundary_wkb and len(dataset_translated) == 1 and not b_alpha_channel:
+        if not polygon_boundary_wkb and len(dataset_translated) == 1:
+            if b_alpha_channel:
+                self.__add_alpha_band(dataset_translated[0], output_type)
             return dataset_translated[0]
 
+        # the warped dataset keeps nodata, so the union of the per-scene masks (clipped by the cutline) is its mask
         dataset_warped = self.__get_warped(dataset_translated,
                                            output_type=output_type,
+                                           spatial_resolution_m=spatial_resolution_m,
                                            polygon_boundary_wkb=polygon_boundary_wkb,
-                                           dstAlpha=b_alpha_channel)
+                                           boundary_cs=boundary_cs)
 
         for dataset in dataset_translated:
             del dataset
 
+        if b_alpha_channel:
+            self.__add_alpha_band(dataset_warped, output_type)
+
         return dataset_warped
 
+    @staticmethod
+    def __has_band_math(band_definitions) -> bool:
+        return any(isinstance(band_definition, FunctionDetails) and band_definition.is_band_math
+                   for band_definition in band_definitions)
+
+    @staticmethod
+    def __get_band_math_sources(band_definitions) -> list:
+        """
+        The band definitions that have to be read to evaluate band_definitions: every band that isn't a band math
+        expression, plus the sources of the expressions. Each is listed once, alpha is left out.
+        """
+        sources = []
+        for band_definition in band_definitions:
+            if band_definition is Band.ALPHA:
+                continue
+            if isinstance(band_definition, FunctionDetails) and band_definition.is_band_math:
+                for source in band_definition.band_definitions:
+                    if source not in sources:
+                        sources.append(source)
+            elif band_definition not in sources:
+                sources.append(band_definition)
+        return sources
+
+    @staticmethod
+    def __get_evaluated_dataset(band_definitions, sources: list, dataset, window: tuple=None):
+        """
+        Read the source bands from a window of the dataset, evaluate the band math expressions in band_definitions
+        from them, and collect them with the other bands into a Float32 MEM dataset, in band_definitions order
+        (without alpha). When a function runs in the BandFunctionPool the sources are read straight into the shared
+        memory its workers read, and its result is written to the MEM band from the shared memory they write.
+        :param sources: the band definitions the dataset's bands are, from __get_band_math_sources
+        :param dataset: the dataset to read from
+        :param window: (xoff, yoff, xsize, ysize) to read, None for the whole dataset, whose geotransform and
+        projection are then copied
+        """
+        b_georeferenced = window is None
+        if not window:
+            window = (0, 0, dataset.RasterXSize, dataset.RasterYSize)
+        x_size, y_size = window[2], window[3]
+        source_shape = (len(sources), y_size, x_size)
+        source_dtype = gdal_array.GDALTypeCodeToNumericTypeCode(dataset.GetRasterBand(1).DataType)
+        b_pooled = any(isinstance(band_definition, FunctionDetails) and band_definition.is_band_math and
+                       not band_definition.expression for band_definition in band_definitions)
+
+        shared_sources = SharedArrayLease(source_shape, source_dtype) if b_pooled else None
+        try:
+            source_nda = shared_sources.array if b_pooled else np.empty(source_shape, dtype=source_dtype)
+            Landsat.__read_into(dataset, source_nda, window, False)
+
+            output_definitions = [band_definition for band_definition in band_definitions
+                                  if band_definition is not Band.ALPHA]
+            evaluated = gdal.GetDriverByName('MEM').Create('', x_size, y_size, len(output_definitions),
+                                                           gdal.GDT_Float32)
+            if b_georeferenced:
+                evaluated.SetGeoTransform(dataset.GetGeoTransform())
+                evaluated.SetProjection(dataset.GetProjection())
+
+            for band_index, band_definition in enumerate(output_definitions):
+                band = evaluated.GetRasterBand(band_index + 1)
+                band.SetNoDataValue(0)
+                if not isinstance(band_definition, FunctionDetails) or not band_definition.is_band_math:
+                    band.WriteArray(source_nda[sources.index(band_definition)])
+                elif band_definition.expression:
+                    # evaluated into the function's own data type first, as a VRT band of that type would be
+                    result = np.empty((y_size, x_size), dtype=band_definition.data_type.numpy_type)
+                    arrays = {get_band_name(source): source_nda[sources.index(source)]
+                              for source in band_definition.band_definitions}
+                    band_definition.band_expression.evaluate(arrays, result)
+                    band.WriteArray(result)
+                    del arrays
+                else:
+                    with SharedArrayLease((y_size, x_size), band_definition.data_type.numpy_type) as shared_result:
+                        result = BandFunctionPool.evaluate(band_definition.name,
+                                                           band_definition.code,
+                                                           shared_sources,
+                                                           shared_result,
+                                                           source_indices=[sources.index(source) for source
+                                                                           in band_definition.band_definitions],
+                                                           arguments=band_definition.arguments,
+                                                           geo_transform=dataset.GetGeoTransform() if
+                                                           b_georeferenced else None,
+                                                           code_hash=band_definition.code_hash)
+                        band.WriteArray(result)
+                        # views of a lease have to be gone before it's closed
+                        del result
+        finally:
+            source_nda = None
+            if shared_sources is not None:
+                shared_sources.close()
+
+        return evaluated
+
+    @staticmethod
+    def __has_computed_scale(scale_params) -> bool:
+        """
+        Whether gdal.Translate would compute a source range from the pixels it's given, for a scale_params entry
+        without one
+        """
+        return bool(scale_params) and any(len(entry) < 2 for entry in scale_params)
+
+    @staticmethod
+    def __get_value_ranges(dataset, ranges: list=None) -> list:
+        """
+        (min, max) of the valid (not nodata 0, finite) values of each band of the dataset, merged into ranges from
+        other parts of the same request. None for a band without valid values.
+        """
+        ranges = list(ranges) if ranges else [None] * dataset.RasterCount
+        for band_index in range(dataset.RasterCount):
+            nda = dataset.GetRasterBand(band_index + 1).ReadAsArray()
+            valid = nda[(nda != 0) & np.isfinite(nda)]
+            if valid.size == 0:
+                continue
+            value_range = (float(valid.min()), float(valid.max()))
+            if ranges[band_index] is not None:
+                value_range = (min(value_range[0], ranges[band_index][0]), max(value_range[1], ranges[band_index][1]))
+            ranges[band_index] = value_range
+        return ranges
+
+    @staticmethod
+    def __resolve_scale_params(scale_params, ranges: list):
+        """
+        scale_params with the source range of entries that don't have one filled in from ranges, so that every part
+        of a request is scaled the same, as gdal.Translate would scale the whole of it
+        :param ranges: from __get_value_ranges, one per band
+        """
+        resolved = []
+        for band_index, entry in enumerate(scale_params):
+            if len(entry) < 2 and band_index < len(ranges) and ranges[band_index] is not None:
+                # a missing source range also means the default output range
+                entry = list(ranges[band_index])
+            resolved.append(entry)
+        return resolved
+
+    def __get_band_math_dataset(self,
+                                band_definitions,
+                                output_type: DataType,
+                                scale_params=None,
+                                envelope_boundary: tuple = None,
+                                polygon_boundary_wkb: bytes = None,
+                                spatial_resolution_m=60,
+                                boundary_cs=4326):
+        """
+        get_dataset for band definitions that include band math expressions. The source bands are read unscaled as
+        Float32 through the regular translate/warp path, the expressions are evaluated in numpy, and the collected
+        bands are scaled and converted to the output type with the same gdal.Translate as any other request.
+        """
+        sources = self.__get_band_math_sources(band_definitions)
+        source_dataset = self.__get_dataset(sources,
+                                            output_type=DataType.FLOAT32,
+                                            envelope_boundary=envelope_boundary,
+                                            polygon_boundary_wkb=polygon_boundary_wkb,
+                                            spatial_resolution_m=spatial_resolution_m,
+                                            boundary_cs=boundary_cs)
+
+        evaluated = self.__get_evaluated_dataset(band_definitions, sources, source_dataset)
+        del source_dataset
+
+        if self.__has_computed_scale(scale_params):
+            # exact, where gdal.Translate would approximate. Blocks resolve theirs the same way
+            scale_params = self.__resolve_scale_params(scale_params, self.__get_value_ranges(evaluated))
+
+        dataset = gdal.Translate('', evaluated,
+                                 format='MEM',
+                                 scaleParams=scale_params,
+                                 outputType=output_type.gdal,
+                                 noData=0)
+        del evaluated
+
+        if Band.ALPHA in band_definitions:
+            self.__add_alpha_band(dataset, output_type)
+
+        return dataset
+
+    @staticmethod
+    def __get_alpha(dataset, output_type: DataType, window: tuple=None) -> np.ndarray:
+        """
+        Alpha values built from the validity masks of the bands in the dataset. This is what gdal.Warp(dstAlpha=True)
+        would produce, without resampling the dataset a second time.
+        :param dataset: dataset with a nodata value set on its bands
+        :param output_type:
+        :param window: (xoff, yoff, xsize, ysize) to read, the whole dataset if None
+        :return: ndarray of shape (ysize, xsize)
+        """
+        if not window:
+            window = (0, 0, dataset.RasterXSize, dataset.RasterYSize)
+
+        valid = None
+        for band_index in range(1, dataset.RasterCount + 1):
+            band_valid = dataset.GetRasterBand(band_index).GetMaskBand().ReadAsArray(*window) > 0
+            valid = band_valid if valid is None else np.logical_or(valid, band_valid, out=valid)
+
+        return valid.astype(output_type.numpy_type) * output_type.numpy_type(Landsat.__get_alpha_max(output_type))
+
+    @staticmethod
+    def __get_alpha_max(output_type: DataType):
+        # warp uses 255 as the opaque value for Byte and floating point outputs
+        if output_type in (DataType.UINT16, DataType.INT16, DataType.UINT32, DataType.INT32):
+            return output_type.range_max
+        return 255
+
+    @staticmethod
+    def __add_alpha_band(dataset, output_type: DataType):
+        """
+        Append an alpha band built from the validity masks of the bands already in the dataset.
+        :param dataset: MEM dataset with a nodata value set on its bands
+        :param output_type:
+        :return:
+        """
+        alpha = Landsat.__get_alpha(dataset, output_type)
+        dataset.AddBand(output_type.gdal)
+        alpha_band = dataset.GetRasterBand(dataset.RasterCount)
+        alpha_band.SetColorInterpretation(gdal.GCI_AlphaBand)
+        alpha_band.WriteArray(alpha)
+
+    def __get_virtual_dataset(self,
+                              band_definitions,
+                              output_type: DataType,
+                              scale_params=None,
+                              envelope_boundary: tuple = None,
+                              polygon_boundary_wkb: bytes = None,
+                              spatial_resolution_m=60,
+                              envelope_cs=4326,
+                              boundary_cs=4326):
+        """
+        The same result as get_dataset, but as a VRT that hasn't read any pixels. A warped VRT only takes one source,
+        so mosaics are warped scene by scene onto the grid __get_warped uses for all of them at once (see
+        __get_warp_options) and combined with gdal.BuildVRT, where like in the warp the last scene wins where they
+        overlap. Alpha is not included, see __get_alpha.
+        :param envelope_cs: epsg code of envelope_boundary
+        :param boundary_cs: epsg code of polygon_boundary_wkb
+        :return: the VRT dataset and the intermediate datasets it reads from, which must be kept open as long as it is
+        """
+        dataset_translated = self.__get_translated_datasets(band_definitions,
+                                                            output_type,
+                                                            scale_params,
+                                                            envelope_boundary,
+                                                            xRes=spatial_resolution_m,
+                                                            yRes=spatial_resolution_m,
+                                                            output_format='VRT',
+                                                            envelope_cs=envelope_cs)
+
+        if not polygon_boundary_wkb and len(dataset_translated) == 1:
+            return dataset_translated[0], []
+
+        cutlineDSName = self.__create_cutline(polygon_boundary_wkb, boundary_cs)
+        warp_options = self.__get_warp_options(dataset_translated, output_type, spatial_resolution_m, cutlineDSName)
+        dataset_warped = [gdal.Warp("", dataset, format='VRT', **warp_options) for dataset in dataset_translated]
+        if cutlineDSName:
+            gdal.Unlink(cutlineDSName)
+
+        if len(dataset_warped) == 1:
+            return dataset_warped[0], dataset_translated
+
+        return gdal.BuildVRT("", dataset_warped, srcNodata=0, VRTNodata=0), dataset_translated + dataset_warped
+
+    def iter_imagery_blocks(self,
+                            band_definitions,
+                            scale_params=None,
+                            polygon_boundary_wkb: bytes=None,
+                            envelope_boundary: tuple=None,
+                            boundary_cs=4326,
+                            output_type: DataType=DataType.BYTE,
+                            spatial_resolution_m=60,
+                            block_size=512,
+                            cutline_mode: CutlineMode=CutlineMode.WARP) -> Generator[Tuple[tuple, np.ndarray],
+                                                                                     None, None]:
+        """
+        Stream the result of fetch_imagery_array in blocks, so that only two blocks are ever held in memory: the one
+        handed to the caller and the next one, which is read on a background thread in the meantime.
+        :param block_size: width and height of the blocks. Blocks start at multiples of block_size, the last block in
+        a row or column is clipped to the output size
+        :param cutline_mode: how polygon_boundary_wkb is applied, a RASTER_MASK is rasterized from boundary_cs onto
+        each block
+        :return: generator of ((xoff, yoff, xsize, ysize), ndarray) with the ndarray laid out like
+        fetch_imagery_array's result
+        """
+        if polygon_boundary_wkb:
+            envelope_boundary = self.__get_polygon_envelope(polygon_boundary_wkb, boundary_cs)
+
+        if self.__is_auto_scale(scale_params):
+            scale_params = self.get_auto_scale_params(band_definitions, output_type)
+
+        _, _, _, blocks, _ = self.__get_blocks(band_definitions,
+                                               scale_params=scale_params,
+                                               polygon_boundary_wkb=polygon_boundary_wkb,
+                                               envelope_boundary=envelope_boundary,
+                                               output_type=output_type,
+                                               spatial_resolution_m=spatial_resolution_m,
+                                               block_size=block_size,
+                                               boundary_cs=boundary_cs,
+                                               cutline_mode=cutline_mode)
+        yield from blocks
+
+    def iter_imagery_chunks(self,
+                            band_definitions,
+                            scale_params=None,
+                            polygon_boundary_wkb: bytes=None,
+                            envelope_boundary: tuple=None,
+                            boundary_cs=4326,
+                            output_type: DataType=DataType.BYTE,
+                            spatial_resolution_m=60,
+                            chunk_rows=256,
+                            b_raw_buffer=True,
+                            compression: Compression=Compression.NONE,
+                            cutline_mode: CutlineMode=CutlineMode.WARP) -> Generator[epl_imagery_pb2.NDArrayChunk,
+                                                                                     None, None]:
+        """
+        Stream the result of fetch_imagery_array as NDArrayChunk messages of chunk_rows full width rows, for a
+        server streaming response. Chunks are encoded as they're read, so memory is bounded by the chunk size, not
+        the result. See ndarray_result.assemble_ndarray_chunks for the client side.
+        :param chunk_rows: rows of the result in each chunk, the last chunk has what's left
+        :param b_raw_buffer: send each chunk's pixels as a raw buffer, see ndarray_result.to_ndarray_result
+        :param compression: compression of each chunk's raw buffer
+        :param cutline_mode: how polygon_boundary_wkb is applied, see iter_imagery_blocks
+        """
+        if polygon_boundary_wkb:
+            envelope_boundary = self.__get_polygon_envelope(polygon_boundary_wkb, boundary_cs)
+
+        if self.__is_auto_scale(scale_params):
+            scale_params = self.get_auto_scale_params(band_definitions, output_type)
+
+        (x_size, y_size), band_count, dtype, blocks, _ = self.__get_blocks(band_definitions,
+                                                                           scale_params=scale_params,
+                                                                           polygon_boundary_wkb=polygon_boundary_wkb,
+                                                                           envelope_boundary=envelope_boundary,
+                                                                           output_type=output_type,
+                                                                           spatial_resolution_m=spatial_resolution_m,
+                                                                           block_size=(None, chunk_rows),
+                                                                           boundary_cs=boundary_cs,
+                                                                           cutline_mode=cutline_mode)
+        b_interleave = len(band_definitions) >= 3
+        shape = self.__get_array_shape(band_count, (0, 0, x_size, y_size), b_interleave)
+        # rows are the first axis, except for (band, y, x) results
+        y_axis = 1 if len(shape) == 3 and not b_interleave else 0
+
+        try:
+            for window, nda in blocks:
+                offset = [0] * len(shape)
+                offset[y_axis] = window[1]
+                yield to_ndarray_chunk(shape, offset, nda, b_raw_buffer=b_raw_buffer, compression=compression)
+        finally:
+            # closed early, this stops the block read ahead
+            blocks.close()
+
+    def export_cog(self,
+                   file_path: str,
+                   band_definitions,
+                   scale_params=None,
+                   polygon_boundary_wkb: bytes=None,
+                   envelope_boundary: tuple=None,
+                   boundary_cs=4326,
+                   output_type: DataType=DataType.BYTE,
+                   spatial_resolution_m=60,
+                   cutline_mode: CutlineMode=CutlineMode.WARP,
+                   compression: Compression=Compression.DEFLATE,
+                   compression_level: int=None,
+                   threads="ALL_CPUS",
+                   block_size=512,
+                   overview_resampling="AVERAGE",
+                   temporary_directory: str=None):
+        """
+        Write the result of fetch_imagery_array as a cloud optimized GeoTIFF with internal overviews. Blocks from
+        iter_imagery_blocks are written to a temporary tiled GeoTIFF as they're read, then the COG driver copies it
+        into place, building the overviews and compressing on threads, so only a couple of blocks are ever held in
+        memory however large the export is. It's all done with the IOProfile.BULK_EXPORT GDAL config.
+        :param file_path: the COG to write, a local path or a GDAL virtual file system path (/vsigs/, /vsis3/)
+        :param cutline_mode: how polygon_boundary_wkb is applied, see iter_imagery_blocks
+        :param compression: DEFLATE, ZSTD or NONE
+        :param compression_level: DEFLATE 1 to 9 or ZSTD 1 to 22, None for GDAL's default
+        :param threads: compression and overview threads, a number or "ALL_CPUS"
+        :param block_size: width and height of the COG's tiles and of the blocks read
+        :param overview_resampling: gdal resampling of the overviews
+        :param temporary_directory: where the temporary GeoTIFF is written, the directory of file_path if it's
+        local, otherwise the system temporary directory. It needs room for the uncompressed export
+        """
+        if compression not in (Compression.DEFLATE, Compression.ZSTD, Compression.NONE):
+            raise ValueError("{} isn't a GeoTIFF compression".format(compression.name))
+
+        if polygon_boundary_wkb:
+            envelope_boundary = self.__get_polygon_envelope(polygon_boundary_wkb, boundary_cs)
+
+        if self.__is_auto_scale(scale_params):
+            scale_params = self.get_auto_scale_params(band_definitions, output_type)
+
+        # the block reads pick the config up on their thread as well
+        with GDALConfig(IOProfile.BULK_EXPORT):
+            (x_size, y_size), band_count, dtype, blocks, (geo_transform, projection) = self.__get_blocks(
+                band_definitions,
+                scale_params=scale_params,
+                polygon_boundary_wkb=polygon_boundary_wkb,
+                envelope_boundary=envelope_boundary,
+                output_type=output_type,
+                spatial_resolution_m=spatial_resolution_m,
+                block_size=block_size,
+                boundary_cs=boundary_cs,
+                cutline_mode=cutline_mode)
+
+            if temporary_directory is None:
+                temporary_directory = tempfile.gettempdir() if file_path.startswith("/vsi") else \
+                    os.path.dirname(os.path.abspath(file_path))
+            temporary_path = os.path.join(temporary_directory, "{}.export.tif".format(uuid.uuid4()))
+
+            gtiff = gdal.GetDriverByName("GTiff")
+            # the temporary file is only ever read back once, it's written with the cheapest compression
+            temporary = gtiff.Create(temporary_path, x_size, y_size, band_count,
+                                     gdal_array.NumericTypeCodeToGDALTypeCode(dtype),
+                                     options=["TILED=YES",
+                                              "BLOCKXSIZE={}".format(block_size),
+                                              "BLOCKYSIZE={}".format(block_size),
+                                              "COMPRESS=LZW",
+                                              "BIGTIFF=YES"])
+            if temporary is None:
+                raise IOError("couldn't create {0}: {1}".format(temporary_path, gdal.GetLastErrorMsg()))
+
+            try:
+                temporary.SetGeoTransform(geo_transform)
+                temporary.SetProjection(projection)
+                b_alpha_channel = Band.ALPHA in band_definitions
+                for band_index in range(band_count):
+                    band = temporary.GetRasterBand(band_index + 1)
+                    if b_alpha_channel and band_index == band_count - 1:
+                        band.SetColorInterpretation(gdal.GCI_AlphaBand)
+                    elif not b_alpha_channel:
+                        band.SetNoDataValue(0)
+
+                b_interleave = len(band_definitions) >= 3
+                for (x_offset, y_offset, _, _), block in blocks:
+                    for band_index in range(band_count):
+                        if b_interleave:
+                            band_block = block[:, :, band_index]
+                        else:
+                            band_block = block if block.ndim == 2 else block[band_index]
+                        temporary.GetRasterBand(band_index + 1).WriteArray(band_block, x_offset, y_offset)
+                temporary.FlushCache()
+
+                self.__write_cog(file_path, temporary, compression, compression_level, threads, block_size,
+                                 overview_resampling)
+            finally:
+                temporary = None
+                gtiff.Delete(temporary_path)
+
+    @staticmethod
+    def __write_cog(file_path: str,
+                    dataset,
+                    compression: Compression,
+                    compression_level: int,
+                    threads,
+                    block_size,
+                    overview_resampling):
+        if compression is Compression.NONE:
+            options = ["COMPRESS=NONE"]
+        else:
+            options = ["COMPRESS={}".format(compression.name), "PREDICTOR=YES"]
+        options += ["NUM_THREADS={}".format(threads), "BIGTIFF=IF_SAFER"]
+
+        cog = gdal.GetDriverByName("COG")
+        if cog is not None:
+            if compression_level is not None:
+                options.append("LEVEL={}".format(compression_level))
+            written = cog.CreateCopy(file_path,
+                                     dataset,
+                                     options=options + ["BLOCKSIZE={}".format(block_size),
+                                                        "OVERVIEWS=AUTO",
+                                                        "RESAMPLING={}".format(overview_resampling)])
+        else:
+            # before GDAL 3.1 there's no COG driver, a GeoTIFF copied with its overviews has the same layout
+            factors = []
+            factor = 2
+            while max(dataset.RasterXSize, dataset.RasterYSize) / factor >= block_size:
+                factors.append(factor)
+                factor *= 2
+            with GDALConfig(GDAL_NUM_THREADS=threads):
+                dataset.BuildOverviews(overview_resampling, factors)
+
+            options = [option.replace("PREDICTOR=YES", "PREDICTOR=2") for option in options]
+            if compression_level is not None:
+                options.append("{0}={1}".format("ZSTD_LEVEL" if compression is Compression.ZSTD else "ZLEVEL",
+                                                compression_level))
+            written = gdal.GetDriverByName("GTiff").CreateCopy(file_path,
+                                                                dataset,
+                                                                options=options + ["TILED=YES",
+                                                                                   "BLOCKXSIZE={}".format(block_size),
+                                                                                   "BLOCKYSIZE={}".format(block_size),
+                                                                                   "COPY_SRC_OVERVIEWS=YES"])
+        if written is None:
+            raise IOError("couldn't write {0}: {1}".format(file_path, gdal.GetLastErrorMsg()))
+        # closing finishes the file, and the upload of a /vsi path
+        written.FlushCache()
+        del written
+
+    def __get_blocks(self,
+                     band_definitions,
+                     scale_params,
+                     polygon_boundary_wkb: bytes,
+                     envelope_boundary: tuple,
+                     output_type: DataType,
+                     spatial_resolution_m,
+                     block_size,
+                     boundary_cs=4326,
+                     cutline_mode: CutlineMode=CutlineMode.WARP):
+        """
+        Build the virtual dataset for iter_imagery_blocks
+        :param block_size: width and height of the blocks, or a (width, height) tuple where None is the whole width or
+        height
+        :return: ((x_size, y_size), band_count, dtype, generator of blocks, (geo_transform, projection))
+        """
+        dataset, dependencies, band_count, dtype, read_block = self.__get_window_reader(band_definitions,
+                                                                                        scale_params,
+                                                                                        polygon_boundary_wkb,
+                                                                                        envelope_boundary,
+                                                                                        output_type,
+                                                                                        spatial_resolution_m,
+                                                                                        boundary_cs,
+                                                                                        cutline_mode)
+        block_x_size, block_y_size = block_size if isinstance(block_size, tuple) else (block_size, block_size)
+        block_x_size = max(block_x_size or dataset.RasterXSize, 1)
+        block_y_size = max(block_y_size or dataset.RasterYSize, 1)
+        windows = [(x_offset,
+                    y_offset,
+                    min(block_x_size, dataset.RasterXSize - x_offset),
+                    min(block_y_size, dataset.RasterYSize - y_offset))
+                   for y_offset in range(0, dataset.RasterYSize, block_y_size)
+                   for x_offset in range(0, dataset.RasterXSize, block_x_size)]
+
+        def blocks():
+            nonlocal dataset, dependencies
+            # config options are thread local, the innermost GDALConfig of the thread iterating is entered again on
+            # the reading thread
+            config = GDALConfig.current()
+
+            def read_configured_block(window):
+                if config is None:
+                    return read_block(window)
+                with config:
+                    return read_block(window)
+
+            try:
+                if windows:
+                    # a single worker reads ahead one block. datasets aren't safe for concurrent reads, but reading
+                    # from one thread at a time is fine. Closing the generator waits for the block being read
+                    with ThreadPoolExecutor(max_workers=1) as executor:
+                        future = executor.submit(read_configured_block, windows[0])
+                        for next_window in windows[1:] + [None]:
+                            block = future.result()
+                            if next_window:
+                                future = executor.submit(read_configured_block, next_window)
+                            yield block
+            finally:
+                dataset = None
+                dependencies = None
+
+        return (dataset.RasterXSize, dataset.RasterYSize), band_count, dtype, blocks(), \
+            (dataset.GetGeoTransform(), dataset.GetProjection())
+
+    def __get_window_reader(self,
+                            band_definitions,
+                            scale_params,
+                            polygon_boundary_wkb: bytes,
+                            envelope_boundary: tuple,
+                            output_type: DataType,
+                            spatial_resolution_m,
+                            boundary_cs=4326,
+                            cutline_mode: CutlineMode=CutlineMode.WARP,
+                            envelope_cs=4326):
+        """
+        Build a virtual dataset and a function that reads any window of it laid out like fetch_imagery_array's
+        result, with band math evaluated, alpha added and the polygon applied as cutline_mode says
+        :param envelope_cs: epsg code of envelope_boundary
+        :return: (dataset, dependencies to keep open with it, band_count, dtype, function of a window that returns
+        (window, ndarray))
+        """
+        # band math blocks are evaluated from their unscaled Float32 sources, then scaled like get_dataset does
+        b_band_math = self.__has_band_math(band_definitions)
+        sources = self.__get_band_math_sources(band_definitions) if b_band_math else None
+        # the same choice as __fetch_imagery_array, the mask is rasterized for each window
+        b_raster_mask = polygon_boundary_wkb is not None and \
+            cutline_mode is CutlineMode.RASTER_MASK and \
+            len(self.__metadata) == 1
+
+        dataset, dependencies = self.__get_virtual_dataset(sources if b_band_math else band_definitions,
+                                                           output_type=DataType.FLOAT32 if b_band_math else output_type,
+                                                           scale_params=None if b_band_math else scale_params,
+                                                           envelope_boundary=envelope_boundary,
+                                                           polygon_boundary_wkb=None if b_raster_mask else
+                                                           polygon_boundary_wkb,
+                                                           spatial_resolution_m=spatial_resolution_m,
+                                                           envelope_cs=envelope_cs,
+                                                           boundary_cs=boundary_cs)
+
+        vrt_options = self.__get_vrt_options(band_definitions)
+        b_alpha_channel = Band.ALPHA in band_definitions
+        b_interleave = len(band_definitions) >= 3
+
+        band_count = len(band_definitions) if b_band_math else dataset.RasterCount + (1 if b_alpha_channel else 0)
+        dtype = gdal_array.GDALTypeCodeToNumericTypeCode(output_type.gdal if b_band_math else
+                                                         dataset.GetRasterBand(1).DataType)
+
+        if b_band_math and self.__has_computed_scale(scale_params):
+            # gdal.Translate would compute a missing source range from each block alone. The range of the whole
+            # request is found first, evaluating strips of it, which reads the sources twice
+            ranges = None
+            strip_rows = 256
+            with GDALConfig(**vrt_options):
+                for y_offset in range(0, dataset.RasterYSize, strip_rows):
+                    window = (0, y_offset, dataset.RasterXSize, min(strip_rows, dataset.RasterYSize - y_offset))
+                    evaluated = self.__get_evaluated_dataset(band_definitions, sources, dataset, window)
+                    ranges = self.__get_value_ranges(evaluated, ranges)
+                    del evaluated
+            if ranges:
+                scale_params = self.__resolve_scale_params(scale_params, ranges)
+
+        def read_block(window):
+            nda = np.empty(self.__get_array_shape(band_count, window, b_interleave), dtype=dtype)
+            # config options are thread local, so they're set again on the reading thread
+            with GDALConfig(**vrt_options):
+                if b_band_math:
+                    evaluated = self.__get_evaluated_dataset(band_definitions, sources, dataset, window)
+                    translated = gdal.Translate('', evaluated,
+                                                format='MEM',
+                                                scaleParams=scale_params,
+                                                outputType=output_type.gdal,
+                                                noData=0)
+                    self.__read_into(translated, nda, (0, 0, window[2], window[3]), b_interleave)
+                    del evaluated
+                    del translated
+                else:
+                    self.__read_into(dataset, nda, window, b_interleave)
+
+                if b_alpha_channel:
+                    alpha = self.__get_alpha(dataset, output_type, window)
+                    if b_interleave:
+                        nda[:, :, -1] = alpha
+                    else:
+                        nda[-1] = alpha
+
+            if b_raster_mask:
+                mask = self.get_cutline_mask(polygon_boundary_wkb, dataset, boundary_cs=boundary_cs, window=window)
+                if b_interleave:
+                    nda[~mask] = 0
+                else:
+                    nda[..., ~mask] = 0
+
+            return window, nda
+
+        return dataset, dependencies, band_count, dtype, read_block
+
+    def fetch_imagery_arrays(self,
+                             band_definitions,
+                             boundaries: list,
+                             scale_params=None,
+                             boundary_cs=4326,
+                             output_type: DataType=DataType.BYTE,
+                             spatial_resolution_m=60) -> list:
+        """
+        Read many areas of interest from one scene at once. The virtual dataset is built once for the union of the
+        areas, the pixel windows of areas that overlap are merged, and each merged window is read once and sliced into
+        the areas it covers, so a small area costs little more than its pixels. Results are on the scene's grid, laid
+        out like fetch_imagery_array's result, with the pixels outside of a polygon set to 0.
+        :param boundaries: polygon wkb (bytes) or envelope tuples (minx, miny, maxx, maxy), in boundary_cs
+        :return: list of ndarrays, one per boundary, in order. An area outside of the scene has a 0 width or height
+        """
+        if len(self.__metadata) != 1:
+            raise ValueError("fetch_imagery_arrays reads from a single scene, not {}".format(len(self.__metadata)))
+
+        if self.__is_auto_scale(scale_params):
+            scale_params = self.get_auto_scale_params(band_definitions, output_type)
+
+        envelopes = [shapely.wkb.loads(boundary).bounds if isinstance(boundary, bytes) else tuple(boundary)
+                     for boundary in boundaries]
+        if not envelopes:
+            return []
+        union = (min(envelope[0] for envelope in envelopes),
+                 min(envelope[1] for envelope in envelopes),
+                 max(envelope[2] for envelope in envelopes),
+                 max(envelope[3] for envelope in envelopes))
+
+        # the union is clipped in boundary_cs, the same coordinate system the windows are projected from
+        dataset, dependencies, band_count, dtype, read_window = self.__get_window_reader(band_definitions,
+                                                                                         scale_params,
+                                                                                         None,
+                                                                                         union,
+                                                                                         output_type,
+                                                                                         spatial_resolution_m,
+                                                                                         boundary_cs=boundary_cs,
+                                                                                         envelope_cs=boundary_cs)
+        windows = self.__get_aoi_windows(envelopes, boundary_cs, dataset)
+        b_interleave = len(band_definitions) >= 3
+
+        results = [None] * len(boundaries)
+        for merged, indices in self.__merge_windows(windows):
+            _, nda = read_window(merged)
+            for index in indices:
+                x_offset, y_offset, x_size, y_size = windows[index]
+                rows = slice(y_offset - merged[1], y_offset - merged[1] + y_size)
+                columns = slice(x_offset - merged[0], x_offset - merged[0] + x_size)
+                aoi = np.ascontiguousarray(nda[rows, columns] if b_interleave or nda.ndim == 2 else
+                                           nda[:, rows, columns])
+                if isinstance(boundaries[index], bytes):
+                    outside = ~self.get_cutline_mask(boundaries[index], dataset, boundary_cs, window=windows[index])
+                    if b_interleave or aoi.ndim == 2:
+                        aoi[outside] = 0
+                    else:
+                        aoi[:, outside] = 0
+                results[index] = aoi
+
+        for index, window in enumerate(windows):
+            if results[index] is None:
+                results[index] = np.zeros(self.__get_array_shape(band_count, window, b_interleave), dtype=dtype)
+
+        dataset = None
+        dependencies = None
+        return results
+
+    def __get_aoi_windows(self, envelopes: list, boundary_cs: int, dataset) -> list:
+        """
+        Pixel windows of the dataset that cover each envelope, clipped to the dataset. The corners and edge midpoints
+        of an envelope are projected, since its edges aren't straight lines in the dataset's projection
+        """
+        inverse = gdal.InvGeoTransform(dataset.GetGeoTransform())
+        windows = []
+        for min_x, min_y, max_x, max_y in envelopes:
+            mid_x, mid_y = (min_x + max_x) / 2.0, (min_y + max_y) / 2.0
+            outline = np.array([(min_x, min_y), (mid_x, min_y), (max_x, min_y), (max_x, mid_y),
+                                (max_x, max_y), (mid_x, max_y), (min_x, max_y), (min_x, mid_y)], dtype=np.float64)
+            projected = self.__project_points(outline, boundary_cs, dataset.GetProjection())
+            columns = inverse[0] + projected[:, 0] * inverse[1] + projected[:, 1] * inverse[2]
+            rows = inverse[3] + projected[:, 0] * inverse[4] + projected[:, 1] * inverse[5]
+
+            x_start = min(max(int(math.floor(columns.min())), 0), dataset.RasterXSize)
+            x_stop = min(max(int(math.ceil(columns.max())), x_start), dataset.RasterXSize)
+            y_start = min(max(int(math.floor(rows.min())), 0), dataset.RasterYSize)
+            y_stop = min(max(int(math.ceil(rows.max())), y_start), dataset.RasterYSize)
+            windows.append((x_start, y_start, x_stop - x_start, y_stop - y_start))
+        return windows
+
+    @staticmethod
+    def __merge_windows(windows: list) -> list:
+        """
+        Merge windows that overlap into their bounding windows until none of them overlap, so pixels shared by several
+        areas are only read once. Empty windows aren't read.
+        :return: list of (merged window, indices of the windows it covers)
+        """
+        merged = [((x, y, x + x_size, y + y_size), [index])
+                  for index, (x, y, x_size, y_size) in enumerate(windows) if x_size and y_size]
+        b_changed = True
+        while b_changed:
+            b_changed = False
+            for i in range(len(merged)):
+                for j in range(len(merged) - 1, i, -1):
+                    a, b = merged[i][0], merged[j][0]
+                    if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                        merged[i] = ((min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])),
+                                     merged[i][1] + merged[j][1])
+                        del merged[j]
+                        b_changed = True
+
+        return [((bounds[0], bounds[1], bounds[2] - bounds[0], bounds[3] - bounds[1]), indices)
+                for bounds, indices in merged]
+
+    def fetch_time_series(self,
+                          band_definitions,
+                          scale_params=None,
+                          polygon_boundary_wkb: bytes=None,
+                          envelope_boundary: tuple=None,
+                          boundary_cs=4326,
+                          output_type: DataType=DataType.BYTE,
+                          spatial_resolution_m=60,
+                          target_cs: int=None,
+                          out=None,
+                          max_workers=4):
+        """
+        Read each scene as its own frame instead of mosaicking them. Every frame is warped onto one grid: the
+        envelope_boundary (or the polygon's bounds) in target_cs at spatial_resolution_m, so scenes from different
+        UTM zones line up pixel for pixel. Scenes are read in parallel.
+        :param target_cs: epsg code of the grid, the projection of the first scene if None
+        :param out: where to write the frames, shape (time, band, y, x). An ndarray is read into directly, anything
+        else that takes out[time] = (band, y, x) ndarray (np.memmap, a zarr array chunked by time) is written frame by
+        frame. Allocated if None
+        :param max_workers: number of scenes read at once
+        :return: out, frames in the order of the Metadata this Landsat was made with
+        """
+        if polygon_boundary_wkb:
+            envelope_boundary = shapely.wkb.loads(polygon_boundary_wkb).bounds
+        if not envelope_boundary:
+            raise ValueError("a time series needs an envelope_boundary or polygon_boundary_wkb for its grid")
+
+        if self.__is_auto_scale(scale_params):
+            # one stretch for every frame, so values are comparable over time
+            scale_params = self.get_auto_scale_params(band_definitions, output_type)
+
+        if target_cs:
+            target_srs = osr.SpatialReference()
+            target_srs.ImportFromEPSG(target_cs)
+            target_projection = target_srs.ExportToWkt()
+        else:
+            self.storage.mount_sub_folder(self.__metadata[0], request_key=str(self.__id))
+            target_projection = self.__calculate_metadata(self.__metadata[0], band_definitions).projection
+
+        grid_bounds = self.__get_grid_bounds(envelope_boundary, boundary_cs, target_projection, spatial_resolution_m)
+        x_size = int(round((grid_bounds[2] - grid_bounds[0]) / spatial_resolution_m))
+        y_size = int(round((grid_bounds[3] - grid_bounds[1]) / spatial_resolution_m))
+
+        frame_definitions = [band_definition for band_definition in band_definitions if band_definition is not Band.ALPHA]
+        b_alpha_channel = Band.ALPHA in band_definitions
+        shape = (len(self.__metadata), len(band_definitions), y_size, x_size)
+        if out is None:
+            out = np.empty(shape, dtype=output_type.numpy_type)
+        elif tuple(out.shape) != shape:
+            raise ValueError("out must have shape {0}, not {1}".format(shape, tuple(out.shape)))
+        b_direct = isinstance(out, np.ndarray)
+
+        b_band_math = self.__has_band_math(band_definitions)
+        vrt_options = self.__get_vrt_options(band_definitions)
+
+        def read_frame(frame_index):
+            frame = Landsat(self.__metadata[frame_index])
+            with GDALConfig(**vrt_options):
+                if b_band_math:
+                    source, dependencies = frame.__get_dataset(frame_definitions,
+                                                               output_type=output_type,
+                                                               scale_params=scale_params,
+                                                               envelope_boundary=envelope_boundary,
+                                                               spatial_resolution_m=spatial_resolution_m), []
+                else:
+                    source, dependencies = frame.__get_virtual_dataset(frame_definitions,
+                                                                       output_type=output_type,
+                                                                       scale_params=scale_params,
+                                                                       envelope_boundary=envelope_boundary,
+                                                                       spatial_resolution_m=spatial_resolution_m)
+
+                cutlineDSName = self.__create_cutline(polygon_boundary_wkb, boundary_cs)
+                warped = gdal.Warp("",
+                                   source,
+                                   format='MEM',
+                                   dstSRS=target_projection,
+                                   outputBounds=grid_bounds,
+                                   xRes=spatial_resolution_m,
+                                   yRes=spatial_resolution_m,
+                                   multithread=True,
+                                   warpMemoryLimit=GDALConfig.warp_memory_limit(),
+                                   cutlineDSName=cutlineDSName,
+                                   outputType=output_type.gdal,
+                                   dstNodata=0)
+                if cutlineDSName:
+                    gdal.Unlink(cutlineDSName)
+                del source
+                del dependencies
+
+            frame_nda = out[frame_index] if b_direct else np.empty(shape[1:], dtype=output_type.numpy_type)
+            self.__read_into(warped, frame_nda, (0, 0, x_size, y_size), False)
+            if b_alpha_channel:
+                frame_nda[-1] = self.__get_alpha(warped, output_type)
+            del warped
+            return frame_index, frame_nda
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(read_frame, frame_index) for frame_index in range(len(self.__metadata))]
+            for future in as_completed(futures):
+                frame_index, frame_nda = future.result()
+                if not b_direct:
+                    # stores like zarr are written from this thread only
+                    out[frame_index] = frame_nda
+
+        return out
+
+    def sample_points(self,
+                      points,
+                      band_definitions,
+                      points_cs=4326,
+                      max_workers=8) -> np.ndarray:
+        """
+        Pixel drill: the unscaled values of the bands at each point, in every scene. Points are mapped into each band
+        file's pixel grid with its cached geotransform and grouped by the file's blocks, so only the blocks that
+        contain a point are read, whatever the distance between the points.
+        :param points: shapely Points, (x, y) tuples or an (n, 2) ndarray, in points_cs
+        :param band_definitions: bands, band numbers and band math expressions (not python functions or alpha)
+        :param points_cs: epsg code of the points
+        :param max_workers: number of band files read at once
+        :return: float32 ndarray of shape (point, time, band), NaN where a point is outside of a scene
+        """
+        for band_definition in band_definitions:
+            if band_definition is Band.ALPHA or \
+                    (isinstance(band_definition, FunctionDetails) and not band_definition.expression):
+                raise ValueError("points can be sampled from bands and band math expressions, not {}".format(
+                    band_definition))
+
+        coordinates = np.array([(point.x, point.y) if hasattr(point, 'x') else point for point in points],
+                               dtype=np.float64).reshape((-1, 2))
+        sources = self.__get_band_math_sources(band_definitions)
+        source_values = np.full((len(coordinates), len(self.__metadata), len(sources)), np.nan, dtype=np.float32)
+
+        projected = {}
+        tasks = []
+        for time_index, metadata in enumerate(self.__metadata):
+            if self.storage.mount_sub_folder(metadata, request_key=str(self.__id)) is False:
+                continue
+
+            raster = self.__calculate_metadata(metadata, sources)
+            if raster.projection not in projected:
+                projected[raster.projection] = self.__project_points(coordinates, points_cs, raster.projection)
+
+            for source_index, source in enumerate(sources):
+                band_number = metadata.band_map.get_number(source) if isinstance(source, Band) else source
+                tasks.append((time_index, source_index, raster.get_metadata(band_number), projected[raster.projection]))
+
+        def sample(task):
+            time_index, source_index, band_raster, xy = task
+            return time_index, source_index, self.__sample_band_file(band_raster.file_path, band_raster.geo_transform, xy)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for time_index, source_index, values in executor.map(sample, tasks):
+                source_values[:, time_index, source_index] = values
+
+        result = np.empty((len(coordinates), len(self.__metadata), len(band_definitions)), dtype=np.float32)
+        for band_index, band_definition in enumerate(band_definitions):
+            if isinstance(band_definition, FunctionDetails):
+                arrays = {get_band_name(source): source_values[:, :, sources.index(source)]
+                          for source in band_definition.band_definitions}
+                band_definition.band_expression.evaluate(arrays, result[:, :, band_index])
+                outside = np.zeros(result.shape[:2], dtype=bool)
+                for array in arrays.values():
+                    outside |= np.isnan(array)
+                result[:, :, band_index][outside] = np.nan
+            else:
+                result[:, :, band_index] = source_values[:, :, sources.index(band_definition)]
+        return result
+
+    @staticmethod
+    def __project_points(coordinates: np.ndarray, points_cs: int, projection: str) -> np.ndarray:
+        source_srs = osr.SpatialReference()
+        source_srs.ImportFromEPSG(points_cs)
+        target_srs = osr.SpatialReference()
+        target_srs.ImportFromWkt(projection)
+        if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+            source_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+            target_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        transform = osr.CoordinateTransformation(source_srs, target_srs)
+        return np.array([transform.TransformPoint(x, y)[:2] for x, y in coordinates], dtype=np.float64).reshape((-1, 2))
+
+    @staticmethod
+    def __sample_band_file(file_path: str, geo_transform: tuple, xy: np.ndarray) -> np.ndarray:
+        """
+        Values of band 1 of a file at the projected points, reading each block that holds a point once
+        :return: float32 ndarray, NaN for points outside of the file
+        """
+        values = np.full(len(xy), np.nan, dtype=np.float32)
+        dataset = gdal.Open(file_path)
+        band = dataset.GetRasterBand(1)
+        x_size, y_size = dataset.RasterXSize, dataset.RasterYSize
+        block_x_size, block_y_size = band.GetBlockSize()
+
+        columns = np.floor((xy[:, 0] - geo_transform[0]) / geo_transform[1]).astype(np.int64)
+        rows = np.floor((xy[:, 1] - geo_transform[3]) / geo_transform[5]).astype(np.int64)
+        inside = np.flatnonzero((columns >= 0) & (columns < x_size) & (rows >= 0) & (rows < y_size))
+
+        block_columns = (x_size + block_x_size - 1) // block_x_size
+        block_keys = (rows[inside] // block_y_size) * block_columns + columns[inside] // block_x_size
+        order = np.argsort(block_keys, kind='stable')
+        keys, starts = np.unique(block_keys[order], return_index=True)
+        for key, group in zip(keys, np.split(inside[order], starts[1:])):
+            block_row, block_column = divmod(int(key), block_columns)
+            x_offset, y_offset = block_column * block_x_size, block_row * block_y_size
+            block = band.ReadAsArray(x_offset,
+                                     y_offset,
+                                     min(block_x_size, x_size - x_offset),
+                                     min(block_y_size, y_size - y_offset))
+            values[group] = block[rows[group] - y_offset, columns[group] - x_offset]
+
+        del dataset
+        return values
+
+    @staticmethod
+    def __get_grid_bounds(envelope_boundary: tuple, boundary_cs: int, target_projection: str, resolution) -> tuple:
+        """
+        The envelope transformed to the target projection (its edges are densified, a lat/lon box isn't a box in
+        UTM) and snapped outwards to multiples of the resolution
+        :return: (xmin, ymin, xmax, ymax)
+        """
+        source_srs = osr.SpatialReference()
+        source_srs.ImportFromEPSG(boundary_cs)
+        target_srs = osr.SpatialReference()
+        target_srs.ImportFromWkt(target_projection)
+        if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+            source_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+            target_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        transform = osr.CoordinateTransformation(source_srs, target_srs)
+
+        xmin, ymin, xmax, ymax = envelope_boundary
+        steps = np.linspace(0.0, 1.0, 21)
+        edge_points = [(xmin + (xmax - xmin) * step, y) for step in steps for y in (ymin, ymax)] + \
+                      [(x, ymin + (ymax - ymin) * step) for step in steps for x in (xmin, xmax)]
+        projected = np.array([transform.TransformPoint(x, y)[:2] for x, y in edge_points])
+
+        return (math.floor(projected[:, 0].min() / resolution) * resolution,
+                math.floor(projected[:, 1].min() / resolution) * resolution,
+                math.ceil(projected[:, 0].max() / resolution) * resolution,
+                math.ceil(projected[:, 1].max() / resolution) * resolution)
+
     def __get_warped(self,
                      dataset_translated: ogr,
                      output_type: DataType,
+                     spatial_resolution_m,
                      polygon_boundary_wkb: bytes=None,
-                     dstAlpha: bool=False):
-        cutlineDSName = None
-        if polygon_boundary_wkb:
-            cutlineDSName = '/vsimem/cutline.json'
-            cutline_ds = ogr.GetDriverByName('GeoJSON').CreateDataSource(cutlineDSName)
-            cutline_lyr = cutline_ds.CreateLayer('cutline')
-            f = ogr.Feature(cutline_lyr.GetLayerDefn())
-
-            f.SetGeometry(ogr.CreateGeometryFromWkb(polygon_boundary_wkb))
-            cutline_lyr.CreateFeature(f)
-            f = None
-            cutline_lyr = None
-            cutline_ds = None
+                     dstAlpha: bool=False,
+                     boundary_cs=4326):
+        cutlineDSName = self.__create_cutline(polygon_boundary_wkb, boundary_cs)
 
         dataset_warped = gdal.Warp("",
                                    dataset_translated,
                                    format='MEM',
                                    multithread=True,
-                                   cutlineDSName=cutlineDSName,
-                                   outputType=output_type.gdal,
-                                   dstAlpha=dstAlpha)
+                                   dstAlpha=dstAlpha,
+                                   **self.__get_warp_options(dataset_translated,
+                                                             output_type,
+                                                             spatial_resolution_m,
+                                                             cutlineDSName))
 
+        if cutlineDSName:
+            gdal.Unlink(cutlineDSName)
 
         return dataset_warped
 
+    @staticmethod
+    def __get_warp_options(dataset_translated: list, output_type: DataType, spatial_resolution_m, cutlineDSName) -> dict:
+        """
+        gdal.Warp options shared by __get_warped and __get_virtual_dataset, so a mosaic or cutline lands on the same
+        grid whether it's warped in one go or scene by scene. It's the grid gdal.Warp picks on its own, which
+        get_dataset mosaics have always had: the first scene's projection at spatial_resolution_m, from the top left
+        corner of the union of the scenes, rounded to whole pixels (so a single scene keeps its own grid). Only scenes
+        in other projections differ, gdal.Warp's resolution for them was the finest of the reprojected scenes'. The
+        transformer is exact: the default approximation is interpolated over each chunk being warped, and chunks
+        differ between a MEM and a VRT warp.
+        """
+        projection = dataset_translated[0].GetProjection()
+
+        extents = []
+        for dataset in dataset_translated:
+            if dataset.GetProjection() != projection:
+                # gdal's suggested output in the first scene's projection, no pixels are read
+                dataset = gdal.Warp("", dataset, format='VRT', dstSRS=projection)
+            x_min, x_res, _, y_max, _, y_res = dataset.GetGeoTransform()
+            extents.append((x_min, y_max + y_res * dataset.RasterYSize, x_min + x_res * dataset.RasterXSize, y_max))
+
+        x_min = min(extent[0] for extent in extents)
+        y_max = max(extent[3] for extent in extents)
+        # rounded like gdalwarp sizes its output
+        x_size = int((max(extent[2] for extent in extents) - x_min) / spatial_resolution_m + 0.5)
+        y_size = int((y_max - min(extent[1] for extent in extents)) / spatial_resolution_m + 0.5)
+        output_bounds = (x_min,
+                         y_max - y_size * spatial_resolution_m,
+                         x_min + x_size * spatial_resolution_m,
+                         y_max)
+
+        return {'dstSRS': projection,
+                'xRes': spatial_resolution_m,
+                'yRes': spatial_resolution_m,
+                'outputBounds': output_bounds,
+                'errorThreshold': 0,
+                'warpMemoryLimit': GDALConfig.warp_memory_limit(),
+                'cutlineDSName': cutlineDSName,
+                'outputType': output_type.gdal,
+                'dstNodata': 0}
+
+    @classmethod
+    def __create_cutline(cls, polygon_boundary_wkb: bytes=None, boundary_cs=4326):
+        """
+        Write the polygon to a GeoJSON file in /vsimem for use as a warp cutline. Each call gets its own file so
+        concurrent requests don't overwrite each other's cutlines. The caller unlinks it after the warp.
+        :param boundary_cs: epsg code of the polygon, the warp reprojects the cutline from it like get_cutline_mask
+        :return: the /vsimem path or None if there is no polygon
+        """
+        if not polygon_boundary_wkb:
+            return None
+
+        cutlineDSName = '/vsimem/cutline_{}.json'.format(uuid.uuid4().hex)
+        cutline_ds = ogr.GetDriverByName('GeoJSON').CreateDataSource(cutlineDSName)
+        cutline_lyr = cutline_ds.CreateLayer('cutline', srs=cls.__get_boundary_srs(boundary_cs))
+        f = ogr.Feature(cutline_lyr.GetLayerDefn())
+
+        f.SetGeometry(ogr.CreateGeometryFromWkb(polygon_boundary_wkb))
+        cutline_lyr.CreateFeature(f)
+        f = None
+        cutline_lyr = None
+        cutline_ds = None
+        return cutlineDSName
+
 
 class Sentinel2:
     bucket_name = ""
@@ -1317,11 +3192,12 @@ class MetadataService(metaclass=__Singleton):
             metadata_rows.append(Metadata(row, mount_base_path))
         return metadata_rows
 
-    def search(self,
-               satellite_id=None,
-               limit=10,
-               data_filters: MetadataFilters=None,
-               base_mount_path='/imagery') -> Generator[Metadata, None, None]:
+    def __get_search_filters(self, satellite_id, data_filters: MetadataFilters):
+        """
+        :return: (the filters of the search's query, the search area its rows are post filtered by)
+        """
+        if not data_filters:
+            data_filters = LandsatQueryFilters()
 
         if PLATFORM_PROVIDER == 'AWS':
             # this is really arbitrary, but we're saying any data before mid-year 2013 should be excluded
@@ -1329,13 +3205,77 @@ class MetadataService(metaclass=__Singleton):
             exclude_data_before = date(2013, 7, 1)
             data_filters.acquired.set_exclude_range(end=exclude_data_before)
 
-        if not data_filters:
-            data_filters = LandsatQueryFilters()
-
         if satellite_id and satellite_id is not SpacecraftID.UNKNOWN_SPACECRAFT:
             data_filters.spacecraft_id.set_value(satellite_id.name)
 
-        search_area_polygon = self.get_search_area(data_filters=data_filters)
+        return data_filters, self.get_search_area(data_filters=data_filters)
+
+    def __query_rows(self, query_string: str):
+        # TODO update to use bigquery asynchronous query.
+        query = self.m_client.run_sync_query(query_string)
+        query.timeout_ms = self.m_timeout_ms
+
+        # TODO this should moved into a method by itself and handled more elegantly
+        try:
+            query.run()
+        except exceptions.GoogleCloudError:
+            try:
+                query.run()
+                Warning("exceptions.GoogleCloudError:", sys.exc_info()[0])
+            except exceptions.GoogleCloudError:
+                raise
+        except ValueError:
+            raise
+
+        return query.rows
+
+    def __iter_pages(self, data_filters: MetadataFilters, limit):
+        """
+        Pages of up to limit rows from search_pipelined's query. The next page is queried before the rows of this one
+        are post filtered, so every row of a page is excluded from the queries after it, not only the ones yielded
+        like search does. Stops after an empty or short page
+        """
+        query_string = data_filters.get_sql(limit=limit)
+        while True:
+            # TODO sort by area
+            rows = self.__query_rows(query_string)
+            if len(rows) == 0:
+                return
+
+            yield rows
+            if len(rows) < limit:
+                return
+
+            for row in rows:
+                if row[0]:
+                    data_filters.scene_id.set_exclude_value(row[0])
+                if row[1]:
+                    data_filters.product_id.set_exclude_value(row[1])
+            query_string = data_filters.get_sql(limit=limit)
+
+    def __get_metadata(self, row, base_mount_path, search_area_polygon):
+        """
+        :return: the row's Metadata, None if its scene isn't in the search area or its files weren't found
+        """
+        try:
+            metadata = Metadata(row, base_mount_path)
+        except FileNotFoundError:
+            Warning("scene {0} / product {1} not found in aws".format(row[0], row[1]))
+            return None
+
+        if search_area_polygon is None or search_area_polygon.is_empty:
+            return metadata
+
+        wrs_wkb = self.m_wrs_geometry.get_wrs_geometry(wrs_path=metadata.wrs_path, wrs_row=metadata.wrs_row)
+        wrs_shape = shapely.wkb.loads(wrs_wkb)
+        return metadata if wrs_shape.intersects(search_area_polygon) else None
+
+    def search(self,
+               satellite_id=None,
+               limit=10,
+               data_filters: MetadataFilters=None,
+               base_mount_path='/imagery') -> Generator[Metadata, None, None]:
+        data_filters, search_area_polygon = self.__get_search_filters(satellite_id, data_filters)
 
         limit_found = 0
         query_string = data_filters.get_sql(limit=limit)
@@ -1346,45 +3286,15 @@ class MetadataService(metaclass=__Singleton):
             exclude_scene_id = []
             exclude_product_id = []
 
-            # TODO update to use bigquery asynchronous query.
-            query = self.m_client.run_sync_query(query_string)
-            query.timeout_ms = self.m_timeout_ms
-
-            # TODO this should moved into a method by itself and handled more elegantly
-            try:
-                query.run()
-            except exceptions.GoogleCloudError:
-                try:
-                    query.run()
-                    Warning("exceptions.GoogleCloudError:", sys.exc_info()[0])
-                except exceptions.GoogleCloudError:
-                    raise
-            except ValueError:
-                raise
-
-            if len(query.rows) == 0:
+            rows = self.__query_rows(query_string)
+            if len(rows) == 0:
                 return
-            elif len(query.rows) < limit:
+            elif len(rows) < limit:
                 b_limit_reached = True
 
-            for row in query.rows:
-                metadata = None
-                try:
-                    metadata = Metadata(row, base_mount_path)
-                except FileNotFoundError:
-                    Warning("scene {0} / product {1} not found in aws".format(row[0], row[1]))
-                    continue
-
-                if search_area_polygon is None or search_area_polygon.is_empty:
-                    exclude_scene_id.append(metadata.scene_id)
-                    exclude_product_id.append(metadata.product_id)
-                    limit_found += 1
-                    yield metadata
-                    continue
-
-                wrs_wkb = self.m_wrs_geometry.get_wrs_geometry(wrs_path=metadata.wrs_path, wrs_row=metadata.wrs_row)
-                wrs_shape = shapely.wkb.loads(wrs_wkb)
-                if wrs_shape.intersects(search_area_polygon):
+            for row in rows:
+                metadata = self.__get_metadata(row, base_mount_path, search_area_polygon)
+                if metadata is not None:
                     exclude_scene_id.append(metadata.scene_id)
                     exclude_product_id.append(metadata.product_id)
                     limit_found += 1
@@ -1405,6 +3315,104 @@ class MetadataService(metaclass=__Singleton):
                         data_filters.product_id.set_exclude_value(product_id)
                 query_string = data_filters.get_sql(limit=limit)
 
+    def search_pipelined(self,
+                         satellite_id=None,
+                         limit=10,
+                         data_filters: MetadataFilters=None,
+                         base_mount_path='/imagery',
+                         workers=4,
+                         prefetch_pages=1) -> Generator[Metadata, None, None]:
+        """
+        search with its steps overlapped, for streaming the results: the query for the next page runs on a
+        background thread while the rows of the pages before it are made into Metadata (globbing the mounted bucket
+        on AWS) and post filtered on workers threads. Metadata are yielded in the query's order, each as soon as it
+        and the ones before it are ready. The search runs on a copy of data_filters, which search adds its exclusions
+        to.
+
+        The pages aren't search's. Every row of a page is excluded from the queries after it, where search only
+        excludes the rows it yielded and queries the ones post filtering rejected again, so its later pages hold
+        fewer new rows (and a full page of rejected rows is queried over and over). With the query sorted (see
+        sort_by) both yield the first limit rows in that order that post filtering keeps. Unsorted, BigQuery returns
+        the rows in any order, and the two may yield different rows of the ones that match.
+
+        The steps are joined by bounded queues, so a consumer that reads slowly holds the query back: at most
+        prefetch_pages pages are queried ahead of the rows being made into Metadata, and a page's rows are only
+        started once fewer than workers are in flight. Closing the generator stops the query.
+        """
+        # the query thread adds exclusions to the filters while the caller may still be using them
+        data_filters, search_area_polygon = self.__get_search_filters(satellite_id, copy.deepcopy(data_filters))
+
+        pages = queue.Queue(maxsize=prefetch_pages)
+        stopped = threading.Event()
+        end = object()
+
+        def put(item) -> bool:
+            # wakes up now and then to see if the consumer has gone away
+            while not stopped.is_set():
+                try:
+                    pages.put(item, timeout=0.5)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def query():
+            try:
+                for rows in self.__iter_pages(data_filters, limit):
+                    if not put(rows):
+                        return
+                put(end)
+            except Exception as e:
+                put(e)
+
+        threading.Thread(target=query, daemon=True).start()
+
+        pending = deque()
+        limit_found = 0
+        b_query_done = False
+        query_error = None
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            while pending or not b_query_done:
+                # start the rows of the next page when the workers have room for them. only wait on the query
+                # when there's nothing in flight to hand over in the meantime
+                if not b_query_done and len(pending) < workers:
+                    try:
+                        page = pages.get(block=not pending)
+                    except queue.Empty:
+                        page = None
+
+                    if page is end:
+                        b_query_done = True
+                    elif isinstance(page, Exception):
+                        # raised once the rows before it are handed over
+                        b_query_done = True
+                        query_error = page
+                    elif page is not None:
+                        pending.extend(executor.submit(self.__get_metadata, row, base_mount_path,
+                                                       search_area_polygon) for row in page)
+                        continue
+
+                if not pending:
+                    continue
+                metadata = pending.popleft().result()
+                if metadata is None:
+                    continue
+
+                limit_found += 1
+                yield metadata
+                if limit_found >= limit:
+                    return
+
+            if query_error is not None:
+                raise query_error
+        finally:
+            stopped.set()
+            # rows that haven't started are dropped rather than waited for
+            for future in pending:
+                future.cancel()
+            executor.shutdown()
+
     def _layer_group_by_area(self,
                              data_filters_copy: LandsatQueryFilters,
                              search_area_polygon,
@@ -0,0 +1,87 @@
+"""
+   Copyright 2017-2018 Echo Park Labs
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   For additional information, contact:
+
+   email: info@echoparklabs.io
+"""
+
+import numpy as np
+
+from functools import lru_cache
+
+# every UInt16 (and Byte) source value has an entry
+LUT_SIZE = 65536
+
+
+def get_lut_scale_params(scale_params, band_count: int):
+    """
+    Normalize gdal.Translate scaleParams to one (src_min, src_max, dst_min, dst_max) tuple per band, the way
+    gdal_translate reads them: a single entry applies to every band, otherwise there's one entry per band, and a
+    missing output range is 0 to 255.
+    :return: list of tuples, or None if the scale can't be done with a lookup table (no scale_params, a band without
+    a source range, which has to be computed from the data, or a band count that doesn't match)
+    """
+    if not scale_params:
+        return None
+    if len(scale_params) == 1:
+        scale_params = list(scale_params) * band_count
+    elif len(scale_params) != band_count:
+        return None
+
+    normalized = []
+    for scale_param in scale_params:
+        if not scale_param or len(scale_param) not in (2, 4):
+            return None
+        dst_min, dst_max = (scale_param[2], scale_param[3]) if len(scale_param) == 4 else (0, 255)
+        normalized.append((float(scale_param[0]), float(scale_param[1]), float(dst_min), float(dst_max)))
+    return normalized
+
+
+@lru_cache(maxsize=128)
+def get_scale_lut(scale_param: tuple, dtype: str) -> np.ndarray:
+    """
+    Lookup table that does the linear scale gdal.Translate does for every possible UInt16 source value: scaled in
+    floating point, then rounded half up and clamped to the output type.
+    :param scale_param: (src_min, src_max, dst_min, dst_max)
+    :param dtype: numpy dtype string of the output, an integer type
+    :return: read only ndarray of LUT_SIZE entries
+    """
+    src_min, src_max, dst_min, dst_max = scale_param
+    if src_max == src_min:
+        # what gdal_translate does to avoid dividing by zero
+        src_max += 0.1
+
+    dtype_info = np.iinfo(dtype)
+    values = np.arange(LUT_SIZE, dtype=np.float64)
+    scaled = (values - src_min) * ((dst_max - dst_min) / (src_max - src_min)) + dst_min
+    lut = np.clip(np.floor(scaled + 0.5), dtype_info.min, dtype_info.max).astype(dtype)
+    lut.flags.writeable = False
+    return lut
+
+
+def apply_lut(lut: np.ndarray, nda: np.ndarray, out: np.ndarray=None) -> np.ndarray:
+    """
+    Map every value of an unsigned 16 bit (or 8 bit) ndarray through a lookup table with a single numpy take
+    :param out: where to write, any view the shape of nda. nda itself when the types match, for in place
+    :return: out
+    """
+    if out is None:
+        out = np.empty(nda.shape, dtype=lut.dtype)
+    elif out.dtype != lut.dtype:
+        out[...] = np.take(lut, nda, mode='clip')
+        return out
+    # mode clip skips the bounds checks, a UInt16 value can't be out of range of the table
+    return np.take(lut, nda, out=out, mode='clip')
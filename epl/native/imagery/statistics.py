@@ -0,0 +1,129 @@
+"""
+   Copyright 2017-2018 Echo Park Labs
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   For additional information, contact:
+
+   email: info@echoparklabs.io
+"""
+
+import threading
+import numpy as np
+
+from collections import OrderedDict
+from osgeo import gdal
+
+# Landsat band files are Byte or UInt16, a histogram bin for every value covers both
+HISTOGRAM_SIZE = 65536
+
+
+class BandStatistics:
+    """
+    Histogram of the valid (non zero) values of a band file. Statistics are computed from an overview, or from a
+    decimated read when the file has none, so they cost a small fraction of a full resolution read. They're cached by
+    file path, which identifies a scene's band file.
+    """
+    cache_size = 512
+    # the longest side, in pixels, of the overview or decimated read a histogram is computed from
+    sample_size = 1024
+
+    __cache = OrderedDict()
+    __cache_lock = threading.Lock()
+
+    def __init__(self, histogram: np.ndarray):
+        """
+        :param histogram: HISTOGRAM_SIZE counts, one per value. the count for 0 (nodata) is ignored
+        """
+        self.histogram = histogram.astype(np.int64)
+        self.histogram[0] = 0
+
+    def __add__(self, other):
+        return BandStatistics(self.histogram + other.histogram)
+
+    @property
+    def count(self) -> int:
+        return int(self.histogram.sum())
+
+    @property
+    def min(self):
+        values = np.flatnonzero(self.histogram)
+        return int(values[0]) if len(values) else None
+
+    @property
+    def max(self):
+        values = np.flatnonzero(self.histogram)
+        return int(values[-1]) if len(values) else None
+
+    @property
+    def mean(self):
+        count = self.count
+        if not count:
+            return None
+        return float(np.dot(np.arange(HISTOGRAM_SIZE, dtype=np.float64), self.histogram) / count)
+
+    def percentile(self, percent: float):
+        """
+        :param percent: 0 to 100
+        :return: the smallest value with at least percent of the valid values at or below it, None if there are no
+        valid values
+        """
+        count = self.count
+        if not count:
+            return None
+        cumulative = np.cumsum(self.histogram)
+        return int(np.searchsorted(cumulative, count * percent / 100.0))
+
+    @classmethod
+    def get(cls, file_path: str):
+        """
+        Statistics of band 1 of a file, from the cache if they've been computed before
+        """
+        with cls.__cache_lock:
+            if file_path in cls.__cache:
+                cls.__cache.move_to_end(file_path)
+                return cls.__cache[file_path]
+
+        statistics = BandStatistics(cls.__get_histogram(file_path, cls.sample_size))
+
+        with cls.__cache_lock:
+            cls.__cache[file_path] = statistics
+            while len(cls.__cache) > cls.cache_size:
+                cls.__cache.popitem(last=False)
+
+        return statistics
+
+    @staticmethod
+    def __get_histogram(file_path: str, sample_size: int) -> np.ndarray:
+        dataset = gdal.Open(file_path)
+        if dataset is None:
+            raise FileNotFoundError("can't open {} for statistics".format(file_path))
+
+        band = dataset.GetRasterBand(1)
+        if band.DataType not in (gdal.GDT_Byte, gdal.GDT_UInt16):
+            raise ValueError("statistics are only kept for Byte and UInt16 bands, {0} is {1}".format(
+                file_path, gdal.GetDataTypeName(band.DataType)))
+
+        # the smallest overview that's still at least sample_size, otherwise the band itself
+        source = band
+        for overview_index in range(band.GetOverviewCount()):
+            overview = band.GetOverview(overview_index)
+            if sample_size <= max(overview.XSize, overview.YSize) < max(source.XSize, source.YSize):
+                source = overview
+
+        ratio = min(1.0, float(sample_size) / max(source.XSize, source.YSize))
+        nda = source.ReadAsArray(buf_xsize=max(1, int(source.XSize * ratio)),
+                                 buf_ysize=max(1, int(source.YSize * ratio)))
+        del dataset
+
+        return np.bincount(nda.ravel(), minlength=HISTOGRAM_SIZE)
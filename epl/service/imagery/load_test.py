@@ -0,0 +1,266 @@
+"""
+   Copyright 2017-2018 Echo Park Labs
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   For additional information, contact:
+
+   email: info@echoparklabs.io
+"""
+
+import os
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import grpc
+import numpy as np
+
+from osgeo import gdal, osr
+
+from epl.grpc.imagery import epl_imagery_pb2, epl_imagery_pb2_grpc
+from epl.native.imagery.ndarray_result import SharedMemoryArray
+from epl.service.imagery.server import ImageryServer
+
+# Load test an ImageryOperators server with synthetic Landsat 8 scenes written to a temporary mount path, so the
+# throughput of the server itself is measured without a bucket or BigQuery.
+#
+# python -m epl.service.imagery.load_test --concurrency 16 --duration 30
+# python -m epl.service.imagery.load_test --aio --stream
+# python -m epl.service.imagery.load_test --shared-memory
+
+SYNTHETIC_BUCKET = "synthetic-landsat"
+# UTM 13N, around the Taos test area
+SYNTHETIC_EPSG = 32613
+SYNTHETIC_ORIGIN = (399960.0, 4100040.0)
+SYNTHETIC_BANDS = range(1, 8)
+
+
+def create_synthetic_scenes(base_mount_path: str, scene_count=2, size=2048) -> list:
+    """
+    Write UInt16 band files for scene_count overlapping Landsat 8 scenes at 30m, tiled and with overviews like the
+    public data, and return their MetadataResults
+    """
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(SYNTHETIC_EPSG)
+    geographic = osr.SpatialReference()
+    geographic.ImportFromEPSG(4326)
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        geographic.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    to_geographic = osr.CoordinateTransformation(srs, geographic)
+
+    driver = gdal.GetDriverByName("GTiff")
+    random_state = np.random.RandomState(0)
+    results = []
+    for scene_index in range(scene_count):
+        product_id = "LC08_L1TP_033034_201701{0:02d}_201701{0:02d}_01_T1".format(scene_index + 1)
+        prefix = "LC08/01/033/034/{}".format(product_id)
+        full_mount_path = os.path.join(base_mount_path, SYNTHETIC_BUCKET, prefix)
+        os.makedirs(full_mount_path, exist_ok=True)
+
+        # each scene is shifted a quarter of the way along, so mosaics have something to combine
+        x_origin = SYNTHETIC_ORIGIN[0] + scene_index * size * 30 / 4
+        y_origin = SYNTHETIC_ORIGIN[1]
+        geo_transform = (x_origin, 30.0, 0.0, y_origin, 0.0, -30.0)
+
+        for band_number in SYNTHETIC_BANDS:
+            dataset = driver.Create("{0}/{1}_B{2}.TIF".format(full_mount_path, product_id, band_number),
+                                    size, size, 1, gdal.GDT_UInt16,
+                                    options=["TILED=YES", "COMPRESS=DEFLATE"])
+            dataset.SetGeoTransform(geo_transform)
+            dataset.SetProjection(srs.ExportToWkt())
+            dataset.GetRasterBand(1).SetNoDataValue(0)
+            # smooth gradients plus noise, so compression and scaling do some real work
+            gradient = np.add.outer(np.arange(size), np.arange(size)) * (40000.0 / (2 * size))
+            noise = random_state.randint(0, 2000, size=(size, size))
+            dataset.GetRasterBand(1).WriteArray((gradient + noise + band_number * 1000).astype(np.uint16))
+            dataset.BuildOverviews("AVERAGE", [2, 4, 8, 16])
+            del dataset
+
+        corners = [to_geographic.TransformPoint(x, y)[:2] for x, y in
+                   [(x_origin, y_origin), (x_origin + size * 30, y_origin),
+                    (x_origin, y_origin - size * 30), (x_origin + size * 30, y_origin - size * 30)]]
+        results.append(epl_imagery_pb2.MetadataResult(
+            scene_id="LC80330342017{0:03d}LGN00".format(scene_index + 1),
+            product_id=product_id,
+            spacecraft_id=epl_imagery_pb2.LANDSAT_8,
+            sensor_id="OLI_TIRS",
+            date_acquired="2017-01-{0:02d}".format(scene_index + 1),
+            sensing_time="2017-01-{0:02d}T17:40:00.000000Z".format(scene_index + 1),
+            collection_number="01",
+            collection_category="T1",
+            data_type="L1TP",
+            wrs_path=33,
+            wrs_row=34,
+            cloud_cover=0.0,
+            north_lat=max(corner[1] for corner in corners),
+            south_lat=min(corner[1] for corner in corners),
+            west_lon=min(corner[0] for corner in corners),
+            east_lon=max(corner[0] for corner in corners),
+            base_url="gs://{0}/{1}".format(SYNTHETIC_BUCKET, prefix)))
+    return results
+
+
+def get_random_request(metadata_results: list,
+                       tile_degrees: float,
+                       spatial_resolution_m: float,
+                       b_raw_buffer: bool,
+                       random_state: random.Random) -> epl_imagery_pb2.ImageryRequest:
+    """
+    An RGB request for a random tile inside of the overlap of the scenes
+    """
+    west = max(metadata.west_lon for metadata in metadata_results)
+    east = min(metadata.east_lon for metadata in metadata_results)
+    south = max(metadata.south_lat for metadata in metadata_results)
+    north = min(metadata.north_lat for metadata in metadata_results)
+    x = random_state.uniform(west, max(west, east - tile_degrees))
+    y = random_state.uniform(south, max(south, north - tile_degrees))
+
+    request = epl_imagery_pb2.ImageryRequest(metadata=metadata_results,
+                                             envelope_boundary=[x, y, x + tile_degrees, y + tile_degrees],
+                                             output_type=epl_imagery_pb2.BYTE,
+                                             spatial_resolution_m=spatial_resolution_m,
+                                             raw_buffer=b_raw_buffer)
+    for band_type in (epl_imagery_pb2.RED, epl_imagery_pb2.GREEN, epl_imagery_pb2.BLUE):
+        request.band_definitions.add(band_type=band_type, scale_params=[0, 45000])
+    return request
+
+
+def run(target: str,
+        metadata_results: list,
+        concurrency: int,
+        duration: float,
+        tile_degrees: float,
+        spatial_resolution_m: float,
+        b_stream: bool,
+        b_raw_buffer: bool,
+        deadline: float,
+        b_shared_memory: bool=False) -> dict:
+    """
+    concurrency client threads send requests back to back for duration seconds
+    :return: dict of the results
+    """
+    channel = grpc.insecure_channel(target, options=[('grpc.max_receive_message_length', 256 * 1024 * 1024)])
+    stub = epl_imagery_pb2_grpc.ImageryOperatorsStub(channel)
+    latencies = []
+    errors = {}
+    received = [0]
+    lock = threading.Lock()
+    stop_time = time.monotonic() + duration
+
+    def client(client_index):
+        random_state = random.Random(client_index)
+        while time.monotonic() < stop_time:
+            request = get_random_request(metadata_results, tile_degrees, spatial_resolution_m, b_raw_buffer,
+                                         random_state)
+            request.shared_memory = b_shared_memory
+            start = time.monotonic()
+            try:
+                if b_stream:
+                    size = sum(chunk.ByteSize() for chunk in stub.ImagerySearchNArrayStream(request, timeout=deadline))
+                elif b_shared_memory:
+                    with SharedMemoryArray(stub.ImagerySearchNArray(request, timeout=deadline)) as nda:
+                        size = nda.nbytes
+                else:
+                    size = stub.ImagerySearchNArray(request, timeout=deadline).ByteSize()
+            except grpc.RpcError as e:
+                with lock:
+                    errors[e.code().name] = errors.get(e.code().name, 0) + 1
+                continue
+            with lock:
+                latencies.append(time.monotonic() - start)
+                received[0] += size
+
+    start = time.monotonic()
+    threads = [threading.Thread(target=client, args=(index,)) for index in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+    channel.close()
+
+    latencies = np.array(latencies) * 1000
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'requests_per_second': len(latencies) / elapsed,
+        'mb_per_second': received[0] / elapsed / (1024 * 1024),
+        'latency_ms': {'p{}'.format(percent): float(np.percentile(latencies, percent)) if len(latencies) else None
+                       for percent in (50, 95, 99)},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="load test an ImageryOperators server with synthetic scenes")
+    parser.add_argument("--target", default=None,
+                        help="host:port of a running server, started in process if not set. A running server needs "
+                             "--base-mount-path to be its mount path")
+    parser.add_argument("--base-mount-path", default=None, help="where the synthetic scenes are written")
+    parser.add_argument("--scenes", type=int, default=2)
+    parser.add_argument("--size", type=int, default=2048, help="width and height of the synthetic scenes")
+    parser.add_argument("--concurrency", type=int, default=8, help="client threads")
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds")
+    parser.add_argument("--tile-degrees", type=float, default=0.1)
+    parser.add_argument("--resolution", type=float, default=60.0)
+    parser.add_argument("--stream", action="store_true", help="use ImagerySearchNArrayStream")
+    parser.add_argument("--shared-memory", action="store_true",
+                        help="map results from shared memory, the server has to be on this host")
+    parser.add_argument("--legacy-fields", action="store_true", help="ask for the repeated fields, not raw_buffer")
+    parser.add_argument("--deadline", type=float, default=30.0, help="seconds")
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--aio", action="store_true")
+    args = parser.parse_args()
+    if args.stream and args.shared_memory:
+        parser.error("--shared-memory is for ImagerySearchNArray, not --stream")
+
+    base_mount_path = args.base_mount_path or tempfile.mkdtemp(prefix="epl-load-test-")
+    server = None
+    try:
+        metadata_results = create_synthetic_scenes(base_mount_path, args.scenes, args.size)
+        target = args.target
+        if not target:
+            server = ImageryServer(port=0,
+                                   max_workers=args.max_workers,
+                                   b_aio=args.aio,
+                                   base_mount_path=base_mount_path,
+                                   b_shared_memory=args.shared_memory).start()
+            target = "localhost:{}".format(server.port)
+
+        results = run(target,
+                      metadata_results,
+                      concurrency=args.concurrency,
+                      duration=args.duration,
+                      tile_degrees=args.tile_degrees,
+                      spatial_resolution_m=args.resolution,
+                      b_stream=args.stream,
+                      b_raw_buffer=not args.legacy_fields,
+                      deadline=args.deadline,
+                      b_shared_memory=args.shared_memory)
+        print("{requests} requests, {requests_per_second:.1f} requests/s, {mb_per_second:.1f} MB/s".format(**results))
+        print("latency ms p50 {p50}, p95 {p95}, p99 {p99}".format(**results['latency_ms']))
+        if results['errors']:
+            print("errors {}".format(results['errors']))
+        if server:
+            print("server {}".format(server.stats()))
+    finally:
+        if server:
+            server.stop(grace=5.0)
+        if not args.base_mount_path:
+            shutil.rmtree(base_mount_path, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
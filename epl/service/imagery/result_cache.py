@@ -0,0 +1,97 @@
+"""
+   Copyright 2017-2018 Echo Park Labs
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   For additional information, contact:
+
+   email: info@echoparklabs.io
+"""
+
+import threading
+
+from collections import OrderedDict
+
+
+class ResultCache:
+    """
+    LRU cache of rendered results (NDArrayResult and BigFileResult messages, already encoded and compressed) by
+    request key, bounded by the bytes of the results rather than their count, since one mosaic can be the size of
+    thousands of tiles. A hit skips the read and the encoding.
+    """
+    def __init__(self, max_bytes: int):
+        """
+        :param max_bytes: serialized bytes of the results kept. A result bigger than max_bytes is never cached
+        """
+        self.max_bytes = max_bytes
+        self.__results = OrderedDict()
+        self.__bytes = 0
+        self.__lock = threading.Lock()
+
+        self.__hits = 0
+        self.__misses = 0
+        self.__bytes_saved = 0
+        self.__evictions = 0
+
+    def get(self, key):
+        """
+        :return: the cached result, None if there isn't one
+        """
+        with self.__lock:
+            entry = self.__results.get(key)
+            if entry is None:
+                self.__misses += 1
+                return None
+            self.__results.move_to_end(key)
+            self.__hits += 1
+            self.__bytes_saved += entry[1]
+            return entry[0]
+
+    def put(self, key, result, size: int=None):
+        """
+        :param result: protobuf message
+        :param size: serialized bytes of the result, result.ByteSize() if None
+        """
+        size = result.ByteSize() if size is None else size
+        if size > self.max_bytes:
+            return
+
+        with self.__lock:
+            previous = self.__results.pop(key, None)
+            if previous is not None:
+                self.__bytes -= previous[1]
+            self.__results[key] = (result, size)
+            self.__bytes += size
+            while self.__bytes > self.max_bytes:
+                _, (_, evicted_size) = self.__results.popitem(last=False)
+                self.__bytes -= evicted_size
+                self.__evictions += 1
+
+    def clear(self):
+        with self.__lock:
+            self.__results.clear()
+            self.__bytes = 0
+
+    def stats(self) -> dict:
+        """
+        hit_ratio is hits over lookups, bytes_saved the serialized bytes of every result served from the cache
+        """
+        with self.__lock:
+            lookups = self.__hits + self.__misses
+            return {'hits': self.__hits,
+                    'misses': self.__misses,
+                    'hit_ratio': float(self.__hits) / lookups if lookups else 0.0,
+                    'bytes_saved': self.__bytes_saved,
+                    'evictions': self.__evictions,
+                    'entries': len(self.__results),
+                    'bytes': self.__bytes}
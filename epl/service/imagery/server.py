@@ -0,0 +1,585 @@
+"""
+   Copyright 2017-2018 Echo Park Labs
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   For additional information, contact:
+
+   email: info@echoparklabs.io
+"""
+
+import os
+import time
+import hashlib
+import signal
+import asyncio
+import argparse
+import threading
+import grpc
+
+from concurrent.futures import ThreadPoolExecutor, Future, TimeoutError as FutureTimeoutError
+
+from epl.grpc.imagery import epl_imagery_pb2, epl_imagery_pb2_grpc
+from epl.native.imagery.reader import MetadataService, Landsat, Metadata, DataType, FunctionDetails
+from epl.native.imagery.metadata_helpers import LandsatQueryFilters, SpacecraftID, Band
+from epl.native.imagery.band_math import SpectralIndex
+from epl.native.imagery.memory_budget import MemoryBudgetExceeded
+from epl.native.imagery.file_encoding import FileType
+from epl.native.imagery.ndarray_result import negotiate_compression, to_ndarray_result, to_shared_memory_result
+from epl.service.imagery.single_flight import SingleFlight, DeadlineExpired
+from epl.service.imagery.result_cache import ResultCache
+from epl.service.imagery.shared_memory_leases import SharedMemoryLeases
+
+# rows in each NDArrayChunk when the request doesn't set chunk_rows
+DEFAULT_CHUNK_ROWS = 256
+
+
+def get_data_type(grpc_num, default: DataType=None) -> DataType:
+    for data_type in DataType:
+        if data_type.grpc_num == grpc_num and data_type is not DataType.UNKNOWN_GDAL:
+            return data_type
+    return default
+
+
+def get_band_definitions(band_definition_messages) -> list:
+    """
+    Band definitions for Landsat from BandDefinition messages: a Band, a band number or a FunctionDetails
+    """
+    band_definitions = []
+    for message in band_definition_messages:
+        if message.HasField("band_function") and message.band_function.name:
+            function = message.band_function
+            if not (function.code or function.expression or function.band_definitions) and \
+                    SpectralIndex.from_name(function.name):
+                # a bare index name addresses the built in index
+                band_definitions.append(FunctionDetails.from_spectral_index(
+                    function.name,
+                    data_type=get_data_type(function.data_type, DataType.FLOAT32),
+                    arguments=dict(function.arguments) or None))
+                continue
+            band_definitions.append(FunctionDetails(name=function.name,
+                                                    band_definitions=get_band_definitions(
+                                                        function.band_definitions) or None,
+                                                    data_type=get_data_type(function.data_type),
+                                                    code=function.code or None,
+                                                    arguments=dict(function.arguments) or None,
+                                                    transfer_type=get_data_type(function.transfer_type),
+                                                    expression=function.expression or None,
+                                                    process_pool=function.process_pool))
+        elif message.band_type != epl_imagery_pb2.UNKNOWN_BAND:
+            band_definitions.append(Band(message.band_type))
+        else:
+            band_definitions.append(message.band_number)
+    return band_definitions
+
+
+def get_fetch_arguments(request: epl_imagery_pb2.ImageryRequest) -> dict:
+    """
+    Keyword arguments for Landsat.fetch_imagery_array from an ImageryRequest
+    """
+    arguments = {
+        'band_definitions': get_band_definitions(request.band_definitions),
+        'output_type': get_data_type(request.output_type, DataType.BYTE),
+        'spatial_resolution_m': request.spatial_resolution_m or 60,
+        'boundary_cs': request.boundary_cs.wkid or 4326,
+    }
+
+    if request.auto_scale:
+        arguments['scale_params'] = "auto"
+    elif any(band_definition.scale_params for band_definition in request.band_definitions):
+        arguments['scale_params'] = [list(band_definition.scale_params)
+                                     for band_definition in request.band_definitions
+                                     if band_definition.band_type != epl_imagery_pb2.ALPHA]
+
+    if request.polygon_boundary_wkb:
+        arguments['polygon_boundary_wkb'] = request.polygon_boundary_wkb
+    elif len(request.envelope_boundary) == 4:
+        arguments['envelope_boundary'] = tuple(request.envelope_boundary)
+
+    return arguments
+
+
+def get_request_key(request) -> str:
+    """
+    Canonical hash of an ImageryRequest or ImageryFileRequest. Requests for the same pixels in the same encoding
+    have the same key: scenes are identified by their ids alone, scale_params are ignored with auto_scale,
+    accepted_compression is replaced by the compression it negotiates to, and maps are serialized in a fixed order.
+    """
+    canonical = type(request)()
+    canonical.CopyFrom(request)
+    imagery_request = canonical.imagery_request if isinstance(canonical, epl_imagery_pb2.ImageryFileRequest) \
+        else canonical
+
+    del imagery_request.metadata[:]
+    for metadata in request.metadata if imagery_request is canonical else request.imagery_request.metadata:
+        imagery_request.metadata.add(scene_id=metadata.scene_id, product_id=metadata.product_id)
+
+    if imagery_request.auto_scale:
+        for band_definition in imagery_request.band_definitions:
+            band_definition.ClearField("scale_params")
+
+    compression = negotiate_compression(imagery_request.accepted_compression)
+    imagery_request.ClearField("accepted_compression")
+    imagery_request.accepted_compression.append(compression.grpc_num)
+
+    return "{0}:{1}".format(type(request).__name__,
+                            hashlib.sha256(canonical.SerializeToString(deterministic=True)).hexdigest())
+
+
+def to_metadata_result(metadata: Metadata) -> epl_imagery_pb2.MetadataResult:
+    result = epl_imagery_pb2.MetadataResult()
+    for field in result.DESCRIPTOR.fields:
+        if field.name == "wrs_polygon_wkb":
+            result.wrs_polygon_wkb.append(metadata.get_wrs_polygon())
+            continue
+
+        value = getattr(metadata, field.name, None)
+        if value is None:
+            continue
+        if field.label == field.LABEL_REPEATED:
+            getattr(result, field.name).extend(value)
+        else:
+            setattr(result, field.name, int(value) if field.enum_type else value)
+    return result
+
+
+class ImageryService:
+    """
+    The work behind each ImageryOperators rpc, without any gRPC context, so the same code serves the thread pool and
+    the asyncio servers. Everything here does GDAL or BigQuery I/O and blocks, servers run it on worker threads.
+    """
+    def __init__(self,
+                 base_mount_path='/imagery',
+                 shared_memory_leases: SharedMemoryLeases=None,
+                 file_threads=None,
+                 metadata_workers=4):
+        """
+        :param shared_memory_leases: leases of the segments of shared_memory requests, None to refuse them
+        :param file_threads: compression threads of each GeoTIFF file, a number or "ALL_CPUS". None for one
+        :param metadata_workers: threads of each MetadataSearch making rows into Metadata
+        """
+        self.base_mount_path = base_mount_path
+        self.shared_memory_leases = shared_memory_leases
+        self.file_threads = file_threads
+        self.metadata_workers = metadata_workers
+
+    def get_landsat(self, request: epl_imagery_pb2.ImageryRequest) -> Landsat:
+        if not request.metadata:
+            raise ValueError("an ImageryRequest needs at least one metadata result")
+        return Landsat([Metadata(metadata, self.base_mount_path) for metadata in request.metadata])
+
+    def metadata_search(self, request: epl_imagery_pb2.MetadataRequest):
+        """
+        MetadataResults as the pipelined search has each one ready: the next page is queried while the rows of the
+        current one are made into Metadata, so the first results are sent before the query is done
+        """
+        data_filters = LandsatQueryFilters(query_filter=request.data_filters) if request.HasField("data_filters") \
+            else None
+        rows = MetadataService().search_pipelined(satellite_id=SpacecraftID(request.satellite_id),
+                                                  limit=request.limit or 10,
+                                                  data_filters=data_filters,
+                                                  base_mount_path=self.base_mount_path,
+                                                  workers=self.metadata_workers)
+        try:
+            for metadata in rows:
+                yield to_metadata_result(metadata)
+        finally:
+            # a cancelled rpc stops the query
+            rows.close()
+
+    def search_narray(self, request: epl_imagery_pb2.ImageryRequest) -> epl_imagery_pb2.NDArrayResult:
+        if request.shared_memory and self.shared_memory_leases is None:
+            raise ValueError("shared memory results aren't enabled on this server")
+
+        nda = self.get_landsat(request).fetch_imagery_array(**get_fetch_arguments(request))
+        if request.shared_memory:
+            return to_shared_memory_result(nda, leases=self.shared_memory_leases)
+        return to_ndarray_result(nda,
+                                 b_raw_buffer=request.raw_buffer,
+                                 compression=negotiate_compression(request.accepted_compression))
+
+    def search_narray_stream(self, request: epl_imagery_pb2.ImageryRequest):
+        arguments = get_fetch_arguments(request)
+        return self.get_landsat(request).iter_imagery_chunks(
+            chunk_rows=request.chunk_rows or DEFAULT_CHUNK_ROWS,
+            b_raw_buffer=request.raw_buffer,
+            compression=negotiate_compression(request.accepted_compression),
+            **arguments)
+
+    def complete_file(self, request: epl_imagery_pb2.ImageryFileRequest) -> epl_imagery_pb2.BigFileResult:
+        file_type = FileType.from_grpc(request.file_type)
+        arguments = get_fetch_arguments(request.imagery_request)
+        del arguments['boundary_cs']
+
+        landsat = self.get_landsat(request.imagery_request)
+        data, spatial_resolution_m = landsat.get_file(file_type=file_type,
+                                                      max_file_size=request.max_file_size or None,
+                                                      quality=request.quality or None,
+                                                      threads=self.file_threads,
+                                                      **arguments)
+        return epl_imagery_pb2.BigFileResult(data=data,
+                                             file_type=request.file_type,
+                                             file_size=len(data),
+                                             spatial_resolution_m=spatial_resolution_m)
+
+
+def get_status_code(exception: Exception) -> grpc.StatusCode:
+    if isinstance(exception, DeadlineExpired):
+        return grpc.StatusCode.DEADLINE_EXCEEDED
+    elif isinstance(exception, MemoryBudgetExceeded):
+        return grpc.StatusCode.RESOURCE_EXHAUSTED
+    elif isinstance(exception, FileNotFoundError):
+        return grpc.StatusCode.NOT_FOUND
+    elif isinstance(exception, ValueError):
+        return grpc.StatusCode.INVALID_ARGUMENT
+    return grpc.StatusCode.INTERNAL
+
+
+# a generator's end, for next() calls that run on the worker pool
+_done = object()
+
+
+class _ServiceStream:
+    """
+    A streaming rpc's service generator, stepped on the worker pool. Closing it runs the generator's cleanup, which is
+    what stops a block reader's prefetch thread or a pipelined search's query thread. A generator can't be closed
+    while a step runs, so close waits for the step in flight, and close_later does the waiting on the worker pool.
+    """
+    def __init__(self, iterator, executor: ThreadPoolExecutor):
+        self.__iterator = iterator
+        self.__executor = executor
+        self.__lock = threading.Lock()
+        self.__b_closed = False
+
+    def next(self):
+        with self.__lock:
+            if self.__b_closed:
+                return _done
+            return next(self.__iterator, _done)
+
+    def close(self):
+        with self.__lock:
+            if self.__b_closed:
+                return
+            self.__b_closed = True
+            if hasattr(self.__iterator, 'close'):
+                self.__iterator.close()
+
+    def close_later(self):
+        try:
+            self.__executor.submit(self.close)
+        except RuntimeError:
+            # the pool is already shut down, there's no step left to wait for
+            self.close()
+
+
+def _submit(single_flight: SingleFlight,
+            result_cache: ResultCache,
+            executor: ThreadPoolExecutor,
+            context,
+            key,
+            function,
+            *args):
+    """
+    Submit an rpc's work, or take its result from the cache. Keyed work that completes is cached
+    :return: (the future of the work, seconds left until the rpc's deadline or None)
+    """
+    remaining = context.time_remaining()
+    if key is not None and result_cache is not None:
+        result = result_cache.get(key)
+        if result is not None:
+            future = Future()
+            future.set_result(result)
+            return future, remaining
+
+        def cached(*args):
+            result = function(*args)
+            result_cache.put(key, result)
+            return result
+        work = cached
+    else:
+        work = function
+
+    deadline = None if remaining is None else time.monotonic() + remaining
+    return single_flight.submit(key, executor, work, *args, deadline=deadline), remaining
+
+
+class ImageryServicer(epl_imagery_pb2_grpc.ImageryOperatorsServicer):
+    """
+    ImageryOperators for a thread pool grpc.server. The rpc threads only wait: GDAL and BigQuery work runs on the
+    service's worker pool, so a call can return DEADLINE_EXCEEDED when its deadline passes, and work whose deadline
+    passed while it was queued is never started. Identical ImagerySearchNArray and ImageryCompleteFile requests in
+    flight at the same time share one computation and its encoded result, and with a result_cache a repeated request
+    is answered from it. shared_memory requests are neither: each client claims its own segment.
+    """
+    def __init__(self,
+                 service: ImageryService,
+                 executor: ThreadPoolExecutor,
+                 single_flight: SingleFlight=None,
+                 result_cache: ResultCache=None):
+        self.service = service
+        self.executor = executor
+        self.single_flight = single_flight or SingleFlight()
+        self.result_cache = result_cache
+
+    def __call(self, context, key, function, *args):
+        future, remaining = _submit(self.single_flight, self.result_cache, self.executor, context, key, function, *args)
+        try:
+            return future.result(timeout=remaining)
+        except FutureTimeoutError:
+            # the work isn't cancelled, other callers may be waiting on it
+            context.abort(grpc.StatusCode.DEADLINE_EXCEEDED, "deadline exceeded")
+        except Exception as e:
+            context.abort(get_status_code(e), str(e))
+
+    def __stream(self, context, function, request):
+        stream = _ServiceStream(self.__call(context, None, lambda: iter(function(request))), self.executor)
+        # a cancelled rpc's handler is just never resumed, the callback is what closes the stream then
+        context.add_callback(stream.close_later)
+        try:
+            while context.is_active():
+                item = self.__call(context, None, stream.next)
+                if item is _done:
+                    return
+                yield item
+        finally:
+            stream.close_later()
+
+    def MetadataSearch(self, request, context):
+        yield from self.__stream(context, self.service.metadata_search, request)
+
+    def ImagerySearchNArray(self, request, context):
+        key = None if request.shared_memory else get_request_key(request)
+        return self.__call(context, key, self.service.search_narray, request)
+
+    def ImagerySearchNArrayStream(self, request, context):
+        yield from self.__stream(context, self.service.search_narray_stream, request)
+
+    def ImageryCompleteFile(self, request, context):
+        return self.__call(context, get_request_key(request), self.service.complete_file, request)
+
+
+class AsyncImageryServicer(epl_imagery_pb2_grpc.ImageryOperatorsServicer):
+    """
+    ImageryOperators for a grpc.aio server. The event loop only handles the rpcs, the work runs on the service's
+    worker pool with the same deadline handling, coalescing and caching as ImageryServicer.
+    """
+    def __init__(self,
+                 service: ImageryService,
+                 executor: ThreadPoolExecutor,
+                 single_flight: SingleFlight=None,
+                 result_cache: ResultCache=None):
+        self.service = service
+        self.executor = executor
+        self.single_flight = single_flight or SingleFlight()
+        self.result_cache = result_cache
+
+    async def __call(self, context, key, function, *args):
+        future, remaining = _submit(self.single_flight, self.result_cache, self.executor, context, key, function, *args)
+        try:
+            # shielded, a timed out caller mustn't cancel work other callers share
+            return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), timeout=remaining)
+        except asyncio.TimeoutError:
+            await context.abort(grpc.StatusCode.DEADLINE_EXCEEDED, "deadline exceeded")
+        except Exception as e:
+            await context.abort(get_status_code(e), str(e))
+
+    async def __stream(self, context, function, request):
+        stream = _ServiceStream(await self.__call(context, None, lambda: iter(function(request))), self.executor)
+        # cancellation and deadlines raise in here, so the stream is closed on the way out
+        try:
+            while True:
+                item = await self.__call(context, None, stream.next)
+                if item is _done:
+                    return
+                yield item
+        finally:
+            stream.close_later()
+
+    async def MetadataSearch(self, request, context):
+        async for item in self.__stream(context, self.service.metadata_search, request):
+            yield item
+
+    async def ImagerySearchNArray(self, request, context):
+        key = None if request.shared_memory else get_request_key(request)
+        return await self.__call(context, key, self.service.search_narray, request)
+
+    async def ImagerySearchNArrayStream(self, request, context):
+        async for item in self.__stream(context, self.service.search_narray_stream, request):
+            yield item
+
+    async def ImageryCompleteFile(self, request, context):
+        return await self.__call(context, get_request_key(request), self.service.complete_file, request)
+
+
+class ImageryServer:
+    """
+    An ImageryOperators server. max_workers threads do the GDAL and BigQuery work for every rpc. b_aio handles the
+    rpcs on an asyncio event loop, otherwise each rpc holds one of max_rpcs threads while its work runs.
+
+    stop drains: new rpcs are refused, rpcs in flight get grace seconds to finish, then the worker pool is shut down.
+
+    b_shared_memory lets clients on the same host ask for ImagerySearchNArray results in shared memory, mapped
+    without the copies of serializing and sending them (SharedMemoryArray).
+
+    server = ImageryServer(port=50051)
+    server.start()
+    server.wait()
+    """
+    # the largest NDArrayResult or BigFileResult sent, the grpc default of 4MB is a small image
+    max_message_bytes = 256 * 1024 * 1024
+
+    def __init__(self,
+                 port=50051,
+                 max_workers=os.cpu_count() or 1,
+                 max_rpcs=None,
+                 b_aio=False,
+                 base_mount_path='/imagery',
+                 result_cache_bytes=512 * 1024 * 1024,
+                 b_shared_memory=False,
+                 shared_memory_lease_seconds=60.0,
+                 file_threads=None,
+                 metadata_workers=4):
+        """
+        :param max_workers: threads doing imagery work
+        :param max_rpcs: rpcs handled at once, more are refused with RESOURCE_EXHAUSTED. 4 times max_workers if None
+        :param b_aio: handle rpcs with grpc.aio instead of a thread each
+        :param result_cache_bytes: bytes of encoded results kept for repeated requests, 0 for no cache
+        :param b_shared_memory: answer shared_memory requests, otherwise they're refused with INVALID_ARGUMENT
+        :param shared_memory_lease_seconds: how long a segment waits for its client before it's unlinked
+        :param file_threads: compression threads of each ImageryCompleteFile GeoTIFF, a number or "ALL_CPUS"
+        :param metadata_workers: threads of each MetadataSearch making rows into Metadata while the next page is
+        queried
+        """
+        self.port = port
+        self.max_workers = max_workers
+        self.max_rpcs = max_rpcs or 4 * max_workers
+        self.b_aio = b_aio
+        self.shared_memory_leases = SharedMemoryLeases(shared_memory_lease_seconds) if b_shared_memory else None
+        self.service = ImageryService(base_mount_path=base_mount_path,
+                                      shared_memory_leases=self.shared_memory_leases,
+                                      file_threads=file_threads,
+                                      metadata_workers=metadata_workers)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.single_flight = SingleFlight()
+        self.result_cache = ResultCache(result_cache_bytes) if result_cache_bytes else None
+
+        self.__server = None
+        self.__rpc_executor = None
+        self.__loop = None
+        self.__loop_thread = None
+
+    @property
+    def options(self) -> list:
+        return [('grpc.max_send_message_length', self.max_message_bytes),
+                ('grpc.max_receive_message_length', self.max_message_bytes)]
+
+    def start(self):
+        if self.b_aio:
+            self.__loop = asyncio.new_event_loop()
+            self.__loop_thread = threading.Thread(target=self.__loop.run_forever, daemon=True)
+            self.__loop_thread.start()
+            asyncio.run_coroutine_threadsafe(self.__start_aio(), self.__loop).result()
+        else:
+            self.__rpc_executor = ThreadPoolExecutor(max_workers=self.max_rpcs)
+            self.__server = grpc.server(self.__rpc_executor,
+                                        options=self.options,
+                                        maximum_concurrent_rpcs=self.max_rpcs)
+            epl_imagery_pb2_grpc.add_ImageryOperatorsServicer_to_server(
+                ImageryServicer(self.service, self.executor, self.single_flight, self.result_cache), self.__server)
+            self.port = self.__server.add_insecure_port("[::]:{}".format(self.port))
+            self.__server.start()
+        return self
+
+    async def __start_aio(self):
+        from grpc import aio
+        self.__server = aio.server(options=self.options, maximum_concurrent_rpcs=self.max_rpcs)
+        epl_imagery_pb2_grpc.add_ImageryOperatorsServicer_to_server(
+            AsyncImageryServicer(self.service, self.executor, self.single_flight, self.result_cache), self.__server)
+        self.port = self.__server.add_insecure_port("[::]:{}".format(self.port))
+        await self.__server.start()
+
+    def stats(self) -> dict:
+        """
+        Metrics of request coalescing, of the result cache (hit_ratio, bytes_saved, ...) and of shared memory results
+        """
+        return {'single_flight': self.single_flight.stats(),
+                'result_cache': self.result_cache.stats() if self.result_cache else None,
+                'shared_memory': self.shared_memory_leases.stats() if self.shared_memory_leases else None}
+
+    def stop(self, grace=30.0):
+        """
+        Refuse new rpcs, wait up to grace seconds for the ones in flight, then shut down the worker pool and unlink
+        shared memory results no client claimed
+        """
+        if self.__server is None:
+            return
+
+        if self.b_aio:
+            asyncio.run_coroutine_threadsafe(self.__server.stop(grace), self.__loop).result()
+            self.__loop.call_soon_threadsafe(self.__loop.stop)
+            self.__loop_thread.join()
+        else:
+            self.__server.stop(grace).wait()
+            self.__rpc_executor.shutdown()
+
+        self.__server = None
+        self.executor.shutdown()
+        if self.shared_memory_leases:
+            self.shared_memory_leases.reap(b_all=True)
+
+    def wait(self):
+        """
+        Block until the process gets SIGTERM or SIGINT, then drain and stop
+        """
+        stopped = threading.Event()
+        for signal_number in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signal_number, lambda *_: stopped.set())
+        stopped.wait()
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ImageryOperators gRPC server")
+    parser.add_argument("--port", type=int, default=50051)
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count() or 1,
+                        help="threads doing imagery work")
+    parser.add_argument("--max-rpcs", type=int, default=None,
+                        help="rpcs handled at once, more are refused. 4 times max-workers by default")
+    parser.add_argument("--aio", action="store_true", help="handle rpcs on an asyncio event loop")
+    parser.add_argument("--base-mount-path", default="/imagery")
+    parser.add_argument("--result-cache-mb", type=int, default=512,
+                        help="MB of encoded results cached for repeated requests, 0 for no cache")
+    parser.add_argument("--shared-memory", action="store_true",
+                        help="answer requests for results in shared memory, from clients on this host")
+    parser.add_argument("--file-threads", default=None,
+                        help="compression threads of each GeoTIFF file, a number or ALL_CPUS")
+    parser.add_argument("--metadata-workers", type=int, default=4,
+                        help="threads of each MetadataSearch making rows into metadata")
+    args = parser.parse_args()
+
+    server = ImageryServer(port=args.port,
+                           max_workers=args.max_workers,
+                           max_rpcs=args.max_rpcs,
+                           b_aio=args.aio,
+                           base_mount_path=args.base_mount_path,
+                           result_cache_bytes=args.result_cache_mb * 1024 * 1024,
+                           b_shared_memory=args.shared_memory,
+                           file_threads=args.file_threads,
+                           metadata_workers=args.metadata_workers).start()
+    print("ImageryOperators listening on port {}".format(server.port))
+    server.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+   Copyright 2017-2018 Echo Park Labs
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   For additional information, contact:
+
+   email: info@echoparklabs.io
+"""
+
+
+import time
+import threading
+
+from collections import deque
+from multiprocessing import shared_memory, resource_tracker
+
+
+class SharedMemoryLeases:
+    """
+    Shared memory segments of results handed to clients. A client unlinks a segment as soon as it maps it, so one
+    that's still there lease_seconds after it was made belongs to a client that gave up or went away, and is
+    unlinked here. Expired leases are reaped as new ones are added, and all of them when the server stops.
+    """
+    def __init__(self, lease_seconds: float=60.0):
+        self.lease_seconds = lease_seconds
+        # (expiry, name) in the order they were added, so the expired ones are at the front
+        self.__leases = deque()
+        self.__lock = threading.Lock()
+        self.__added = 0
+        self.__expired = 0
+
+    def add(self, name: str):
+        with self.__lock:
+            self.__leases.append((time.monotonic() + self.lease_seconds, name))
+            self.__added += 1
+        self.reap()
+
+    def reap(self, b_all: bool=False):
+        """
+        Unlink the segments of expired leases that weren't claimed
+        :param b_all: every lease, not only the expired ones
+        """
+        now = time.monotonic()
+        names = []
+        with self.__lock:
+            while self.__leases and (b_all or self.__leases[0][0] <= now):
+                names.append(self.__leases.popleft()[1])
+
+        for name in names:
+            if self.__unlink(name):
+                with self.__lock:
+                    self.__expired += 1
+
+    @staticmethod
+    def __unlink(name: str) -> bool:
+        """
+        :return: False if the client already claimed the segment
+        """
+        try:
+            segment = shared_memory.SharedMemory(name=name)
+        except FileNotFoundError:
+            return False
+        segment.close()
+        try:
+            segment.unlink()
+        except FileNotFoundError:
+            # claimed in between. attaching put it on the resource tracker, and unlink didn't get to take it off. The
+            # tracker has the name with the leading slash that segment.name leaves off
+            resource_tracker.unregister(name if name.startswith("/") else "/" + name, "shared_memory")
+            return False
+        return True
+
+    def stats(self) -> dict:
+        """
+        added: segments handed out. expired: segments unlinked here because no client claimed them
+        """
+        with self.__lock:
+            return {'added': self.__added, 'expired': self.__expired, 'leased': len(self.__leases)}
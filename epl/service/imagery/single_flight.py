@@ -0,0 +1,96 @@
+"""
+   Copyright 2017-2018 Echo Park Labs
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   For additional information, contact:
+
+   email: info@echoparklabs.io
+"""
+
+import time
+import threading
+
+from concurrent.futures import Executor, Future
+
+
+class DeadlineExpired(Exception):
+    pass
+
+
+class _Flight:
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.future = None
+
+
+class SingleFlight:
+    """
+    Runs work on an executor with identical requests coalesced: while work for a key is queued or running, submitting
+    the same key returns the same future instead of starting it again, so every caller shares the one result. Work
+    isn't started if the deadlines of all of its callers have passed while it was queued.
+    """
+    def __init__(self):
+        self.__flights = {}
+        self.__lock = threading.Lock()
+        self.__started = 0
+        self.__coalesced = 0
+
+    def submit(self, key, executor: Executor, function, *args, deadline: float=None) -> Future:
+        """
+        :param key: hashable identity of the work, None to never coalesce it
+        :param function: called with args on the executor
+        :param deadline: time.monotonic() after which the caller no longer wants the result, None for no deadline
+        :return: the future of the work, shared with every other caller of the same key while it's in flight
+        """
+        with self.__lock:
+            flight = self.__flights.get(key) if key is not None else None
+            if flight is not None:
+                self.__coalesced += 1
+                # the work is needed until the last of its callers gives up
+                if flight.deadline is not None:
+                    flight.deadline = None if deadline is None else max(flight.deadline, deadline)
+                return flight.future
+
+            self.__started += 1
+            flight = _Flight(deadline)
+            flight.future = executor.submit(self.__run, flight, function, *args)
+            if key is not None:
+                self.__flights[key] = flight
+
+        if key is not None:
+            flight.future.add_done_callback(lambda _: self.__land(key, flight))
+        return flight.future
+
+    @staticmethod
+    def __run(flight: _Flight, function, *args):
+        if flight.deadline is not None and time.monotonic() >= flight.deadline:
+            raise DeadlineExpired("deadline passed before the request was started")
+        return function(*args)
+
+    def __land(self, key, flight: _Flight):
+        with self.__lock:
+            if self.__flights.get(key) is flight:
+                del self.__flights[key]
+
+    @property
+    def in_flight(self) -> int:
+        with self.__lock:
+            return len(self.__flights)
+
+    def stats(self) -> dict:
+        """
+        started: work submitted to the executor. coalesced: submissions that shared work already in flight
+        """
+        with self.__lock:
+            return {'started': self.__started, 'coalesced': self.__coalesced}
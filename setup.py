@@ -19,16 +19,20 @@ kwargs = {
     'url': 'https://bitbucket.org/EchoParkLabs/gcp-imagery-reader',
     'packages': find_packages(),
     'version': open('VERSION').read(),
+    # multiprocessing.shared_memory and ast.Constant
+    'python_requires': '>=3.8',
     'zip_safe': False
 }
 
 clssfrs = [
     "Programming Language :: Python",
     "Programming Language :: Python :: 3",
-    "Programming Language :: Python :: 3.3",
-    "Programming Language :: Python :: 3.4",
-    "Programming Language :: Python :: 3.5",
-    "Programming Language :: Python :: 3.6",
+    "Programming Language :: Python :: 3.8",
+    "Programming Language :: Python :: 3.9",
+    "Programming Language :: Python :: 3.10",
+    "Programming Language :: Python :: 3.11",
+    "Programming Language :: Python :: 3.12",
+    "Programming Language :: Python :: 3.13",
 ]
 kwargs['classifiers'] = clssfrs
 
@@ -1,6 +1,8 @@
+import hashlib
 import py_compile
 import unittest
 from datetime import date
+from multiprocessing import shared_memory
 
 import numpy as np
 import pyproj
@@ -13,6 +15,8 @@ from shapely.wkt import loads
 from epl.native.imagery import PLATFORM_PROVIDER
 from epl.native.imagery.reader import MetadataService, Landsat, Storage, RasterMetadata, DataType, FunctionDetails
 from epl.native.imagery.metadata_helpers import LandsatQueryFilters, SpacecraftID, BandMap, Band
+from epl.native.imagery.process_pool import BandFunctionPool, SharedArrayLease
+from epl.native.imagery.band_math import SpectralIndex
 from test.tools.test_helpers import xml_compare
 
 
@@ -687,6 +691,26 @@ def ndvi_numpy(in_ar, out_ar, xoff, yoff, xsize, ysize, raster_xsize, raster_ysi
                                                                              arguments={"factor": 255}))
 
 
+    def test_function_compile_cache(self):
+        code = """import numpy as np
+def multiply_rounded(in_ar, out_ar, xoff, yoff, xsize, ysize, raster_xsize,
+                   raster_ysize, buf_radius, gt, **kwargs):
+    factor = float(kwargs['factor'])
+    out_ar[:] = np.round_(np.clip(in_ar[0] * factor,0,255))"""
+
+        details_1 = FunctionDetails(name="multiply_rounded", band_definitions=[2], data_type=DataType.FLOAT32,
+                                    code=code, arguments={"factor": "1.5"})
+        details_2 = FunctionDetails(name="multiply_rounded", band_definitions=[3], data_type=DataType.FLOAT32,
+                                    code=code, arguments={"factor": "2.5"})
+        self.assertEqual(hashlib.sha256(code.encode()).hexdigest(), details_1.code_hash)
+        self.assertEqual(details_1.code_hash, details_2.code_hash)
+
+        ndvi_1 = FunctionDetails(name="ndvi", band_definitions=[Band.RED, Band.NIR], data_type=DataType.FLOAT32,
+                                 expression="(NIR - RED) / (NIR + RED)")
+        ndvi_2 = FunctionDetails(name="ndvi", band_definitions=[Band.RED, Band.NIR], data_type=DataType.FLOAT32,
+                                 expression="(NIR - RED) / (NIR + RED)")
+        self.assertIs(ndvi_1.band_expression, ndvi_2.band_expression)
+
     # def test_translate_vrt(self):
     #     #                                                          LC80390332016208LGN00
     """
@@ -802,6 +826,145 @@ def ndvi_numpy(in_ar, out_ar, xoff, yoff, xsize, ysize, raster_xsize, raster_ysi
         np.testing.assert_almost_equal(nda, nda2)
         np.testing.assert_equal(nda, nda2)
 
+    def test_ndvi_expression(self):
+        landsat = Landsat(self.metadata_set)
+
+        ndvi = FunctionDetails(name="ndvi",
+                               band_definitions=[Band.RED, Band.NIR],
+                               data_type=DataType.FLOAT32,
+                               expression="(NIR - RED) / (NIR + RED)")
+        nda = landsat.fetch_imagery_array([ndvi],
+                                          polygon_boundary_wkb=self.taos_shape.wkb,
+                                          output_type=DataType.FLOAT32,
+                                          spatial_resolution_m=240)
+
+        bands = landsat.fetch_imagery_array([Band.RED, Band.NIR],
+                                            polygon_boundary_wkb=self.taos_shape.wkb,
+                                            output_type=DataType.FLOAT32,
+                                            spatial_resolution_m=240)
+        expected = self.ndvi_numpy(bands[1], bands[0])
+        expected[(bands[0] == 0) | (bands[1] == 0)] = 0
+
+        self.assertEqual(expected.shape, nda.shape)
+        np.testing.assert_almost_equal(expected, nda, decimal=5)
+
+        blocks = np.zeros_like(nda)
+        for window, block in landsat.iter_imagery_blocks([ndvi],
+                                                         polygon_boundary_wkb=self.taos_shape.wkb,
+                                                         output_type=DataType.FLOAT32,
+                                                         spatial_resolution_m=240,
+                                                         block_size=256):
+            blocks[window[1]:window[1] + window[3], window[0]:window[0] + window[2]] = block
+        self.assertGreater(np.count_nonzero(blocks), 0)
+
+    def test_spectral_index(self):
+        landsat = Landsat(self.metadata_set)
+
+        ndvi = FunctionDetails.from_spectral_index("NDVI")
+        self.assertEqual([Band.RED, Band.NIR], ndvi.band_definitions)
+        self.assertEqual(DataType.FLOAT32, ndvi.data_type)
+
+        nda = landsat.fetch_imagery_array([ndvi],
+                                          polygon_boundary_wkb=self.taos_shape.wkb,
+                                          output_type=DataType.FLOAT32,
+                                          spatial_resolution_m=240)
+        expected = landsat.fetch_imagery_array([FunctionDetails(name="ndvi",
+                                                                band_definitions=[Band.RED, Band.NIR],
+                                                                data_type=DataType.FLOAT32,
+                                                                expression="(NIR - RED) / (NIR + RED)")],
+                                               polygon_boundary_wkb=self.taos_shape.wkb,
+                                               output_type=DataType.FLOAT32,
+                                               spatial_resolution_m=240)
+        np.testing.assert_almost_equal(expected, nda, decimal=5)
+
+        evi = FunctionDetails.from_spectral_index(SpectralIndex.EVI, arguments={'dn_per_reflectance': 10000})
+        self.assertEqual(10000, evi.band_expression.constants['dn_per_reflectance'])
+        self.assertRaises(ValueError, lambda: FunctionDetails.from_spectral_index("not_an_index"))
+        # an index name alone is no longer enough, it has to be asked for
+        self.assertRaises(ValueError, lambda: FunctionDetails(name="ndvi"))
+
+        # through a BandMap the bands are the spacecraft's numbers, MSS has INFRARED2 for NIR
+        mss_ndvi = FunctionDetails.from_spectral_index("ndvi", BandMap(SpacecraftID.LANDSAT_45_MSS))
+        self.assertEqual([2, 4], mss_ndvi.band_definitions)
+        self.assertEqual("(B4 - B2) / (B4 + B2)", mss_ndvi.expression)
+        self.assertRaises(ValueError, lambda: FunctionDetails.from_spectral_index("ndmi",
+                                                                                BandMap(SpacecraftID.LANDSAT_45_MSS)))
+
+    def test_process_pool_function(self):
+        landsat = Landsat(self.metadata_set[0])
+        code = """import numpy as np
+def ndvi_numpy(in_ar, out_ar, xoff, yoff, xsize, ysize, raster_xsize, raster_ysize, buf_radius, gt, **kwargs):
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        out_ar[:] = np.divide((in_ar[1] - in_ar[0]), (in_ar[1] + in_ar[0]))
+        out_ar[np.isnan(out_ar)] = 0.0"""
+
+        pooled = FunctionDetails(name="ndvi_numpy", band_definitions=[4, 5], code=code,
+                                 data_type=DataType.FLOAT32, process_pool=True)
+        self.assertTrue(pooled.is_band_math)
+        self.assertRaises(ValueError, lambda: landsat.get_vrt([pooled]))
+
+        nda = landsat.fetch_imagery_array([pooled],
+                                          polygon_boundary_wkb=self.taos_shape.wkb,
+                                          output_type=DataType.FLOAT32,
+                                          spatial_resolution_m=240)
+        bands = landsat.fetch_imagery_array([4, 5],
+                                            polygon_boundary_wkb=self.taos_shape.wkb,
+                                            output_type=DataType.FLOAT32,
+                                            spatial_resolution_m=240)
+        expected = self.ndvi_numpy(bands[1], bands[0])
+        self.assertEqual(expected.shape, nda.shape)
+        np.testing.assert_almost_equal(expected, nda, decimal=5)
+
+        self.assertRaises(ValueError, lambda: FunctionDetails(name="ndvi", process_pool=True))
+
+    def test_process_pool_keeps_sources(self):
+        code = """def add_one(in_ar, out_ar, xoff, yoff, xsize, ysize, raster_xsize, raster_ysize, buf_radius, gt, **kwargs):
+    out_ar[:] = in_ar[0] + 1"""
+
+        with SharedArrayLease((1, 64, 32), np.float32) as sources:
+            sources.array[:] = 1
+            # workers only attach to the segments, they must not be unlinked when a worker is done with them
+            for _ in range(2):
+                with SharedArrayLease((64, 32), np.float32) as out:
+                    result = BandFunctionPool.evaluate("add_one", code, sources, out, block_rows=16)
+                    np.testing.assert_array_equal(np.full((64, 32), 2, dtype=np.float32), result)
+                    del result
+
+            attached = shared_memory.SharedMemory(name=sources.spec[0])
+            self.assertGreaterEqual(attached.size, sources.array.nbytes)
+            attached.close()
+
+    def test_expression_mixed_bands(self):
+        landsat = Landsat(self.metadata_set[0])
+        scale_params = [[-1.0, 1.0, 1, 255], [0, 40000], [0, 40000]]
+        ndvi = FunctionDetails(name="ndvi",
+                               band_definitions=[4, 5],
+                               data_type=DataType.FLOAT32,
+                               expression="(B5 - B4) / (B5 + B4)")
+
+        nda = landsat.fetch_imagery_array([ndvi, Band.GREEN, Band.BLUE, Band.ALPHA],
+                                          scale_params=scale_params,
+                                          polygon_boundary_wkb=self.taos_shape.wkb,
+                                          spatial_resolution_m=240)
+        nda2 = landsat.fetch_imagery_array([Band.RED, Band.GREEN, Band.BLUE],
+                                           scale_params=scale_params,
+                                           polygon_boundary_wkb=self.taos_shape.wkb,
+                                           spatial_resolution_m=240)
+        self.assertEqual(nda2.shape[:2], nda.shape[:2])
+        self.assertEqual(4, nda.shape[2])
+        np.testing.assert_equal(nda2[:, :, 1:], nda[:, :, 1:3])
+
+        with self.assertRaises(ValueError):
+            landsat.get_vrt([ndvi, Band.GREEN])
+
+    def test_malformed_expression(self):
+        with self.assertRaises(ValueError):
+            FunctionDetails(name="ndvi", band_definitions=[Band.RED, Band.NIR], data_type=DataType.FLOAT32,
+                            expression="(NIR - RED) / (NIR + SWIR1)")
+        with self.assertRaises(ValueError):
+            FunctionDetails(name="ndvi", band_definitions=[Band.RED, Band.NIR], data_type=DataType.FLOAT32,
+                            expression="__import__('os').getcwd()")
+
     @unittest.skip("failing for some reason. unknown.")
     def test_native_vs_custom(self):
         landsat = Landsat(self.metadata_set)
@@ -1,19 +1,33 @@
+import os
+import time
 import unittest
 import datetime
 
 import requests
 import shapely.geometry
 
+import shutil
+import tempfile
+import threading
 import numpy as np
+import pyproj
 
 from shapely.geometry import shape
 from shapely.geometry import box
 from shapely.wkt import loads
 from google.cloud import bigquery
+from osgeo import gdal
 
 from datetime import date
-from epl.native.imagery.reader import MetadataService, Landsat, Metadata, WRSGeometries, DataType
+from epl.native.imagery.reader import MetadataService, Landsat, Metadata, WRSGeometries, DataType, CutlineMode, \
+    FunctionDetails, FileTypeMap
 from epl.native.imagery.metadata_helpers import LandsatQueryFilters, SpacecraftID, BandMap, Band
+from epl.native.imagery.gdal_config import GDALConfig, IOProfile
+from epl.native.imagery.memory_budget import BudgetAction, MemoryBudget, MemoryBudgetExceeded
+from epl.native.imagery.disk_cache import DiskCache
+from epl.native.imagery.file_encoding import FileType, encode_dataset, downsample_dataset
+from epl.native.imagery.ndarray_result import Compression, negotiate_compression, to_ndarray_result, \
+    from_ndarray_result, assemble_ndarray_chunks, to_shared_memory_result, SharedMemoryArray
 from epl.grpc.geometry.geometry_operators_pb2 import GeometryBagData
 from epl.grpc.imagery import epl_imagery_pb2
 
@@ -61,6 +75,68 @@ class TestMetaDataSQL(unittest.TestCase):
 
         self.assertEqual(len(metadata_set), 2)
 
+    def test_search_pipelined(self):
+        taos_shape = shapely.geometry.box(-105.97, 36.0, -105.2, 37.0)
+        metadata_service = MetadataService()
+
+        def get_filters():
+            # searches add exclusions to their filters
+            landsat_filters = LandsatQueryFilters()
+            landsat_filters.acquired.set_range(date(2017, 3, 1), True, date(2017, 6, 1), True)
+            landsat_filters.aoi.set_geometry(taos_shape.wkb)
+            return landsat_filters
+
+        expected = [metadata.scene_id for metadata in
+                    metadata_service.search(SpacecraftID.LANDSAT_8, limit=8, data_filters=get_filters())]
+        self.assertEqual(8, len(expected))
+        pipelined = [metadata.scene_id for metadata in
+                     metadata_service.search_pipelined(SpacecraftID.LANDSAT_8, limit=8, data_filters=get_filters(),
+                                                       workers=3)]
+        self.assertEqual(expected, pipelined)
+
+        # the caller's filters are left as they were
+        landsat_filters = get_filters()
+        sql = landsat_filters.get_sql(limit=8)
+        list(metadata_service.search_pipelined(SpacecraftID.LANDSAT_8, limit=8, data_filters=landsat_filters))
+        self.assertEqual(sql, landsat_filters.get_sql(limit=8))
+
+        # closed early, the query stops
+        rows = metadata_service.search_pipelined(SpacecraftID.LANDSAT_8, limit=8, data_filters=get_filters())
+        self.assertEqual(expected[0], next(rows).scene_id)
+        rows.close()
+
+    def test_search_pipelined_post_filtered(self):
+        # the query only has the line's bounds, scenes inside of those that the line doesn't cross are post filtered
+        line = shapely.geometry.LineString([(-110.0, 33.0), (-104.0, 39.0)]).buffer(0.01)
+        metadata_service = MetadataService()
+
+        def get_filters(b_bounds=False):
+            landsat_filters = LandsatQueryFilters()
+            landsat_filters.acquired.set_range(date(2017, 3, 1), True, date(2017, 4, 1), True)
+            # search and search_pipelined only agree on the rows of a sorted query
+            landsat_filters.acquired.sort_by(epl_imagery_pb2.DESCENDING)
+            if b_bounds:
+                landsat_filters.aoi.set_bounds(*line.bounds)
+            else:
+                landsat_filters.aoi.set_geometry(line.wkb)
+            return landsat_filters
+
+        bounded = {metadata.scene_id for metadata in
+                   metadata_service.search_pipelined(SpacecraftID.LANDSAT_8, limit=100,
+                                                     data_filters=get_filters(b_bounds=True))}
+        crossed = {metadata.scene_id for metadata in
+                   metadata_service.search_pipelined(SpacecraftID.LANDSAT_8, limit=100, data_filters=get_filters())}
+        self.assertTrue(crossed)
+        self.assertTrue(bounded - crossed)
+
+        expected = [metadata.scene_id for metadata in
+                    metadata_service.search(SpacecraftID.LANDSAT_8, limit=6, data_filters=get_filters())]
+        self.assertEqual(6, len(expected))
+        pipelined = [metadata.scene_id for metadata in
+                     metadata_service.search_pipelined(SpacecraftID.LANDSAT_8, limit=6, data_filters=get_filters(),
+                                                       workers=3)]
+        self.assertEqual(expected, pipelined)
+
     def test_where_start(self):
         # sql_filters = ['scene_id="LC80270312016188LGN00"']
         landsat_filters = LandsatQueryFilters()
@@ -587,6 +663,12 @@ class TestBandMap(unittest.TestCase):
         self.assertRaises(KeyError, lambda: band_map.get_number(Band.THERMAL))
         self.assertRaises(KeyError, lambda: band_map.get_band_enum(12))
 
+    def test_mss_equivalents(self):
+        band_map = BandMap(SpacecraftID.LANDSAT_5_MSS)
+        self.assertEqual(band_map.get_number(Band.INFRARED2), band_map.get_number(Band.NIR))
+        self.assertEqual(4, band_map.get_number(Band.NIR))
+        self.assertRaises(KeyError, lambda: band_map.get_number(Band.SWIR1))
+
 
 class TestDataType(unittest.TestCase):
     def test_bitwise(self):
@@ -594,6 +676,227 @@ class TestDataType(unittest.TestCase):
         b = DataType.UINT16
 
 
+class TestNDArrayResult(unittest.TestCase):
+    def test_raw_buffer(self):
+        nda = np.arange(2 * 3 * 4, dtype=np.uint16).reshape((2, 3, 4))
+        for data in [nda, np.asfortranarray(nda), nda[:, ::2], nda.astype('>u2'), nda.astype(np.float32)]:
+            for compression in Compression:
+                if not compression.b_available:
+                    continue
+                result = to_ndarray_result(data, compression=compression)
+                self.assertEqual(compression.grpc_num, result.compression)
+                self.assertEqual(0, len(result.data_uint32))
+                decoded = from_ndarray_result(result)
+                np.testing.assert_array_equal(data, decoded)
+                self.assertEqual(data.dtype.newbyteorder('='), decoded.dtype)
+
+        # a byte image is one byte a pixel instead of a varint a pixel
+        image = np.full((256, 256), 200, dtype=np.uint8)
+        self.assertEqual(image.nbytes, len(to_ndarray_result(image).data_buffer))
+        self.assertGreater(to_ndarray_result(image, b_raw_buffer=False).ByteSize(),
+                           to_ndarray_result(image).ByteSize())
+
+    def test_legacy_fields(self):
+        nda = np.arange(12, dtype=np.uint8).reshape((3, 4))
+        result = to_ndarray_result(nda, b_raw_buffer=False)
+        self.assertEqual(12, len(result.data_uint32))
+        self.assertFalse(result.data_buffer)
+        np.testing.assert_array_equal(nda, from_ndarray_result(result))
+
+    def test_negotiate_compression(self):
+        self.assertIs(Compression.NONE, negotiate_compression([]))
+        self.assertIs(Compression.DEFLATE, negotiate_compression([epl_imagery_pb2.DEFLATE, epl_imagery_pb2.ZSTD]))
+        expected = Compression.ZSTD if Compression.ZSTD.b_available else Compression.DEFLATE
+        self.assertIs(expected, negotiate_compression([epl_imagery_pb2.ZSTD, epl_imagery_pb2.DEFLATE]))
+
+    def test_shared_memory(self):
+        nda = np.arange(2 * 3 * 4, dtype=np.uint16).reshape((2, 3, 4))
+        result = to_shared_memory_result(nda[:, ::2])
+        self.assertFalse(result.data_buffer)
+        self.assertEqual(nda[:, ::2].nbytes, result.shared_memory.size)
+        with SharedMemoryArray(result) as mapped:
+            np.testing.assert_array_equal(nda[:, ::2], mapped)
+
+        # the segment was unlinked as it was mapped, nobody else can claim it
+        with self.assertRaises(FileNotFoundError):
+            SharedMemoryArray(result)
+
+        np.testing.assert_array_equal(nda, from_ndarray_result(to_shared_memory_result(nda)))
+
+
+class TestDiskCache(unittest.TestCase):
+    def setUp(self):
+        self.cache_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_path, ignore_errors=True)
+
+    def test_arrays(self):
+        disk_cache = DiskCache(self.cache_path)
+        nda = np.arange(600, dtype=np.uint16).reshape((3, 10, 20))
+        self.assertIsNone(disk_cache.get_array("a"))
+        disk_cache.put_array("a", nda)
+        np.testing.assert_array_equal(nda, disk_cache.get_array("a"))
+
+        out = np.zeros_like(nda)
+        self.assertIs(out, disk_cache.get_array("a", out=out))
+        np.testing.assert_array_equal(nda, out)
+        # out is checked before anything is copied into it
+        with self.assertRaises(ValueError):
+            disk_cache.get_array("a", out=np.zeros((3, 20, 10), dtype=np.uint16))
+        with self.assertRaises(ValueError):
+            disk_cache.get_array("a", out=np.zeros_like(nda, dtype=np.uint8))
+        wider = np.zeros_like(nda, dtype=np.float64)
+        self.assertIs(wider, disk_cache.get_array("a", out=wider))
+        np.testing.assert_array_equal(nda, wider)
+
+        # a file removed out from under the index is a miss
+        disk_cache.put_array("b", nda)
+        for root, _, file_names in os.walk(self.cache_path):
+            for file_name in file_names:
+                if file_name == "b.npy":
+                    os.remove(os.path.join(root, file_name))
+        self.assertIsNone(disk_cache.get_array("b"))
+        self.assertEqual(1, len(disk_cache))
+
+    def test_evict_least_recently_used(self):
+        nda = np.zeros(1000, dtype=np.uint8)
+        disk_cache = DiskCache(self.cache_path, max_bytes=3500)
+        for key in ["a", "b", "c"]:
+            disk_cache.put_array(key, nda)
+            time.sleep(0.01)
+        disk_cache.get_array("a")
+        time.sleep(0.01)
+
+        disk_cache.put_array("d", nda)
+        self.assertLessEqual(disk_cache.size_bytes, 3500)
+        self.assertIsNone(disk_cache.get_array("b"))
+        for key in ["a", "c", "d"]:
+            self.assertIsNotNone(disk_cache.get_array(key))
+
+    def test_dataset(self):
+        dataset = gdal.GetDriverByName("MEM").Create("", 64, 32, 2, gdal.GDT_UInt16)
+        dataset.SetGeoTransform((399960.0, 30.0, 0.0, 4100040.0, 0.0, -30.0))
+        for band_number in (1, 2):
+            dataset.GetRasterBand(band_number).WriteArray(np.full((32, 64), band_number, dtype=np.uint16))
+
+        disk_cache = DiskCache(self.cache_path)
+        self.assertIsNone(disk_cache.get_dataset("a"))
+        disk_cache.put_dataset("a", dataset)
+        cached = disk_cache.get_dataset("a")
+        self.assertEqual(dataset.GetGeoTransform(), cached.GetGeoTransform())
+        np.testing.assert_array_equal(dataset.ReadAsArray(), cached.ReadAsArray())
+
+
+class TestFileEncoding(unittest.TestCase):
+    def setUp(self):
+        self.dataset = gdal.GetDriverByName("MEM").Create("", 200, 100, 3, gdal.GDT_Byte)
+        self.dataset.SetGeoTransform((399960.0, 30.0, 0.0, 4100040.0, 0.0, -30.0))
+        gradient = np.add.outer(np.arange(100), np.arange(200)).astype(np.uint8)
+        for band_index in range(3):
+            self.dataset.GetRasterBand(band_index + 1).WriteArray(gradient + band_index * 20)
+
+    def test_encode(self):
+        for file_type, magic in [(FileType.PNG, b"\x89PNG"), (FileType.JPEG, b"\xff\xd8"), (FileType.GEOTIFF, b"II*")]:
+            data = encode_dataset(self.dataset, file_type, quality=90, threads=2)
+            self.assertEqual(magic, data[:len(magic)])
+
+            file_path = "/vsimem/test_encode{}".format(file_type.suffix)
+            gdal.FileFromMemBuffer(file_path, data)
+            decoded = gdal.Open(file_path)
+            self.assertEqual((200, 100, 3), (decoded.RasterXSize, decoded.RasterYSize, decoded.RasterCount))
+            if file_type is not FileType.JPEG:
+                np.testing.assert_array_equal(self.dataset.ReadAsArray(), decoded.ReadAsArray())
+            del decoded
+            gdal.Unlink(file_path)
+
+        # a lower quality is a smaller file
+        self.assertLess(len(encode_dataset(self.dataset, FileType.JPEG, quality=10)),
+                        len(encode_dataset(self.dataset, FileType.JPEG, quality=95)))
+
+        self.assertEqual(".png", FileTypeMap.get_suffix(epl_imagery_pb2.PNG))
+        self.assertEqual(".tif", FileTypeMap.get_suffix(FileType.GEOTIFF))
+
+    def test_unsupported(self):
+        uint16 = gdal.GetDriverByName("MEM").Create("", 10, 10, 3, gdal.GDT_UInt16)
+        with self.assertRaises(ValueError):
+            encode_dataset(uint16, FileType.JPEG)
+        encode_dataset(uint16, FileType.PNG)
+
+        rgba = gdal.GetDriverByName("MEM").Create("", 10, 10, 4, gdal.GDT_Byte)
+        with self.assertRaises(ValueError):
+            encode_dataset(rgba, FileType.JPEG)
+
+    def test_downsample(self):
+        downsampled = downsample_dataset(self.dataset, 4)
+        self.assertEqual((50, 25), (downsampled.RasterXSize, downsampled.RasterYSize))
+        self.assertEqual(120.0, downsampled.GetGeoTransform()[1])
+        self.assertEqual((1, 1), (downsample_dataset(self.dataset, 1000).RasterXSize,
+                                  downsample_dataset(self.dataset, 1000).RasterYSize))
+
+
+class TestGDALConfig(unittest.TestCase):
+    def test_thread_local(self):
+        results = {}
+
+        def other_thread():
+            results['other'] = gdal.GetConfigOption('GDAL_NUM_THREADS', None)
+
+        self.assertIsNone(GDALConfig.current())
+        with GDALConfig(IOProfile.LOCAL_SSD) as config:
+            self.assertIs(config, GDALConfig.current())
+            self.assertEqual("ALL_CPUS", gdal.GetConfigOption('GDAL_NUM_THREADS', None))
+            self.assertEqual(512 * 1024 * 1024, GDALConfig.warp_memory_limit())
+
+            thread = threading.Thread(target=other_thread)
+            thread.start()
+            thread.join()
+
+            with GDALConfig(GDAL_NUM_THREADS=1):
+                self.assertEqual("1", gdal.GetConfigOption('GDAL_NUM_THREADS', None))
+                # the inner config doesn't set warp memory, so the outer profile's still applies
+                self.assertEqual(512 * 1024 * 1024, GDALConfig.warp_memory_limit())
+
+            self.assertEqual("ALL_CPUS", gdal.GetConfigOption('GDAL_NUM_THREADS', None))
+
+        self.assertIsNone(results['other'])
+        self.assertIsNone(GDALConfig.current())
+        self.assertIsNone(gdal.GetThreadLocalConfigOption('GDAL_NUM_THREADS', None))
+
+    def test_shared_and_nested(self):
+        config = GDALConfig(GDAL_NUM_THREADS=2)
+        entered = threading.Barrier(2)
+        results = []
+
+        def other_thread():
+            with config:
+                entered.wait()
+                # both threads are in the same instance, each restores its own value on the way out
+                entered.wait()
+            results.append(gdal.GetThreadLocalConfigOption('GDAL_NUM_THREADS', None))
+
+        thread = threading.Thread(target=other_thread)
+        thread.start()
+        gdal.SetThreadLocalConfigOption('GDAL_NUM_THREADS', "3")
+        try:
+            with config:
+                entered.wait()
+                with config:
+                    self.assertEqual("2", gdal.GetThreadLocalConfigOption('GDAL_NUM_THREADS', None))
+                self.assertEqual("2", gdal.GetThreadLocalConfigOption('GDAL_NUM_THREADS', None))
+                entered.wait()
+            thread.join()
+            self.assertEqual("3", gdal.GetThreadLocalConfigOption('GDAL_NUM_THREADS', None))
+            self.assertEqual([None], results)
+        finally:
+            gdal.SetThreadLocalConfigOption('GDAL_NUM_THREADS', None)
+
+    def test_cache_max_only_grows(self):
+        gdal.SetCacheMax(2048 * 1024 * 1024)
+        with GDALConfig(IOProfile.FUSE):
+            self.assertEqual(2048 * 1024 * 1024, gdal.GetCacheMax())
+
+
 class TestWRSGeometries(unittest.TestCase):
     test_cases = [[15.74326, 26.98611, 1, 1, 1, 0, 13001, 13001, 13, 1, 'D', 1, 2233],
                   [2.74362, 6.65058, 942, 942, 1, 0, 61198, 61198, 61, 198, 'A', 1, 3174],
@@ -800,6 +1103,266 @@ class TestLandsat(unittest.TestCase):
 
         # TODO needs shape test
 
+    def test_cutline_raster_mask(self):
+        landsat = Landsat(self.metadata_set[0])
+
+        band_numbers = [Band.RED, Band.GREEN, Band.BLUE]
+        scale_params = [[0.0, 65535], [0.0, 65535], [0.0, 65535]]
+        nda_warped = landsat.fetch_imagery_array(band_numbers,
+                                                 scale_params,
+                                                 self.taos_shape.wkb,
+                                                 spatial_resolution_m=480)
+        nda_masked = landsat.fetch_imagery_array(band_numbers,
+                                                 scale_params,
+                                                 self.taos_shape.wkb,
+                                                 spatial_resolution_m=480,
+                                                 cutline_mode=CutlineMode.RASTER_MASK)
+        self.assertEqual(nda_warped.shape, nda_masked.shape)
+        self.assertEqual(nda_warped.dtype, nda_masked.dtype)
+
+        # warp and rasterize may disagree on the pixels along the polygon edge
+        differing = np.count_nonzero(np.any(nda_warped != nda_masked, axis=2))
+        self.assertLess(differing / (nda_masked.shape[0] * nda_masked.shape[1]), 0.05)
+
+    def test_cutline_projected(self):
+        landsat = Landsat(self.metadata_set[0])
+
+        band_numbers = [Band.RED, Band.GREEN, Band.BLUE]
+        scale_params = [[0.0, 65535], [0.0, 65535], [0.0, 65535]]
+        # web mercator, neither wgs84 nor the scene's utm zone
+        wgs84_cs = pyproj.Proj(init='epsg:4326')
+        mercator_cs = pyproj.Proj(init='epsg:3857')
+        centroid = self.taos_shape.centroid
+        plot = shapely.geometry.Point(centroid.x, centroid.y).buffer(0.05)
+        polygon = shapely.geometry.Polygon([pyproj.transform(wgs84_cs, mercator_cs, x, y)
+                                            for x, y in plot.exterior.coords])
+
+        nda_warped = landsat.fetch_imagery_array(band_numbers,
+                                                 scale_params,
+                                                 polygon.wkb,
+                                                 boundary_cs=3857,
+                                                 spatial_resolution_m=120)
+        nda_masked = landsat.fetch_imagery_array(band_numbers,
+                                                 scale_params,
+                                                 polygon.wkb,
+                                                 boundary_cs=3857,
+                                                 spatial_resolution_m=120,
+                                                 cutline_mode=CutlineMode.RASTER_MASK)
+        self.assertEqual(nda_warped.shape, nda_masked.shape)
+
+        # the circle covers most of its envelope in both modes
+        pixel_count = nda_masked.shape[0] * nda_masked.shape[1]
+        self.assertGreater(np.count_nonzero(np.any(nda_warped != 0, axis=2)) / pixel_count, 0.5)
+        self.assertGreater(np.count_nonzero(np.any(nda_masked != 0, axis=2)) / pixel_count, 0.5)
+        differing = np.count_nonzero(np.any(nda_warped != nda_masked, axis=2))
+        self.assertLess(differing / pixel_count, 0.05)
+
+    def test_iter_imagery_blocks(self):
+        landsat = Landsat(self.metadata_set[0])
+
+        band_numbers = [Band.RED, Band.GREEN, Band.BLUE]
+        scale_params = [[0.0, 65535], [0.0, 65535], [0.0, 65535]]
+        nda = landsat.fetch_imagery_array(band_numbers,
+                                          scale_params,
+                                          envelope_boundary=self.taos_shape.bounds,
+                                          spatial_resolution_m=240)
+
+        assembled = np.zeros_like(nda)
+        block_count = 0
+        for window, block in landsat.iter_imagery_blocks(band_numbers,
+                                                         scale_params,
+                                                         envelope_boundary=self.taos_shape.bounds,
+                                                         spatial_resolution_m=240,
+                                                         block_size=128):
+            x_offset, y_offset, x_size, y_size = window
+            self.assertEqual(0, x_offset % 128)
+            self.assertEqual(0, y_offset % 128)
+            self.assertEqual((y_size, x_size, 3), block.shape)
+            assembled[y_offset:y_offset + y_size, x_offset:x_offset + x_size] = block
+            block_count += 1
+
+        self.assertGreater(block_count, 1)
+        np.testing.assert_array_equal(nda, assembled)
+
+        # the polygon rasterized onto each block from its own coordinate system
+        nda = landsat.fetch_imagery_array(band_numbers,
+                                          scale_params,
+                                          polygon_boundary_wkb=self.taos_shape.wkb,
+                                          spatial_resolution_m=240,
+                                          cutline_mode=CutlineMode.RASTER_MASK)
+        assembled = np.zeros_like(nda)
+        for (x_offset, y_offset, x_size, y_size), block in landsat.iter_imagery_blocks(
+                band_numbers,
+                scale_params,
+                polygon_boundary_wkb=self.taos_shape.wkb,
+                boundary_cs=4326,
+                spatial_resolution_m=240,
+                block_size=128,
+                cutline_mode=CutlineMode.RASTER_MASK):
+            assembled[y_offset:y_offset + y_size, x_offset:x_offset + x_size] = block
+        np.testing.assert_array_equal(nda, assembled)
+
+    def test_iter_imagery_blocks_band_math(self):
+        landsat = Landsat(self.metadata_set[0])
+        ndvi = FunctionDetails(name="ndvi_expression", band_definitions=[Band.RED, Band.NIR],
+                               data_type=DataType.FLOAT32, expression="(NIR - RED) / (NIR + RED)")
+        band_numbers = [ndvi, Band.RED]
+        # no source range for ndvi, it's the range of the whole request and not of each block
+        scale_params = [[], [0.0, 40000.0]]
+        nda = landsat.fetch_imagery_array(band_numbers,
+                                          scale_params,
+                                          envelope_boundary=self.taos_shape.bounds,
+                                          spatial_resolution_m=240)
+
+        assembled = np.zeros_like(nda)
+        for (x_offset, y_offset, x_size, y_size), block in landsat.iter_imagery_blocks(
+                band_numbers,
+                scale_params,
+                envelope_boundary=self.taos_shape.bounds,
+                spatial_resolution_m=240,
+                block_size=128):
+            assembled[:, y_offset:y_offset + y_size, x_offset:x_offset + x_size] = block
+        np.testing.assert_array_equal(nda, assembled)
+
+    def test_iter_imagery_chunks(self):
+        landsat = Landsat(self.metadata_set[0])
+
+        for band_numbers in [[Band.RED, Band.GREEN, Band.BLUE], [Band.RED, Band.NIR]]:
+            scale_params = [[0.0, 65535]] * len(band_numbers)
+            nda = landsat.fetch_imagery_array(band_numbers,
+                                              scale_params,
+                                              envelope_boundary=self.taos_shape.bounds,
+                                              spatial_resolution_m=240)
+
+            chunks = list(landsat.iter_imagery_chunks(band_numbers,
+                                                      scale_params,
+                                                      envelope_boundary=self.taos_shape.bounds,
+                                                      spatial_resolution_m=240,
+                                                      chunk_rows=100,
+                                                      compression=Compression.DEFLATE))
+            self.assertGreater(len(chunks), 1)
+            for chunk in chunks:
+                self.assertEqual(list(nda.shape), list(chunk.shape))
+                self.assertEqual(0, chunk.offset[-1])
+
+            np.testing.assert_array_equal(nda, assemble_ndarray_chunks(chunks))
+            out = np.zeros_like(nda)
+            self.assertIs(out, assemble_ndarray_chunks(chunks, out=out))
+            np.testing.assert_array_equal(nda, out)
+
+    def test_export_cog(self):
+        landsat = Landsat(self.metadata_set)
+        band_numbers = [Band.RED, Band.GREEN, Band.BLUE, Band.ALPHA]
+        scale_params = [[0.0, 40000.0], [0.0, 40000.0], [0.0, 40000.0]]
+        nda = landsat.fetch_imagery_array(band_numbers,
+                                          scale_params,
+                                          polygon_boundary_wkb=self.taos_shape.wkb,
+                                          spatial_resolution_m=60)
+        # the mosaic's grid, the COG is read scene by scene but has to land on the same pixels
+        expected = landsat.get_dataset(band_numbers[:3],
+                                       DataType.BYTE,
+                                       scale_params=scale_params,
+                                       envelope_boundary=self.taos_shape.bounds,
+                                       polygon_boundary_wkb=self.taos_shape.wkb,
+                                       spatial_resolution_m=60)
+        geo_transform = expected.GetGeoTransform()
+        del expected
+
+        directory = tempfile.mkdtemp()
+        try:
+            for compression in [Compression.DEFLATE, Compression.ZSTD]:
+                file_path = os.path.join(directory, "{}.tif".format(compression.name))
+                landsat.export_cog(file_path,
+                                   band_numbers,
+                                   scale_params,
+                                   polygon_boundary_wkb=self.taos_shape.wkb,
+                                   spatial_resolution_m=60,
+                                   compression=compression,
+                                   block_size=128)
+
+                dataset = gdal.Open(file_path)
+                self.assertEqual(compression.name, dataset.GetMetadataItem("COMPRESSION", "IMAGE_STRUCTURE"))
+                self.assertEqual([128, 128], dataset.GetRasterBand(1).GetBlockSize())
+                self.assertGreater(dataset.GetRasterBand(1).GetOverviewCount(), 0)
+                self.assertEqual(gdal.GCI_AlphaBand, dataset.GetRasterBand(4).GetColorInterpretation())
+                np.testing.assert_array_almost_equal(geo_transform, dataset.GetGeoTransform())
+                np.testing.assert_array_equal(nda, np.moveaxis(dataset.ReadAsArray(), 0, -1))
+                del dataset
+            # the temporary GeoTIFFs were written next to the COGs and removed
+            self.assertEqual(["DEFLATE.tif", "ZSTD.tif"], sorted(os.listdir(directory)))
+
+            with self.assertRaises(ValueError):
+                landsat.export_cog(os.path.join(directory, "lz4.tif"), band_numbers, scale_params,
+                                   compression=Compression.LZ4)
+
+            # a web mercator polygon applied as a raster mask, like fetch_imagery_array does
+            wgs84_cs = pyproj.Proj(init='epsg:4326')
+            mercator_cs = pyproj.Proj(init='epsg:3857')
+            centroid = self.taos_shape.centroid
+            plot = shapely.geometry.Point(centroid.x, centroid.y).buffer(0.05)
+            polygon = shapely.geometry.Polygon([pyproj.transform(wgs84_cs, mercator_cs, x, y)
+                                                for x, y in plot.exterior.coords])
+            scene = Landsat(self.metadata_set[0])
+            nda = scene.fetch_imagery_array(band_numbers[:3],
+                                            scale_params,
+                                            polygon_boundary_wkb=polygon.wkb,
+                                            boundary_cs=3857,
+                                            spatial_resolution_m=120,
+                                            cutline_mode=CutlineMode.RASTER_MASK)
+            file_path = os.path.join(directory, "masked.tif")
+            scene.export_cog(file_path,
+                             band_numbers[:3],
+                             scale_params,
+                             polygon_boundary_wkb=polygon.wkb,
+                             boundary_cs=3857,
+                             spatial_resolution_m=120,
+                             cutline_mode=CutlineMode.RASTER_MASK,
+                             block_size=128)
+            dataset = gdal.Open(file_path)
+            np.testing.assert_array_equal(nda, np.moveaxis(dataset.ReadAsArray(), 0, -1))
+            del dataset
+            self.assertIsNone(GDALConfig.current())
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def test_iter_imagery_blocks_mosaic(self):
+        landsat = Landsat(self.metadata_set)
+
+        band_numbers = [Band.NIR, Band.SWIR1, Band.SWIR2, Band.ALPHA]
+        scale_params = [[0.0, 40000.0], [0.0, 40000.0], [0.0, 40000.0]]
+        for window, block in landsat.iter_imagery_blocks(band_numbers,
+                                                         scale_params,
+                                                         polygon_boundary_wkb=self.taos_shape.wkb,
+                                                         spatial_resolution_m=240,
+                                                         block_size=128):
+            self.assertEqual((window[3], window[2], 4), block.shape)
+            self.assertTrue(np.all(block[block[:, :, 3] == 0][:, :3] == 0))
+
+    def test_iter_imagery_blocks_mosaic_cutline(self):
+        # the blocks warp scene by scene, fetch_imagery_array warps the mosaic in one go, both on the same grid
+        landsat = Landsat(self.metadata_set)
+
+        band_numbers = [Band.NIR, Band.SWIR1, Band.SWIR2, Band.ALPHA]
+        scale_params = [[0.0, 40000.0], [0.0, 40000.0], [0.0, 40000.0]]
+        nda = landsat.fetch_imagery_array(band_numbers,
+                                          scale_params,
+                                          polygon_boundary_wkb=self.taos_shape.wkb,
+                                          spatial_resolution_m=240)
+
+        assembled = np.zeros_like(nda)
+        block_count = 0
+        for window, block in landsat.iter_imagery_blocks(band_numbers,
+                                                         scale_params,
+                                                         polygon_boundary_wkb=self.taos_shape.wkb,
+                                                         spatial_resolution_m=240,
+                                                         block_size=128):
+            x_offset, y_offset, x_size, y_size = window
+            assembled[y_offset:y_offset + y_size, x_offset:x_offset + x_size] = block
+            block_count += 1
+
+        self.assertGreater(block_count, 1)
+        np.testing.assert_array_equal(nda, assembled)
+
     def test_mosaic(self):
         # GDAL helper functions for generating VRT
         landsat = Landsat(self.metadata_set)
@@ -813,6 +1376,28 @@ class TestLandsat(unittest.TestCase):
 
         # TODO needs shape test
 
+    def test_mosaic_grid(self):
+        # the mosaic keeps the grid gdal.Warp gave it before the warp options were set explicitly
+        band_numbers = [Band.RED, Band.GREEN, Band.BLUE]
+        scale_params = [[0.0, 65535], [0.0, 65535], [0.0, 65535]]
+        scenes = [Landsat(metadata).get_dataset(band_numbers,
+                                                DataType.BYTE,
+                                                scale_params,
+                                                envelope_boundary=self.taos_shape.bounds,
+                                                spatial_resolution_m=120)
+                  for metadata in self.metadata_set]
+        self.assertGreater(len(scenes), 1)
+        expected = gdal.Warp("", scenes, format='MEM', dstNodata=0)
+
+        dataset = Landsat(self.metadata_set).get_dataset(band_numbers,
+                                                         DataType.BYTE,
+                                                         scale_params,
+                                                         envelope_boundary=self.taos_shape.bounds,
+                                                         spatial_resolution_m=120)
+        self.assertEqual((expected.RasterXSize, expected.RasterYSize), (dataset.RasterXSize, dataset.RasterYSize))
+        np.testing.assert_array_almost_equal(expected.GetGeoTransform(), dataset.GetGeoTransform())
+        self.assertEqual(0, dataset.GetRasterBand(1).GetNoDataValue())
+
     def test_mosaic_cutline(self):
         # GDAL helper functions for generating VRT
         landsat = Landsat(self.metadata_set)
@@ -873,6 +1458,250 @@ class TestLandsat(unittest.TestCase):
         self.assertIsNotNone(nda)
         self.assertEqual((1804, 1295, 3), nda.shape)
 
+    def test_disk_cache(self):
+        cache_path = tempfile.mkdtemp()
+        landsat = Landsat(self.metadata_set)
+        landsat.disk_cache = DiskCache(cache_path)
+        try:
+            band_numbers = [Band.RED, Band.GREEN, Band.BLUE]
+            scale_params = [[0.0, 40000], [0.0, 40000], [0.0, 40000]]
+            nda = landsat.fetch_imagery_array(band_numbers,
+                                              scale_params,
+                                              envelope_boundary=self.taos_shape.bounds,
+                                              spatial_resolution_m=240)
+            self.assertEqual(1, len(landsat.disk_cache))
+
+            # another process, or another run, finds it
+            other = Landsat(self.metadata_set)
+            other.disk_cache = DiskCache(cache_path)
+            np.testing.assert_array_equal(nda, other.fetch_imagery_array(band_numbers,
+                                                                         scale_params,
+                                                                         envelope_boundary=self.taos_shape.bounds,
+                                                                         spatial_resolution_m=240))
+            self.assertEqual(1, len(other.disk_cache))
+
+            # a different grid is a different entry
+            other.fetch_imagery_array(band_numbers,
+                                      scale_params,
+                                      envelope_boundary=self.taos_shape.bounds,
+                                      spatial_resolution_m=480)
+            self.assertEqual(2, len(other.disk_cache))
+
+            dataset = landsat.get_dataset(band_numbers, DataType.BYTE, scale_params,
+                                          envelope_boundary=self.taos_shape.bounds, spatial_resolution_m=240)
+            cached = other.get_dataset(band_numbers, DataType.BYTE, scale_params,
+                                       envelope_boundary=self.taos_shape.bounds, spatial_resolution_m=240)
+            self.assertEqual(dataset.GetGeoTransform(), cached.GetGeoTransform())
+            np.testing.assert_array_equal(dataset.ReadAsArray(), cached.ReadAsArray())
+        finally:
+            shutil.rmtree(cache_path, ignore_errors=True)
+
+    def test_get_file(self):
+        landsat = Landsat(self.metadata_set)
+        band_numbers = [Band.RED, Band.GREEN, Band.BLUE]
+        scale_params = [[0.0, 40000], [0.0, 40000], [0.0, 40000]]
+        data, spatial_resolution_m = landsat.get_file(band_numbers,
+                                                      FileType.PNG,
+                                                      scale_params=scale_params,
+                                                      polygon_boundary_wkb=self.taos_shape.wkb,
+                                                      spatial_resolution_m=120)
+        self.assertEqual(b"\x89PNG", data[:4])
+        self.assertEqual(120, spatial_resolution_m)
+
+        # downsampled until it fits
+        jpeg, spatial_resolution_m = landsat.get_file(band_numbers,
+                                                      FileType.JPEG,
+                                                      scale_params=scale_params,
+                                                      polygon_boundary_wkb=self.taos_shape.wkb,
+                                                      spatial_resolution_m=120,
+                                                      max_file_size=len(data) // 20,
+                                                      quality=75)
+        self.assertEqual(b"\xff\xd8", jpeg[:2])
+        self.assertLessEqual(len(jpeg), len(data) // 20)
+        self.assertGreater(spatial_resolution_m, 120)
+
+    def test_memory_budget(self):
+        landsat = Landsat(self.metadata_set)
+        band_numbers = [Band.RED, Band.GREEN, Band.BLUE]
+        scaleParams = [[0.0, 40000.0], [0.0, 40000.0], [0.0, 40000.0]]
+
+        plan = landsat.plan_request(band_numbers, polygon_boundary_wkb=self.taos_shape.wkb, spatial_resolution_m=120)
+        self.assertEqual(plan.x_size * plan.y_size * 3, plan.output_bytes)
+        self.assertGreater(plan.intermediate_bytes, plan.output_bytes)
+        self.assertAlmostEqual(648, plan.x_size, delta=4)
+        self.assertAlmostEqual(902, plan.y_size, delta=4)
+
+        with self.assertRaises(MemoryBudgetExceeded):
+            landsat.fetch_imagery_array(band_numbers, scaleParams, polygon_boundary_wkb=self.taos_shape.wkb,
+                                        spatial_resolution_m=120, memory_budget=MemoryBudget(plan.output_bytes))
+
+        tiled = landsat.fetch_imagery_array(band_numbers, scaleParams, polygon_boundary_wkb=self.taos_shape.wkb,
+                                            spatial_resolution_m=120,
+                                            memory_budget=MemoryBudget(plan.output_bytes * 2, BudgetAction.TILE))
+        self.assertEqual((902, 648, 3), tiled.shape)
+        np.testing.assert_array_equal(landsat.fetch_imagery_array(band_numbers, scaleParams,
+                                                                  polygon_boundary_wkb=self.taos_shape.wkb,
+                                                                  spatial_resolution_m=120),
+                                      tiled)
+
+        # a single scene tiled with a raster mask cutline
+        scene = Landsat(self.metadata_set[0])
+        scene_plan = scene.plan_request(band_numbers, polygon_boundary_wkb=self.taos_shape.wkb,
+                                        spatial_resolution_m=120)
+        masked = scene.fetch_imagery_array(band_numbers, scaleParams, polygon_boundary_wkb=self.taos_shape.wkb,
+                                           spatial_resolution_m=120, cutline_mode=CutlineMode.RASTER_MASK)
+        masked_tiled = scene.fetch_imagery_array(band_numbers, scaleParams, polygon_boundary_wkb=self.taos_shape.wkb,
+                                                 spatial_resolution_m=120, cutline_mode=CutlineMode.RASTER_MASK,
+                                                 memory_budget=MemoryBudget(scene_plan.output_bytes * 2,
+                                                                            BudgetAction.TILE))
+        np.testing.assert_array_equal(masked, masked_tiled)
+
+        downsampled = landsat.fetch_imagery_array(band_numbers, scaleParams,
+                                                  polygon_boundary_wkb=self.taos_shape.wkb,
+                                                  spatial_resolution_m=120,
+                                                  memory_budget=MemoryBudget(plan.total_bytes // 4,
+                                                                             BudgetAction.DOWNSAMPLE))
+        self.assertLess(downsampled.shape[0], 902 // 2 + 4)
+        self.assertLess(downsampled.shape[1], 648 // 2 + 4)
+
+        # a downsampled result is cached under the resolution it was read at
+        cache_path = tempfile.mkdtemp()
+        try:
+            landsat.disk_cache = DiskCache(cache_path)
+            landsat.fetch_imagery_array(band_numbers, scaleParams, polygon_boundary_wkb=self.taos_shape.wkb,
+                                        spatial_resolution_m=120,
+                                        memory_budget=MemoryBudget(plan.total_bytes // 4, BudgetAction.DOWNSAMPLE))
+            self.assertEqual((902, 648, 3), landsat.fetch_imagery_array(band_numbers, scaleParams,
+                                                                        polygon_boundary_wkb=self.taos_shape.wkb,
+                                                                        spatial_resolution_m=120).shape)
+        finally:
+            landsat.disk_cache = None
+            shutil.rmtree(cache_path, ignore_errors=True)
+
+        MemoryBudget.process_bytes = plan.total_bytes
+        try:
+            with MemoryBudget.reserve(1):
+                with self.assertRaises(MemoryBudgetExceeded):
+                    landsat.fetch_imagery_array(band_numbers, scaleParams, polygon_boundary_wkb=self.taos_shape.wkb,
+                                                spatial_resolution_m=120)
+            self.assertEqual(0, MemoryBudget.in_flight_bytes())
+        finally:
+            MemoryBudget.process_bytes = None
+
+    def test_disk_cache_dataset(self):
+        landsat = Landsat(self.metadata_set[0])
+        band_numbers = [Band.RED, Band.GREEN, Band.BLUE]
+        scale_params = [[0.0, 40000.0], [0.0, 40000.0], [0.0, 40000.0]]
+        cache_path = tempfile.mkdtemp()
+        try:
+            landsat.disk_cache = DiskCache(cache_path)
+            datasets = [landsat.get_dataset(band_numbers, DataType.BYTE, scale_params=scale_params,
+                                            envelope_boundary=self.taos_shape.bounds, spatial_resolution_m=240)
+                        for _ in range(2)]
+            self.assertEqual(1, len(landsat.disk_cache))
+            # the cached one is a MEM copy that can be written to, not the read only GeoTIFF
+            self.assertEqual("MEM", datasets[1].GetDriver().ShortName)
+            np.testing.assert_array_equal(datasets[0].ReadAsArray(), datasets[1].ReadAsArray())
+            self.assertEqual(gdal.CE_None, datasets[1].GetRasterBand(1).Fill(0))
+        finally:
+            landsat.disk_cache = None
+            shutil.rmtree(cache_path, ignore_errors=True)
+
+    def test_time_series(self):
+        landsat = Landsat(self.metadata_set)
+        band_numbers = [Band.RED, Band.NIR, Band.ALPHA]
+        scaleParams = [[0.0, 40000.0], [0.0, 40000.0]]
+
+        cube = landsat.fetch_time_series(band_numbers, scaleParams, polygon_boundary_wkb=self.taos_shape.wkb,
+                                         spatial_resolution_m=240, target_cs=32613)
+        self.assertEqual(4, cube.ndim)
+        self.assertEqual((len(self.metadata_set), 3), cube.shape[:2])
+        for frame in cube:
+            # every frame covers part of Taos and has nothing outside of it
+            self.assertGreater(np.count_nonzero(frame[2]), 0)
+            np.testing.assert_array_equal(frame[0][frame[2] == 0], 0)
+
+        out = np.zeros(cube.shape, dtype=np.uint8)
+        result = landsat.fetch_time_series(band_numbers, scaleParams, polygon_boundary_wkb=self.taos_shape.wkb,
+                                           spatial_resolution_m=240, target_cs=32613, out=out, max_workers=1)
+        self.assertIs(out, result)
+        np.testing.assert_array_equal(cube, out)
+
+    def test_sample_points(self):
+        landsat = Landsat(self.metadata_set)
+        ndvi = FunctionDetails.from_spectral_index("ndvi")
+        centroid = self.taos_shape.centroid
+        points = [centroid, (centroid.x + 0.01, centroid.y - 0.01), (0.0, 0.0)]
+
+        samples = landsat.sample_points(points, [Band.RED, Band.NIR, ndvi])
+        self.assertEqual((3, len(self.metadata_set), 3), samples.shape)
+        # null island isn't in any scene
+        self.assertTrue(np.all(np.isnan(samples[2])))
+
+        covered = ~np.isnan(samples[0, :, 0])
+        self.assertTrue(np.any(covered))
+        red, nir = samples[0, covered, 0], samples[0, covered, 1]
+        np.testing.assert_almost_equal((nir - red) / (nir + red), samples[0, covered, 2], decimal=5)
+
+        self.assertRaises(ValueError, lambda: landsat.sample_points(points, [Band.RED, Band.ALPHA]))
+
+    def test_fetch_imagery_arrays(self):
+        landsat = Landsat(self.metadata_set[0])
+        band_numbers = [Band.RED, Band.GREEN, Band.BLUE]
+        scale_params = [[0.0, 40000], [0.0, 40000], [0.0, 40000]]
+        centroid = self.taos_shape.centroid
+        plot = shapely.geometry.Point(centroid.x, centroid.y).buffer(0.01)
+        boundaries = [self.taos_shape.bounds, plot.wkb, plot.bounds, (0.0, 0.0, 0.1, 0.1)]
+
+        results = landsat.fetch_imagery_arrays(band_numbers,
+                                               boundaries,
+                                               scale_params=scale_params,
+                                               spatial_resolution_m=120)
+        self.assertEqual(4, len(results))
+        for nda in results:
+            self.assertEqual(3, nda.ndim)
+            self.assertEqual(3, nda.shape[2])
+            self.assertTrue(nda.flags['C_CONTIGUOUS'])
+
+        # the polygon is its envelope with the corners outside of the circle zeroed
+        self.assertEqual(results[2].shape, results[1].shape)
+        inside = np.any(results[1] != 0, axis=2)
+        np.testing.assert_array_equal(results[2][inside], results[1][inside])
+        self.assertFalse(np.any(results[1][0, 0]))
+        self.assertGreater(results[0].size, results[2].size)
+
+        # null island is outside of the scene
+        self.assertEqual(0, results[3].size)
+
+        self.assertRaises(ValueError, lambda: Landsat(self.metadata_set).fetch_imagery_arrays(band_numbers, boundaries))
+
+    def test_fetch_imagery_arrays_projected(self):
+        landsat = Landsat(self.metadata_set[0])
+        band_numbers = [Band.RED, Band.GREEN, Band.BLUE]
+        scale_params = [[0.0, 40000], [0.0, 40000], [0.0, 40000]]
+
+        # a utm zone 13 north box around taos and the same box in wgs84
+        wgs84_cs = pyproj.Proj(init='epsg:4326')
+        utm_cs = pyproj.Proj(init='epsg:32613')
+        bounds = self.taos_shape.bounds
+        xmin, ymin = pyproj.transform(wgs84_cs, utm_cs, bounds[0], bounds[1])
+        xmax, ymax = pyproj.transform(wgs84_cs, utm_cs, bounds[2], bounds[3])
+        utm_envelope = (xmin, ymin, xmax, ymax)
+        west, south = pyproj.transform(utm_cs, wgs84_cs, xmin, ymin)
+        east, north = pyproj.transform(utm_cs, wgs84_cs, xmax, ymax)
+
+        results = landsat.fetch_imagery_arrays(band_numbers,
+                                               [utm_envelope],
+                                               scale_params=scale_params,
+                                               boundary_cs=32613,
+                                               spatial_resolution_m=120)
+        expected = landsat.fetch_imagery_array(band_numbers,
+                                               scale_params,
+                                               envelope_boundary=(west, south, east, north),
+                                               spatial_resolution_m=120)
+        self.assertGreater(expected.size, 0)
+        np.testing.assert_array_equal(expected, results[0])
+
     def test_datatypes(self):
         landsat = Landsat(self.metadata_set)
 
@@ -907,6 +1736,24 @@ class TestLandsat(unittest.TestCase):
                                           spatial_resolution_m=120)
         self.assertIsNotNone(nda)
 
+    def test_single_scene_alpha(self):
+        landsat = Landsat(self.metadata_set[0])
+
+        band_numbers = [Band.RED, Band.GREEN, Band.BLUE, Band.ALPHA]
+        scaleParams = [[0.0, 40000], [0.0, 40000], [0.0, 40000]]
+
+        nda = landsat.fetch_imagery_array(band_numbers,
+                                          scaleParams,
+                                          output_type=DataType.BYTE,
+                                          spatial_resolution_m=960)
+        self.assertIsNotNone(nda)
+        self.assertEqual(4, nda.shape[2])
+        self.assertEqual({0, 255}, set(np.unique(nda[:, :, 3])))
+
+        # the corners of a landsat scene are outside of the collect
+        self.assertEqual(0, nda[0, 0, 3])
+        self.assertTrue(np.all(nda[nda[:, :, 3] == 0][:, :3] == 0))
+
     def test_rastermetadata_cache(self):
         # GDAL helper functions for generating VRT
         landsat = Landsat(self.metadata_set)
@@ -929,6 +1776,58 @@ class TestLandsat(unittest.TestCase):
         self.assertIsNotNone(nda)
         self.assertNotEqual((902, 648, 3), nda.shape)
 
+    def test_interleaved_out(self):
+        landsat = Landsat(self.metadata_set)
+        band_numbers = [Band.RED, Band.GREEN, Band.BLUE]
+        scaleParams = [[0.0, 40000.0], [0.0, 40000.0], [0.0, 40000.0]]
+
+        nda = landsat.fetch_imagery_array(band_numbers, scaleParams, polygon_boundary_wkb=self.taos_shape.wkb, spatial_resolution_m=120)
+        self.assertEqual((902, 648, 3), nda.shape)
+        self.assertTrue(nda.flags.c_contiguous)
+
+        out = np.empty((902, 648, 3), dtype=np.uint8)
+        result = landsat.fetch_imagery_array(band_numbers, scaleParams, polygon_boundary_wkb=self.taos_shape.wkb, spatial_resolution_m=120, out=out)
+        self.assertIs(out, result)
+        np.testing.assert_array_equal(nda, out)
+
+        with self.assertRaises(ValueError):
+            landsat.fetch_imagery_array(band_numbers, scaleParams, polygon_boundary_wkb=self.taos_shape.wkb, spatial_resolution_m=120, out=np.empty((3, 902, 648), dtype=np.uint8))
+
+    def test_lut_scale(self):
+        # a single scene without a cutline is scaled through lookup tables instead of by gdal.Translate
+        landsat = Landsat(self.metadata_set[0])
+        band_definitions = [Band.RED, Band.GREEN, Band.BLUE, Band.ALPHA]
+        scale_params = [[500.0, 30000.0, 1, 255]]
+
+        nda = landsat.fetch_imagery_array(band_definitions, scale_params, spatial_resolution_m=240)
+        dataset = landsat.get_dataset(band_definitions, DataType.BYTE, scale_params=scale_params,
+                                      spatial_resolution_m=240)
+        expected = dataset.ReadAsArray().transpose((1, 2, 0))
+        del dataset
+
+        self.assertEqual(expected.shape, nda.shape)
+        self.assertEqual(np.uint8, nda.dtype)
+        np.testing.assert_array_equal(expected, nda)
+
+    def test_auto_scale(self):
+        landsat = Landsat(self.metadata_set[0])
+        band_definitions = [Band.RED, Band.GREEN, Band.BLUE]
+
+        statistics = landsat.get_band_statistics(Band.RED)
+        self.assertIs(statistics.histogram, landsat.get_band_statistics(Band.RED).histogram)
+        self.assertLess(statistics.percentile(2), statistics.percentile(98))
+        self.assertLessEqual(statistics.min, statistics.percentile(2))
+
+        scale_params = landsat.get_auto_scale_params(band_definitions, DataType.BYTE)
+        self.assertEqual(3, len(scale_params))
+        self.assertEqual([statistics.percentile(2), statistics.percentile(98), 1, 255], scale_params[0])
+
+        nda = landsat.fetch_imagery_array(band_definitions, "auto", spatial_resolution_m=240)
+        expected = landsat.fetch_imagery_array(band_definitions, scale_params, spatial_resolution_m=240)
+        np.testing.assert_array_equal(expected, nda)
+
+        self.assertRaises(ValueError, lambda: landsat.get_auto_scale_params(band_definitions, DataType.FLOAT32))
+
     def test_two_bands(self):
         # specify the bands that approximate real color
         landsat = Landsat(self.metadata_set)
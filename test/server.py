@@ -0,0 +1,322 @@
+import time
+import random
+import shutil
+import tempfile
+import threading
+import unittest
+
+import grpc
+import numpy as np
+import shapely.geometry
+
+from concurrent.futures import ThreadPoolExecutor
+
+from epl.grpc.imagery import epl_imagery_pb2, epl_imagery_pb2_grpc
+from epl.native.imagery.reader import DataType, FunctionDetails
+from epl.native.imagery.metadata_helpers import Band
+from epl.native.imagery.ndarray_result import from_ndarray_result, assemble_ndarray_chunks, to_shared_memory_result, \
+    SharedMemoryArray
+from epl.service.imagery.server import ImageryServer, ImageryServicer, get_band_definitions, get_fetch_arguments, \
+    get_request_key
+from epl.service.imagery.single_flight import SingleFlight, DeadlineExpired
+from epl.service.imagery.result_cache import ResultCache
+from epl.service.imagery.shared_memory_leases import SharedMemoryLeases
+from epl.service.imagery.load_test import create_synthetic_scenes, get_random_request
+
+
+class TestRequestArguments(unittest.TestCase):
+    def test_band_definitions(self):
+        request = epl_imagery_pb2.ImageryRequest()
+        request.band_definitions.add(band_type=epl_imagery_pb2.RED, scale_params=[0, 40000])
+        request.band_definitions.add(band_number=5, scale_params=[0, 40000])
+        ndvi = request.band_definitions.add(scale_params=[-1, 1])
+        ndvi.band_function.name = "ndvi"
+        request.band_definitions.add(band_type=epl_imagery_pb2.ALPHA)
+        request.envelope_boundary.extend([-105.6, 36.3, -105.5, 36.4])
+        request.output_type = epl_imagery_pb2.UINT16
+
+        arguments = get_fetch_arguments(request)
+        band_definitions = arguments['band_definitions']
+        self.assertIs(Band.RED, band_definitions[0])
+        self.assertEqual(5, band_definitions[1])
+        self.assertIsInstance(band_definitions[2], FunctionDetails)
+        self.assertEqual([Band.RED, Band.NIR], list(band_definitions[2].band_definitions))
+        self.assertIs(Band.ALPHA, band_definitions[3])
+
+        # alpha has no scale
+        self.assertEqual([[0, 40000], [0, 40000], [-1, 1]], arguments['scale_params'])
+        self.assertEqual(4, len(arguments['envelope_boundary']))
+        self.assertIs(DataType.UINT16, arguments['output_type'])
+        self.assertEqual(60, arguments['spatial_resolution_m'])
+        self.assertEqual(4326, arguments['boundary_cs'])
+
+        request.auto_scale = True
+        request.polygon_boundary_wkb = shapely.geometry.box(-105.6, 36.3, -105.5, 36.4).wkb
+        arguments = get_fetch_arguments(request)
+        self.assertEqual("auto", arguments['scale_params'])
+        self.assertIn('polygon_boundary_wkb', arguments)
+        self.assertNotIn('envelope_boundary', arguments)
+
+    def test_expression(self):
+        function = epl_imagery_pb2.BandFunctionDetails(name="ratio",
+                                                       expression="NIR / RED",
+                                                       data_type=epl_imagery_pb2.FLOAT32)
+        function.band_definitions.add(band_type=epl_imagery_pb2.NIR)
+        function.band_definitions.add(band_type=epl_imagery_pb2.RED)
+        band_definitions = get_band_definitions([epl_imagery_pb2.BandDefinition(band_function=function)])
+        self.assertEqual("NIR / RED", band_definitions[0].expression)
+        self.assertIs(DataType.FLOAT32, band_definitions[0].data_type)
+
+
+class TestImageryServer(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.base_mount_path = tempfile.mkdtemp()
+        cls.metadata_results = create_synthetic_scenes(cls.base_mount_path, scene_count=2, size=512)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.base_mount_path, ignore_errors=True)
+
+    def __check_server(self, b_aio):
+        server = ImageryServer(port=0, max_workers=2, b_aio=b_aio, base_mount_path=self.base_mount_path).start()
+        try:
+            channel = grpc.insecure_channel("localhost:{}".format(server.port))
+            stub = epl_imagery_pb2_grpc.ImageryOperatorsStub(channel)
+            request = get_random_request(self.metadata_results, 0.05, 60, True, random.Random(0))
+            nda = from_ndarray_result(stub.ImagerySearchNArray(request, timeout=30))
+            self.assertEqual(3, nda.ndim)
+            self.assertEqual(np.uint8, nda.dtype)
+            self.assertTrue(np.any(nda))
+
+            # the repeat is answered from the result cache
+            np.testing.assert_array_equal(nda, from_ndarray_result(stub.ImagerySearchNArray(request, timeout=30)))
+            self.assertEqual(1, server.stats()['result_cache']['hits'])
+
+            request.chunk_rows = 16
+            np.testing.assert_array_equal(nda, assemble_ndarray_chunks(
+                stub.ImagerySearchNArrayStream(request, timeout=30)))
+
+            file_request = epl_imagery_pb2.ImageryFileRequest(imagery_request=request, file_type=epl_imagery_pb2.PNG)
+            png = stub.ImageryCompleteFile(file_request, timeout=30)
+            self.assertEqual(b"\x89PNG", png.data[:4])
+            self.assertEqual(len(png.data), png.file_size)
+            self.assertEqual(60, png.spatial_resolution_m)
+
+            # downsampled to fit, rather than failed
+            file_request.max_file_size = png.file_size // 4
+            small = stub.ImageryCompleteFile(file_request, timeout=30)
+            self.assertLessEqual(small.file_size, png.file_size // 4)
+            self.assertGreater(small.spatial_resolution_m, 60)
+
+            # a request with no scenes is the client's mistake
+            with self.assertRaises(grpc.RpcError) as context:
+                stub.ImagerySearchNArray(epl_imagery_pb2.ImageryRequest(), timeout=30)
+            self.assertIs(grpc.StatusCode.INVALID_ARGUMENT, context.exception.code())
+            channel.close()
+        finally:
+            server.stop(grace=5.0)
+
+    def test_thread_pool(self):
+        self.__check_server(b_aio=False)
+
+    def test_aio(self):
+        self.__check_server(b_aio=True)
+
+    def test_shared_memory(self):
+        server = ImageryServer(port=0, max_workers=2, base_mount_path=self.base_mount_path, b_shared_memory=True,
+                               result_cache_bytes=0).start()
+        try:
+            channel = grpc.insecure_channel("localhost:{}".format(server.port))
+            stub = epl_imagery_pb2_grpc.ImageryOperatorsStub(channel)
+            request = get_random_request(self.metadata_results, 0.05, 60, True, random.Random(0))
+            nda = from_ndarray_result(stub.ImagerySearchNArray(request, timeout=30))
+
+            request.shared_memory = True
+            result = stub.ImagerySearchNArray(request, timeout=30)
+            self.assertFalse(result.data_buffer)
+            with SharedMemoryArray(result) as mapped:
+                np.testing.assert_array_equal(nda, mapped)
+            self.assertEqual(1, server.stats()['shared_memory']['added'])
+            channel.close()
+        finally:
+            server.stop(grace=5.0)
+        self.assertEqual(0, server.stats()['shared_memory']['expired'])
+
+        # refused unless the server was started with b_shared_memory
+        server = ImageryServer(port=0, max_workers=1, base_mount_path=self.base_mount_path).start()
+        try:
+            channel = grpc.insecure_channel("localhost:{}".format(server.port))
+            with self.assertRaises(grpc.RpcError) as context:
+                epl_imagery_pb2_grpc.ImageryOperatorsStub(channel).ImagerySearchNArray(request, timeout=30)
+            self.assertIs(grpc.StatusCode.INVALID_ARGUMENT, context.exception.code())
+            channel.close()
+        finally:
+            server.stop(grace=5.0)
+
+
+class TestStreamClose(unittest.TestCase):
+    class Service:
+        def __init__(self):
+            self.closed = threading.Event()
+
+        def metadata_search(self, request):
+            try:
+                while True:
+                    yield request
+            finally:
+                self.closed.set()
+
+    class Context:
+        def __init__(self):
+            self.callbacks = []
+
+        def add_callback(self, callback):
+            self.callbacks.append(callback)
+            return True
+
+        def is_active(self):
+            return True
+
+        def time_remaining(self):
+            return None
+
+    def test_cancel(self):
+        service = self.Service()
+        context = self.Context()
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            responses = ImageryServicer(service, executor).MetadataSearch("row", context)
+            self.assertEqual("row", next(responses))
+
+            # grpc stops resuming a cancelled rpc's handler and runs its callbacks
+            for callback in context.callbacks:
+                callback()
+            self.assertTrue(service.closed.wait(5))
+
+
+class TestSingleFlight(unittest.TestCase):
+    def test_coalesce(self):
+        single_flight = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def work(value):
+            calls.append(value)
+            release.wait()
+            return np.full(4, value)
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            futures = [single_flight.submit("a", executor, work, 1) for _ in range(8)]
+            other = single_flight.submit("b", executor, work, 2)
+            uncoalesced = single_flight.submit(None, executor, work, 3)
+            self.assertEqual(2, single_flight.in_flight)
+            release.set()
+
+            results = [future.result() for future in futures]
+            self.assertTrue(all(result is results[0] for result in results))
+            np.testing.assert_array_equal(np.full(4, 2), other.result())
+            uncoalesced.result()
+
+        self.assertEqual(3, len(calls))
+        self.assertEqual({'started': 3, 'coalesced': 7}, single_flight.stats())
+        self.assertEqual(0, single_flight.in_flight)
+
+        # done work isn't shared with later requests
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            single_flight.submit("a", executor, work, 1).result()
+        self.assertEqual(4, len(calls))
+
+    def test_deadline(self):
+        single_flight = SingleFlight()
+        release = threading.Event()
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            blocker = single_flight.submit(None, executor, release.wait)
+            expired = single_flight.submit("a", executor, lambda: 1, deadline=time.monotonic() + 0.01)
+            time.sleep(0.05)
+            release.set()
+            blocker.result()
+            self.assertRaises(DeadlineExpired, expired.result)
+
+            # a second caller with no deadline keeps the work wanted
+            release.clear()
+            blocker = single_flight.submit(None, executor, release.wait)
+            shared = single_flight.submit("b", executor, lambda: 2, deadline=time.monotonic() + 0.01)
+            self.assertIs(shared, single_flight.submit("b", executor, lambda: 2))
+            time.sleep(0.05)
+            release.set()
+            self.assertEqual(2, shared.result())
+
+    def test_request_key(self):
+        request = epl_imagery_pb2.ImageryRequest(spatial_resolution_m=60, output_type=epl_imagery_pb2.BYTE)
+        request.metadata.add(scene_id="LC80330342017072LGN00", product_id="LC08_L1TP", cloud_cover=3.0)
+        request.band_definitions.add(band_type=epl_imagery_pb2.RED, scale_params=[0, 40000])
+        request.envelope_boundary.extend([-105.6, 36.3, -105.5, 36.4])
+
+        same = epl_imagery_pb2.ImageryRequest()
+        same.CopyFrom(request)
+        # metadata beyond the ids doesn't change the pixels
+        same.metadata[0].cloud_cover = 10.0
+        self.assertEqual(get_request_key(request), get_request_key(same))
+
+        different = epl_imagery_pb2.ImageryRequest()
+        different.CopyFrom(request)
+        different.spatial_resolution_m = 30
+        self.assertNotEqual(get_request_key(request), get_request_key(different))
+
+        file_request = epl_imagery_pb2.ImageryFileRequest(imagery_request=request, file_type=epl_imagery_pb2.PNG)
+        self.assertNotEqual(get_request_key(request), get_request_key(file_request))
+
+
+class TestSharedMemoryLeases(unittest.TestCase):
+    def test_reap(self):
+        nda = np.arange(100, dtype=np.uint8)
+        leases = SharedMemoryLeases(lease_seconds=60.0)
+        claimed = to_shared_memory_result(nda, leases=leases)
+        unclaimed = to_shared_memory_result(nda, leases=leases)
+        with SharedMemoryArray(claimed) as mapped:
+            np.testing.assert_array_equal(nda, mapped)
+
+        # neither lease is up yet
+        leases.reap()
+        self.assertEqual({'added': 2, 'expired': 0, 'leased': 2}, leases.stats())
+
+        leases.reap(b_all=True)
+        self.assertEqual({'added': 2, 'expired': 1, 'leased': 0}, leases.stats())
+        with self.assertRaises(FileNotFoundError):
+            SharedMemoryArray(unclaimed)
+
+        # a lease of 0 is up as soon as it's added
+        leases = SharedMemoryLeases(lease_seconds=0.0)
+        to_shared_memory_result(nda, leases=leases)
+        self.assertEqual(1, leases.stats()['expired'])
+
+
+class TestResultCache(unittest.TestCase):
+    def test_evict_by_bytes(self):
+        result_cache = ResultCache(max_bytes=1000)
+        small = epl_imagery_pb2.BigFileResult(data=b"a" * 100)
+        large = epl_imagery_pb2.BigFileResult(data=b"b" * 700)
+
+        self.assertIsNone(result_cache.get("small"))
+        result_cache.put("small", small)
+        result_cache.put("large", large)
+        self.assertIs(small, result_cache.get("small"))
+
+        # "large" is the least recently used, a second large result pushes it out, not "small"
+        result_cache.put("other", epl_imagery_pb2.BigFileResult(data=b"c" * 700))
+        self.assertIsNone(result_cache.get("large"))
+        self.assertIs(small, result_cache.get("small"))
+
+        # too big to ever fit
+        result_cache.put("huge", epl_imagery_pb2.BigFileResult(data=b"d" * 2000))
+        self.assertIsNone(result_cache.get("huge"))
+
+        stats = result_cache.stats()
+        self.assertEqual(2, stats['hits'])
+        self.assertEqual(3, stats['misses'])
+        self.assertAlmostEqual(0.4, stats['hit_ratio'])
+        self.assertEqual(2 * small.ByteSize(), stats['bytes_saved'])
+        self.assertEqual(1, stats['evictions'])
+        self.assertEqual(2, stats['entries'])
+        self.assertLessEqual(stats['bytes'], 1000)